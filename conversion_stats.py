@@ -0,0 +1,105 @@
+__author__ = 'Renchen'
+
+import os.path
+import json
+import threading
+
+class conversion_stats(object):
+	'''
+	Per-document conversion history (duration, page count, file size) keyed
+	on document hash and role ('ref' or 'tar'). Used to schedule the most
+	expensive documents first so a few huge files don't end up setting the
+	wall-clock time of the run.
+	'''
+	def __init__(self, path=None):
+		self.__path = path
+		self.__lock = threading.Lock()
+		# hash -> role -> {'duration': seconds, 'pages': n, 'size': bytes}
+		self.__entries = {}
+		if self.__path and os.path.exists(self.__path):
+			try:
+				with open(self.__path, 'rb') as file:
+					self.__entries = json.loads(file.read().decode('utf-8'))
+			except Exception as e:
+				print(e)
+				self.__entries = {}
+
+	def record(self, hash, role, duration, pages, size, partial=False):
+		'''
+		partial: only some pages were rendered, so pages is a lower bound of the page count
+		'''
+		with self.__lock:
+			roles = self.__entries.setdefault(hash, {})
+			if partial and role in roles:
+				pages = max(pages, roles[role]['pages'])
+			roles[role] = {'duration': duration, 'pages': pages, 'size': size}
+
+	def pages(self, hash):
+		'''
+		Largest page count seen for the document, or None if it was never converted
+		'''
+		with self.__lock:
+			roles = self.__entries.get(hash)
+			if not roles:
+				return None
+			return max(entry['pages'] for entry in roles.values())
+
+	def __seconds_per_byte(self):
+		'''
+		role -> average conversion time per byte of source document
+		'''
+		totals = {}
+		for roles in self.__entries.values():
+			for role, entry in roles.items():
+				total = totals.setdefault(role, [0.0, 0])
+				total[0] += entry['duration']
+				total[1] += entry['size']
+		return dict((role, duration / size) for role, (duration, size) in totals.items() if size)
+
+	def __estimate(self, hash, size, rates):
+		roles = self.__entries.get(hash, {})
+		if not roles and not rates:
+			# No history at all, the file size is all there is
+			return size
+		# A document costs its conversion in every role, the ones it was never
+		# converted in are estimated from its size
+		cost = sum(entry['duration'] for entry in roles.values())
+		return cost + sum(size * rate for role, rate in rates.items() if role not in roles)
+
+	def order(self, files, hash_func):
+		'''
+		Sort files longest-first by their historical conversion time
+		'''
+		# Hashing may read the files, keep it out of the lock so record() isn't blocked
+		keys = []
+		for path in files:
+			try:
+				size = os.path.getsize(path)
+			except Exception:
+				size = 0
+			keys.append((path, hash_func(path), size))
+		return self.rank(keys)
+
+	def rank(self, keys):
+		'''
+		Sort (path, hash, size) keys longest-first and return the paths, for
+		callers that know hashes and sizes already
+		'''
+		with self.__lock:
+			rates = self.__seconds_per_byte()
+			costs = dict((path, self.__estimate(hash, size, rates)) for path, hash, size in keys)
+		return sorted(costs.keys(), key=lambda path: costs[path], reverse=True)
+
+	def save(self):
+		if not self.__path:
+			return
+		with self.__lock:
+			json_str = json.dumps(self.__entries)
+
+		tmp_path = self.__path + '.tmp'
+		try:
+			with open(tmp_path, 'wb') as file:
+				file.write(json_str.encode('utf-8'))
+			os.replace(tmp_path, self.__path)
+		except Exception as e:
+			print(e)
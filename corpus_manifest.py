@@ -0,0 +1,253 @@
+__author__ = 'Renchen'
+
+import os
+import json
+import threading
+
+def document_tags(src_dir, path):
+	'''
+	Tags of a source document: the name of src_dir followed by the folders
+	between src_dir and the document, e.g. a document in PDFTest/Annotations
+	is tagged ['PDFTest', 'Annotations']
+	'''
+	relpath = os.path.relpath(path, os.path.commonprefix([path, src_dir]))
+	relpath_nofname = os.path.split(relpath)[0]
+	ret = [os.path.split(src_dir)[1]]
+	while relpath_nofname:
+		(relpath_nofname, tag) = os.path.split(relpath_nofname)
+		ret.append(tag)
+	return ret
+
+def _matches(entry, st):
+	# Same stamp as hash_index: a document rewritten in place keeps its folder's mtime, not its own
+	return [entry['size'], entry['mtime'], entry.get('inode')] == [st.st_size, st.st_mtime_ns, st.st_ino]
+
+def _min_mtime(changed_since):
+	if changed_since is None:
+		return None
+	if hasattr(changed_since, 'timestamp'):
+		changed_since = changed_since.timestamp()
+	return int(changed_since * 1e9)
+
+def _document(src_dir, path, ext, st):
+	return {'size': st.st_size, 'mtime': st.st_mtime_ns, 'inode': st.st_ino, 'hash': None,
+			'tags': document_tags(src_dir, path), 'ext': ext, 'pages': None}
+
+class corpus_manifest(object):
+	'''
+	Persisted listing of the source documents under src_dir: path (relative
+	to src_dir), size, mtime, inode, document hash, tags, extension and page
+	count. A folder is only listed again when its mtime changed, so
+	refreshing the manifest costs a stat per folder and per document instead
+	of a full walk, and document hashes are kept until the file changes.
+	Without refresh the manifest, hashes included, is trusted as it is.
+
+	Also used as the regression's document hash source: document_hash and
+	digest have the same interface as hash_index, which is used for anything
+	that isn't a known document.
+	'''
+	# Documents the converters know about, whatever the extensions of the current run
+	EXTS = ['.pdf', '.docx', '.doc', '.pptx']
+
+	def __init__(self, path, src_dir, hash_cache, page_count=None, refresh=True):
+		'''
+		page_count(hash) fills in the page counts when the manifest is saved
+		'''
+		self.__path = path
+		self.__refresh = refresh
+		# Paths are handed out under src_dir as given, and stored relative to it
+		self.__root = src_dir
+		self.__src_dir = os.path.abspath(src_dir)
+		self.__hash_cache = hash_cache
+		self.__page_count = page_count
+		self.__lock = threading.Lock()
+		self.__dirty = False
+		# relative folder ('' for src_dir) -> {'mtime': ns, 'dirs': [relative subfolders],
+		#                                      'documents': {name: {'size', 'mtime', 'inode', 'hash', 'tags', 'ext', 'pages'}}}
+		self.__folders = {}
+		if self.__path and os.path.exists(self.__path):
+			try:
+				with open(self.__path, 'rb') as file:
+					obj = json.loads(file.read().decode('utf-8'))
+				# A manifest of another tree is useless
+				if obj['root'] == self.__src_dir:
+					self.__folders = obj['folders']
+			except Exception as e:
+				print(e)
+
+	def __in_scope(self, rel, tags):
+		if not tags:
+			return True
+		return bool(set(tags) & set(document_tags(self.__src_dir, os.path.join(self.__src_dir, rel, 'x'))))
+
+	def __list(self, rel, mtime, old):
+		# New record of a folder, keeping what old knew about unchanged documents
+		old_documents = old['documents'] if old else {}
+		dirs = []
+		documents = {}
+		with os.scandir(os.path.join(self.__src_dir, rel)) as entries:
+			for entry in entries:
+				if entry.is_dir():
+					dirs.append(os.path.join(rel, entry.name))
+					continue
+				ext = os.path.splitext(entry.name)[1].lower()
+				if ext not in self.EXTS or not entry.is_file():
+					continue
+				# Not DirEntry.stat(), whose st_ino is 0 on Windows
+				stat = os.stat(entry.path)
+				found = old_documents.get(entry.name)
+				if found and _matches(found, stat):
+					documents[entry.name] = found
+				else:
+					documents[entry.name] = _document(self.__src_dir, entry.path, ext, stat)
+		return {'mtime': mtime, 'dirs': dirs, 'documents': documents}
+
+	def __validate(self, rel, record):
+		# Stat the documents of a folder that wasn't listed again, for the ones rewritten in place
+		for name, found in list(record['documents'].items()):
+			path = os.path.join(self.__src_dir, rel, name)
+			try:
+				stat = os.stat(path)
+			except FileNotFoundError:
+				stat = None
+			if stat and _matches(found, stat):
+				continue
+			with self.__lock:
+				if stat:
+					record['documents'][name] = _document(self.__src_dir, path, found['ext'], stat)
+				else:
+					del record['documents'][name]
+				self.__dirty = True
+
+	def scan(self, exts, tags=None, changed_since=None, refresh=True):
+		'''
+		Yield (folder, document paths) for the documents with one of the
+		extensions in exts, and optionally one of tags and an mtime at or
+		after changed_since (seconds since the epoch or a datetime). With
+		refresh, every folder is stat'ed and listed again if it changed, out of
+		scope ones too since they may have new subfolders in scope, and the
+		documents in scope are stat'ed. Without it the manifest is trusted,
+		only folders it doesn't know yet are listed.
+		'''
+		min_mtime = _min_mtime(changed_since)
+
+		visited = set()
+		stack = ['']
+		while stack:
+			rel = stack.pop()
+			in_scope = self.__in_scope(rel, tags)
+			with self.__lock:
+				record = self.__folders.get(rel)
+			if record is None or refresh:
+				try:
+					mtime = os.stat(os.path.join(self.__src_dir, rel)).st_mtime_ns
+					if record is None or record['mtime'] != mtime:
+						record = self.__list(rel, mtime, record)
+						with self.__lock:
+							self.__folders[rel] = record
+							self.__dirty = True
+					elif in_scope:
+						self.__validate(rel, record)
+				except Exception as e:
+					# Gone, dropped below
+					print(e)
+					continue
+			visited.add(rel)
+			stack.extend(reversed(record['dirs']))
+			if not in_scope:
+				continue
+			docs = []
+			for name, entry in sorted(record['documents'].items()):
+				if entry['ext'] in exts and (min_mtime is None or entry['mtime'] >= min_mtime):
+					docs.append(os.path.join(self.__root, rel, name))
+			if docs:
+				yield os.path.join(self.__root, rel), docs
+
+		with self.__lock:
+			# Folders that were removed, with their documents
+			for rel in [rel for rel in self.__folders.keys() if rel not in visited]:
+				del self.__folders[rel]
+				self.__dirty = True
+
+	def known(self, exts, tags=None, changed_since=None):
+		'''
+		(path, hash, size) of the documents scan would yield according to the
+		manifest as it is, without touching the disk. The hash is None for
+		documents that were never hashed
+		'''
+		min_mtime = _min_mtime(changed_since)
+		ret = []
+		with self.__lock:
+			for rel, record in self.__folders.items():
+				if not self.__in_scope(rel, tags):
+					continue
+				for name, entry in record['documents'].items():
+					if entry['ext'] in exts and (min_mtime is None or entry['mtime'] >= min_mtime):
+						ret.append((os.path.join(self.__root, rel, name), entry['hash'], entry['size']))
+		return ret
+
+	def entry(self, path):
+		'''
+		Manifest entry of a document, or None if it isn't known
+		'''
+		folder, name = os.path.split(os.path.relpath(os.path.abspath(path), self.__src_dir))
+		with self.__lock:
+			record = self.__folders.get(folder)
+			return record['documents'].get(name) if record else None
+
+	def tags(self, path):
+		entry = self.entry(path)
+		return list(entry['tags']) if entry else document_tags(self.__src_dir, os.path.abspath(path))
+
+	def document_hash(self, fpath):
+		'''
+		Hash of a document. With refresh, the hash of the manifest is only used
+		while the document's stat still matches it, otherwise it is trusted
+		'''
+		entry = self.entry(fpath)
+		stat = None
+		if entry and self.__refresh:
+			try:
+				stat = os.stat(fpath)
+			except OSError:
+				pass
+		if entry and entry['hash'] and (not self.__refresh or (stat and _matches(entry, stat))):
+			return entry['hash']
+		hash = self.__hash_cache.document_hash(fpath)
+		if hash and entry:
+			with self.__lock:
+				if stat and not _matches(entry, stat):
+					entry.update({'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'inode': stat.st_ino})
+				entry['hash'] = hash
+				self.__dirty = True
+		return hash
+
+	def digest(self, fpath):
+		return self.__hash_cache.digest(fpath)
+
+	def save(self):
+		'''
+		Save the manifest and the underlying hash_index
+		'''
+		self.__hash_cache.save()
+		if not self.__path:
+			return
+		with self.__lock:
+			if self.__page_count:
+				for entry in [entry for record in self.__folders.values() for entry in record['documents'].values()]:
+					pages = self.__page_count(entry['hash']) if entry['hash'] else None
+					if pages and pages != entry['pages']:
+						entry['pages'] = pages
+						self.__dirty = True
+			if not self.__dirty:
+				return
+			json_str = json.dumps({'root': self.__src_dir, 'folders': self.__folders})
+			self.__dirty = False
+
+		tmp_path = self.__path + '.tmp'
+		try:
+			with open(tmp_path, 'wb') as file:
+				file.write(json_str.encode('utf-8'))
+			os.replace(tmp_path, self.__path)
+		except Exception as e:
+			print(e)
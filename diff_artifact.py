@@ -0,0 +1,223 @@
+__author__ = 'Renchen'
+
+import io
+import os
+import json
+import zipfile
+from PIL import Image
+from PIL import ImageDraw
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+# Compact replacement for full-page difference PNGs. The diffs of all the pages
+# of a document (for one ref-tar pair) are kept in a single zip file:
+#
+#   index.json       {'format': 1, 'pages': {page num: {'size', 'mode', 'boxes'}}}
+#   <page>/<i>.png   patch of the difference image cropped to boxes[i]
+#   <page>/<i>.rle   changed-pixel mask of boxes[i], row-major run lengths
+#                    (uint32, little endian) starting with an unchanged run
+#
+# A diff page is addressed as "<artifact path>#<page num>", see page_path.
+# Viewers rebuild a PNG on demand with render().
+
+EXT = '.rdiff'
+FORMAT = 1
+INDEX = 'index.json'
+
+def page_path(path, page_num):
+	return '%s#%d' % (path, page_num)
+
+def split_page_path(path):
+	'''
+	(artifact path, page num) of a page path, or (path, None) for a plain file
+	'''
+	base, sep, page = path.rpartition('#')
+	if sep and base.endswith(EXT) and page.isdigit():
+		return base, int(page)
+	return path, None
+
+def exists(path):
+	'''
+	Whether a diff image path (a plain file or an artifact page) can be read back
+	'''
+	path, page_num = split_page_path(path)
+	if page_num is None:
+		return os.path.exists(path)
+	try:
+		with diff_artifact(path) as artifact:
+			return page_num in artifact.pages()
+	except Exception:
+		return False
+
+def _rle(mask):
+	flat = mask.ravel()
+	if not flat.size:
+		return b''
+	bounds = numpy.concatenate(([0], numpy.flatnonzero(flat[1:] != flat[:-1]) + 1, [flat.size]))
+	runs = numpy.diff(bounds)
+	if flat[0]:
+		runs = numpy.concatenate(([0], runs))
+	return runs.astype('<u4').tobytes()
+
+def _unrle(data, shape):
+	runs = numpy.frombuffer(data, dtype='<u4')
+	values = numpy.arange(len(runs)) % 2 == 1
+	return numpy.repeat(values, runs).reshape(shape)
+
+def encode_page(diff_image, boxes):
+	'''
+	Page record of a difference image: the boxes that hold every changed
+	pixel, with their mask and cropped patch. Small enough to be sent back
+	from a diff worker and written by write()
+	'''
+	record = {'size': list(diff_image.size), 'mode': diff_image.mode, 'boxes': [], 'masks': [], 'patches': []}
+	for box in boxes:
+		patch = diff_image.crop(box)
+		data = numpy.asarray(patch)
+		mask = data.max(axis=2) != 0 if data.ndim == 3 else data != 0
+		output = io.BytesIO()
+		patch.save(output, 'PNG')
+		record['boxes'].append(list(box))
+		record['masks'].append(_rle(mask))
+		record['patches'].append(output.getvalue())
+	return record
+
+def write(path, pages, keep=()):
+	'''
+	(Re)write the artifact at path with the page records in pages (page num ->
+	encode_page record), plus the pages in keep copied over from the current
+	file. Any other page of the current file is dropped, and the file is
+	removed if no page is left. The file is replaced atomically.
+	'''
+	keep = set(keep) - set(pages.keys())
+	old = None
+	if not os.path.exists(path):
+		keep = set()
+	else:
+		old = zipfile.ZipFile(path)
+		old_index = json.loads(old.read(INDEX).decode('utf-8'))['pages']
+		keep = set(page_num for page_num in keep if str(page_num) in old_index)
+		if not pages and keep == set(int(key) for key in old_index.keys()):
+			# Nothing changed
+			old.close()
+			return
+
+	try:
+		if not pages and not keep:
+			if old:
+				old.close()
+				old = None
+				os.unlink(path)
+			return
+
+		index = {}
+		tmp_path = path + '.tmp'
+		with zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_DEFLATED) as output:
+			for page_num in sorted(keep):
+				index[str(page_num)] = old_index[str(page_num)]
+				for info in old.infolist():
+					if info.filename.startswith('%d/' % page_num):
+						output.writestr(info, old.read(info))
+			for page_num in sorted(pages.keys()):
+				record = pages[page_num]
+				index[str(page_num)] = {'size': record['size'], 'mode': record['mode'], 'boxes': record['boxes']}
+				for i in range(len(record['boxes'])):
+					# PNG data doesn't deflate any further
+					output.writestr('%d/%d.png' % (page_num, i), record['patches'][i], zipfile.ZIP_STORED)
+					output.writestr('%d/%d.rle' % (page_num, i), record['masks'][i])
+			output.writestr(INDEX, json.dumps({'format': FORMAT, 'pages': index}))
+	finally:
+		if old:
+			old.close()
+	os.replace(tmp_path, path)
+
+class diff_artifact(object):
+	'''
+	Read side of an artifact, for viewers
+	'''
+	def __init__(self, path):
+		self.__path = path
+		self.__zip = zipfile.ZipFile(path)
+		index = json.loads(self.__zip.read(INDEX).decode('utf-8'))
+		assert index['format'] <= FORMAT
+		self.__pages = dict((int(key), value) for key, value in index['pages'].items())
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def close(self):
+		self.__zip.close()
+
+	def path(self):
+		return self.__path
+
+	def pages(self):
+		return sorted(self.__pages.keys())
+
+	def page(self, page_num):
+		'''
+		{'size', 'mode', 'boxes'} of a page
+		'''
+		return self.__pages[page_num]
+
+	def mask(self, page_num):
+		'''
+		Boolean array (height x width) of the changed pixels of a page
+		'''
+		page = self.__pages[page_num]
+		mask = numpy.zeros((page['size'][1], page['size'][0]), dtype=bool)
+		for i, (left, top, right, bottom) in enumerate(page['boxes']):
+			mask[top:bottom, left:right] = _unrle(self.__zip.read('%d/%d.rle' % (page_num, i)), (bottom - top, right - left))
+		return mask
+
+	def difference_image(self, page_num):
+		'''
+		The full-page difference image the patches were cropped from
+		'''
+		page = self.__pages[page_num]
+		image = Image.new(page['mode'], tuple(page['size']))
+		for i, box in enumerate(page['boxes']):
+			image.paste(Image.open(io.BytesIO(self.__zip.read('%d/%d.png' % (page_num, i)))), tuple(box[:2]))
+		return image
+
+	def highlight(self, page_num, background=None, color=(255, 0, 0)):
+		'''
+		RGB image of a page with its changed pixels painted in color and its
+		boxes outlined, over a faded background (e.g. the reference render, a
+		path or an Image) or over white
+		'''
+		page = self.__pages[page_num]
+		size = tuple(page['size'])
+		if background is None:
+			base = Image.new('RGB', size, 'white')
+		else:
+			if not isinstance(background, Image.Image):
+				background = Image.open(background)
+			base = Image.blend(background.convert('L').convert('RGB').resize(size), Image.new('RGB', size, 'white'), 0.6)
+		mask = Image.fromarray(self.mask(page_num).astype(numpy.uint8) * 255, 'L')
+		image = Image.composite(Image.new('RGB', size, color), base, mask)
+		draw = ImageDraw.Draw(image)
+		for left, top, right, bottom in page['boxes']:
+			draw.rectangle((left, top, right - 1, bottom - 1), outline=color)
+		return image
+
+def render(path, background=None, highlight=True):
+	'''
+	PNG bytes of a diff page given its Page.path: the highlighted page, or
+	the plain difference image. Plain PNG paths are read as they are
+	'''
+	artifact_path, page_num = split_page_path(path)
+	if page_num is None:
+		with open(path, 'rb') as file:
+			return file.read()
+	with diff_artifact(artifact_path) as artifact:
+		image = artifact.highlight(page_num, background) if highlight else artifact.difference_image(page_num)
+	output = io.BytesIO()
+	image.save(output, 'PNG')
+	return output.getvalue()
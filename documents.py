@@ -1,11 +1,12 @@
 __author__ = 'Renchen'
 
 import os.path
-import hashlib
-import re
 import json
 import regression
+import diff_artifact
+from hash_index import hash_index
 from bson.binary import Binary
+from pymongo import UpdateOne
 
 class Base(object):
 	def __init__(self):
@@ -114,18 +115,23 @@ class Document(Base):
 			return inserted.inserted_id
 
 
-	def populate(self, d_path):
+	def db_key(self):
+		return {'hash': self.get('hash')}
+
+	def dbobj(self):
+		return self.__dummy_copy()
+
+	def populate(self, d_path, hash_cache=None):
 		filename,ext = os.path.splitext(d_path)
 		self.set('document_name', os.path.basename(d_path))
 		self.set('ext', ext)
 		self.set('path', d_path)
 		if not self.get('hash'):
-			try:
-				with open(d_path) as file:
-					sha1 = hashlib.sha1(file.read())
-					self.set('hash', sha1.hexdigest() + '_' + os.path.basename(d_path))
-			except Exception as e:
-				print(e)
+			if not hash_cache:
+				hash_cache = hash_index()
+			hash = hash_cache.document_hash(d_path)
+			if hash:
+				self.set('hash', hash)
 
 	def __dummy_copy(self):
 		doc = Document()
@@ -173,6 +179,12 @@ class Difference(Base):
 
 		return collections['differences'].find_one({'hash': self.get('hash'), 'version': self.get('version')})['_id']
 
+	def db_key(self):
+		return {'hash': self.get('hash'), 'version': self.get('version')}
+
+	def dbobj(self):
+		return self.__dummy_copy()
+
 	def __dummy_copy(self):
 		diff = Difference()
 		diff_obj = diff.obj()
@@ -231,6 +243,12 @@ class Reference(Base):
 			return inserted_ret.inserted_id
 
 
+	def db_key(self):
+		return {'hash': self.get('hash'), 'version': self.get('version')}
+
+	def dbobj(self):
+		return self.__dummy_copy()
+
 	def __dummy_copy(self):
 		bm = Reference()
 		ret = bm.obj()
@@ -239,53 +257,34 @@ class Reference(Base):
 		ret['hash'] = self.get('hash')
 		return ret
 
-	def __filter_files(self, dir, pattern):
-		result = {} # page num -> path
-		for file in os.listdir(dir):
-			ret = re.search(pattern, file)
-			if not ret:
-				continue
-			page_num = int(ret.group(1)) if ret.group(1) else 1
-			result[page_num] = os.path.join(dir, file)
-		return result
-
 	def populate(self, regression, document):
-		# remember: the output generated from binary (pdf2image) for single page pdf will not include the page number
-		pattern = re.escape(os.path.splitext(document.get('document_name'))[0]) + '(?:\.png|_(\d+).png)'
-
 		dname = document.get('document_name')
 		hash = document.get('hash')
 		self.set('hash', hash)
 
 		if regression.out_dir():
 			# find the image outputs based on hash
-			out_dir = regression.out_dir()
-			ref_dir = os.path.join(out_dir, hash, regression.ref_dir_name())
-			tar_dir = os.path.join(out_dir, hash, regression.tar_dir_name())
-			diff_dir = os.path.join(out_dir, hash, regression.diff_dir_name())
-
-			ref_outs = self.__filter_files(ref_dir, pattern)
-			tar_outs = self.__filter_files(tar_dir, pattern)
-			diff_outs = self.__filter_files(diff_dir, pattern)
+			index = regression.get_page_index()
+			ref_outs = index.pages(hash, 'ref', regression.get_reference_version())
+			tar_outs = index.pages(hash, 'tar')
 
+			# Only the pages selected by the run's page_policy were diffed
+			policy = regression.get_page_policy()
 			for page_num in ref_outs.keys():
-				if page_num > 10:
+				if not policy.includes(hash, page_num):
 					continue
 				page = Page()
 
 				self.get('pages')[page_num] = page
-				if len(self.get('pages')) > 10:
-					break
 				page.set('hash', hash)
 				page.set('version', regression.get_reference_version())
 				page.set('document_name', dname)
 				page.set('page_num', page_num)
 				page.set('ext', 'png')
-				page.set('path', os.path.abspath(ref_outs[page_num]))
+				page.set('path', os.path.abspath(ref_outs[page_num]['path']))
 				# with open(ref_outs[page_num], 'r') as mfile:
 				# 	page.set('binary', Binary(mfile.read()))
 
-			metrics_tar_map = regression.diff_metrics_tar_map()
 			difference = Difference()
 			difference.set('version', regression.get_target_version())
 			difference.set('hash', hash)
@@ -293,30 +292,40 @@ class Reference(Base):
 			difference.set('num_page_diffs', len(ref_outs.keys()) - len(tar_outs.keys()))
 			self.get('diffs')[regression.get_target_version()] = difference
 
-			for page_num in diff_outs.keys():
-				if page_num > 10:
+			# Pixel-identical pages have metrics but no diff image
+			for page_num in tar_outs.keys():
+				if not policy.includes(hash, page_num):
 					continue
-				page = Page()
-
-				difference.get('pages')[page_num] = page
-				if len(difference.get('pages').keys()) > 10:
-					break
-				page.set('hash', hash)
-				page.set('version', regression.get_target_version())
-				page.set('document_name', dname)
-				page.set('page_num', page_num)
-				page.set('ext', 'png')
-				page.set('path', os.path.abspath(diff_outs[page_num]))
-				# with open(diff_outs[page_num], 'r') as mfile:
-				# 	page.set('binary', Binary(mfile.read()))
+				result = regression.diff_result(tar_outs[page_num]['path'])
+				if result is None:
+					continue
+				metrics, diff_path = result
+
+				if diff_path:
+					page = Page()
+
+					difference.get('pages')[page_num] = page
+					page.set('hash', hash)
+					page.set('version', regression.get_target_version())
+					page.set('document_name', dname)
+					page.set('page_num', page_num)
+					# Either a difference PNG or a page of the document's diff artifact (see diff_artifact.render)
+					artifact_path, artifact_page = diff_artifact.split_page_path(diff_path)
+					if artifact_page is None:
+						page.set('ext', 'png')
+						page.set('path', os.path.abspath(diff_path))
+					else:
+						page.set('ext', diff_artifact.EXT[1:])
+						page.set('path', diff_artifact.page_path(os.path.abspath(artifact_path), artifact_page))
+					# with open(diff_outs[page_num], 'r') as mfile:
+					# 	page.set('binary', Binary(mfile.read()))
 
-				assert tar_outs[page_num] in metrics_tar_map
-				metrics = metrics_tar_map[tar_outs[page_num]]
 				difference.get('metrics')[page_num] = metrics
 
 				metrics.set('tar_version', regression.get_target_version())
 				metrics.set('ref_version', regression.get_reference_version())
 				metrics.set('hash', hash)
+				metrics.set('page_num', page_num)
 				metrics.set('document_name', dname)
 		else:
 			# Not supposed to be here if you are in a simple regression mode
@@ -341,6 +350,12 @@ class Page(Base):
 
 		return collections['pages'].find_one({'hash': self.get('hash'), 'page_num': self.get('page_num'), 'version': self.get('version')})['_id']
 
+	def db_key(self):
+		return {'hash': self.get('hash'), 'page_num': self.get('page_num'), 'version': self.get('version')}
+
+	def dbobj(self):
+		return self.__dummy_copy()
+
 	def __dummy_copy(self):
 		page = Page()
 		ret = page.obj()
@@ -366,36 +381,186 @@ class DifferenceMetric(Base):
 	'''
 	Each metric represents a page that generated by a target
 	'''
+	# Fields computed by image_diff.ImageDiff
+	METRICS = ['diff_percentage', 'tolerance', 'tolerance_percentage', 'max_delta', 'region_count', 'ssim']
+
 	def __init__(self, obj=None):
 		Base.__init__(self)
 		self._impl = {
 			'diff_percentage': '', # Difference percentage
+			'tolerance': '', # per-channel delta ignored by tolerance_percentage
+			'tolerance_percentage': '', # percentage of pixels changed by more than tolerance
+			'max_delta': '', # largest channel difference
+			'region_count': '', # number of separate changed areas
+			'ssim': '', # structural similarity of grayscale thumbnails, 1 is identical
 			'hash': '', # document hash
+			'page_num': '', # page number
 			'ref_version': '', #version
 			'tar_version': '',
 			'document_name': '', # document name
 		}
 		if obj:
 			assert isinstance(obj, dict)
-			self.set('diff_percentage', obj['diff_percentage'])
+			for key in self.METRICS:
+				if key in obj:
+					self.set(key, obj[key])
 			self.set('document_name', obj['document_name'])
 
 	def bson(self, collections, refversion, tarversion):
 		dbobj = self.__dummy_copy()
-		collections['difference_metrics'].update_one({'hash': self.get('hash'), 'ref_version': self.get('ref_version'), 'tar_version': self.get('tar_version')}, {'$set': dbobj}, upsert=True)
+		collections['difference_metrics'].update_one(self.db_key(), {'$set': dbobj}, upsert=True)
 
-		return collections['difference_metrics'].find_one({'hash': self.get('hash'), 'ref_version': self.get('ref_version'), 'tar_version': self.get('tar_version')})['_id']
+		return collections['difference_metrics'].find_one(self.db_key())['_id']
+
+	def db_key(self):
+		# One metric per page of a ref-tar pair
+		return {'hash': self.get('hash'), 'page_num': self.get('page_num'), 'ref_version': self.get('ref_version'), 'tar_version': self.get('tar_version')}
+
+	def dbobj(self):
+		return self.__dummy_copy()
 
 	def __dummy_copy(self):
 		diff = DifferenceMetric()
 		ret = diff.obj()
-		ret['diff_percentage'] = self.get('diff_percentage')
+		for key in self.METRICS:
+			ret[key] = self.get(key)
 		ret['hash'] = self.get('hash')
+		ret['page_num'] = self.get('page_num')
 		ret['ref_version'] = self.get('ref_version')
 		ret['tar_version'] = self.get('tar_version')
 		ret['document_name'] = self.get('document_name')
 		return ret
 
+class BulkWriter(object):
+	'''
+	Batched replacement for Document.bson. Documents are written chunk by chunk,
+	bottom-up (pages, metrics, differences, references, documents), with one
+	unordered bulk_write per collection and one query per collection to read
+	back the _ids. The resulting collections match what Document.bson produces.
+	'''
+	def __init__(self, collections, chunk_size=1000):
+		self.__collections = collections
+		self.__chunk_size = max(1, chunk_size)
+
+	def __key(self, key):
+		return tuple(key[field] for field in sorted(key.keys()))
+
+	def __bulk(self, collection, requests):
+		for i in range(0, len(requests), self.__chunk_size):
+			self.__collections[collection].bulk_write(requests[i:i + self.__chunk_size], ordered=False)
+
+	def __resolve_ids(self, collection, keys):
+		'''
+		Map natural keys to their _id with one $or query per chunk
+		'''
+		ret = {}
+		for i in range(0, len(keys), self.__chunk_size):
+			chunk = keys[i:i + self.__chunk_size]
+			projection = dict((field, 1) for field in chunk[0].keys())
+			for found in self.__collections[collection].find({'$or': chunk}, projection):
+				ret[self.__key(dict((field, found[field]) for field in chunk[0].keys()))] = found['_id']
+		return ret
+
+	def __upsert_all(self, collection, objs, extra=None):
+		'''
+		Upsert each obj on its natural key (last one wins, like sequential
+		update_one calls) and return natural key -> _id
+		'''
+		unique = {}
+		for obj in objs:
+			unique[self.__key(obj.db_key())] = obj
+		if not unique:
+			return {}
+
+		requests = []
+		for obj in unique.values():
+			dbobj = obj.dbobj()
+			if extra:
+				dbobj.update(extra(obj))
+			requests.append(UpdateOne(obj.db_key(), {'$set': dbobj}, upsert=True))
+		self.__bulk(collection, requests)
+		return self.__resolve_ids(collection, [obj.db_key() for obj in unique.values()])
+
+	def write(self, documents):
+		for i in range(0, len(documents), self.__chunk_size):
+			self.__write_chunk(documents[i:i + self.__chunk_size])
+
+	def __write_chunk(self, documents):
+		references = []
+		for document in documents:
+			references.extend(document.get('references').values())
+		if not references:
+			return
+
+		# Reference pages are only written when the reference is new
+		existing_refs = self.__resolve_ids('references', [reference.db_key() for reference in references])
+		new_refs = [reference for reference in references if self.__key(reference.db_key()) not in existing_refs]
+
+		differences = []
+		for reference in references:
+			differences.extend(reference.get('diffs').values())
+
+		pages = []
+		for reference in new_refs:
+			pages.extend(reference.get('pages').values())
+		for diff in differences:
+			pages.extend(diff.get('pages').values())
+		metrics = []
+		for diff in differences:
+			metrics.extend(diff.get('metrics').values())
+
+		page_ids = self.__upsert_all('pages', pages)
+		metric_ids = self.__upsert_all('difference_metrics', metrics)
+
+		def diff_children(diff):
+			ret = {'pages': {}, 'metrics': {}}
+			for key in diff.get('pages').keys():
+				ret['pages'][str(key)] = page_ids[self.__key(diff.get('pages')[key].db_key())]
+			for key in diff.get('metrics').keys():
+				ret['metrics'][str(key)] = metric_ids[self.__key(diff.get('metrics')[key].db_key())]
+			return ret
+		diff_ids = self.__upsert_all('differences', differences, diff_children)
+
+		requests = []
+		for reference in references:
+			update = {}
+			for key in reference.get('diffs').keys():
+				diff = reference.get('diffs')[key]
+				update['diffs.' + key.replace('.', '_')] = diff_ids[self.__key(diff.db_key())]
+
+			pages_obj = {}
+			for key in reference.get('pages').keys():
+				page_key = self.__key(reference.get('pages')[key].db_key())
+				if page_key in page_ids:
+					pages_obj[str(key)] = page_ids[page_key]
+
+			dbobj = {'$setOnInsert': {'type': reference.get('type'), 'pages': pages_obj}}
+			if update:
+				dbobj['$set'] = update
+			else:
+				dbobj['$setOnInsert']['diffs'] = {}
+			requests.append(UpdateOne(reference.db_key(), dbobj, upsert=True))
+		self.__bulk('references', requests)
+		ref_ids = self.__resolve_ids('references', [reference.db_key() for reference in references])
+
+		requests = []
+		for document in documents:
+			update = {}
+			for key in document.get('references').keys():
+				reference = document.get('references')[key]
+				update['references.' + key.replace('.', '_')] = ref_ids[self.__key(reference.db_key())]
+
+			dbobj = document.dbobj()
+			del dbobj['hash']
+			del dbobj['references']
+			request = {'$setOnInsert': dbobj}
+			if update:
+				request['$set'] = update
+			else:
+				dbobj['references'] = {}
+			requests.append(UpdateOne(document.db_key(), request, upsert=True))
+		self.__bulk('documents', requests)
+
 class JsonEncoder(json.JSONEncoder):
 	def default(self, o):
 		return o.obj()
@@ -1,38 +1,171 @@
 __author__ = 'Renchen'
-import operator
+import threading
+import json
+import time
 
 class errorhandler:
-	def __init__(self, name='error.txt'):
+	'''
+	Thread-safe error sink for one regression run. Every error is written as
+	a json line (run, path, hash, object, category, message, timestamp,
+	duration) through a buffered file, appended to so earlier runs and other
+	workers sharing the file are kept, and can also be streamed to a database
+	collection in batches. crashes(), exceptions() and missing()
+	are answered from in-memory indexes.
+	'''
+	def __init__(self, name='errors.jsonl', collection=None, batch_size=100, buffer_size=64 * 1024):
 		self.__name = name
-		self.__filehandle = open(self.__name, 'wb')
+		self.__lock = threading.Lock()
+		self.__filehandle = open(self.__name, 'ab', buffering=buffer_size)
+		self.__run = time.strftime('%Y%m%d-%H%M%S')
+
 		self.__crashes = []
 
 		# This is a map between exception message and file name
 		self.__exceptions = {}
+		self.__numofexceptions = 0
+		# Sorted view of __exceptions, rebuilt only after it changes
+		self.__exceptions_sorted = None
+
 		self.__missing = []
+		self.__timeouts = []
+		self.__ooms = []
+		# (path, object, category, message) of every error, so replayed ones aren't counted twice
+		self.__seen = set()
 
-	def writemessage(self, msg):
-		self.__filehandle.write(msg)
+		# Records waiting to be inserted into the collection. Until one is attached, all
+		# of them wait, so a collection attached late still gets the whole run
+		self.__collection = collection
+		self.__batch_size = batch_size
+		self.__pending = []
+
+	def attach_collection(self, collection, batch_size=None):
+		'''
+		Stream records to collection, starting with the ones written so far
+		'''
+		with self.__lock:
+			self.__collection = collection
+			if batch_size:
+				self.__batch_size = batch_size
+			flush = len(self.__pending) >= self.__batch_size
+		if flush:
+			self.__flush_pending()
+
+	def run(self):
+		return self.__run
+
+	def set_run(self, run):
+		'''
+		Tag the following records with run, e.g. the id of the sharded run a worker works for
+		'''
+		with self.__lock:
+			self.__run = run
+
+	def __emit(self, record):
+		# Must be called with the lock held. Returns whether a batch is ready for the collection
+		record['run'] = self.__run
+		record['timestamp'] = time.time()
+		self.__filehandle.write(json.dumps(record, ensure_ascii=False).encode('utf-8'))
 		self.__filehandle.write('\n'.encode('utf-8'))
+		self.__pending.append(record)
+		return self.__collection is not None and len(self.__pending) >= self.__batch_size
 
-	def write(self, filepath, message='', object='', iscrash=False, ismissing=False, isexception=False):
+	def __flush_pending(self):
+		# Must be called without the lock, so the database round trip doesn't block the writers
+		with self.__lock:
+			collection = self.__collection
+			if collection is None:
+				return
+			pending = self.__pending
+			self.__pending = []
+		if not pending:
+			return
+		try:
+			collection.insert_many(pending, ordered=False)
+		except Exception as e:
+			print(e)
+
+	def writemessage(self, msg):
+		if isinstance(msg, bytes):
+			msg = msg.decode('utf-8', 'replace')
+		with self.__lock:
+			flush = self.__emit({'category': 'message', 'message': msg.rstrip('\n')})
+		if flush:
+			self.__flush_pending()
+
+	def write(self, filepath, message='', object='', iscrash=False, ismissing=False, isexception=False, istimeout=False, isoom=False, hash=None, duration=None):
 		'''
 		object: 'ref' or 'tar' or ''
 		'''
+		record = {'path': filepath, 'hash': hash, 'object': object, 'message': message, 'duration': duration}
+		with self.__lock:
+			self.__index(record, iscrash, ismissing, isexception, istimeout, isoom)
+			flush = self.__emit(record)
+		if flush:
+			self.__flush_pending()
 
-		if iscrash:
+	def __index(self, record, iscrash=False, ismissing=False, isexception=False, istimeout=False, isoom=False):
+		# Must be called with the lock held
+		filepath = record['path']
+		message = record['message']
+		if istimeout:
+			self.__timeouts.append(filepath)
+			record['category'] = 'timeout'
+		elif isoom:
+			self.__ooms.append(filepath)
+			record['category'] = 'oom'
+		elif iscrash:
 			self.__crashes.append(filepath)
-			self.__filehandle.write(('(%s) Crash when converting: %s\n' % (object, filepath)).encode('utf-8'))
+			record['category'] = 'crash'
 		elif isexception:
 			assert(message)
 			if message not in self.__exceptions:
 				self.__exceptions[message] = [filepath]
 			else:
 				self.__exceptions[message].append(filepath)
-			self.__filehandle.write(('(%s) Exception: %s occurs when converting: %s\n' % (object, message, filepath)).encode('utf-8'))
+			self.__numofexceptions += 1
+			self.__exceptions_sorted = None
+			record['category'] = 'exception'
 		else:
 			self.__missing.append(filepath)
-			self.__filehandle.write(('(%s) %s is missing' % (object, filepath)).encode('utf-8'))
+			record['category'] = 'missing'
+		self.__seen.add((filepath, record['object'], record['category'], message))
+
+	def replay(self, path, run):
+		'''
+		Count the errors another errorhandler (e.g. a sharded worker's) wrote to
+		path for run, as if they had been recorded here. They aren't written
+		again. Missing references are left out, the sanity check looks for them
+		'''
+		flags = {'crash': 'iscrash', 'exception': 'isexception', 'timeout': 'istimeout', 'oom': 'isoom'}
+		count = 0
+		try:
+			with open(path, 'rb') as file:
+				for line in file:
+					try:
+						record = json.loads(line.decode('utf-8'))
+					except ValueError:
+						# Torn last line of a worker that is still writing
+						continue
+					if record.get('run') != run or record.get('category') not in flags:
+						continue
+					with self.__lock:
+						if (record['path'], record['object'], record['category'], record['message']) in self.__seen:
+							continue
+						self.__index(record, **{flags[record['category']]: True})
+					count += 1
+		except Exception as e:
+			print(e)
+		return count
+
+	def flush(self):
+		with self.__lock:
+			self.__filehandle.flush()
+		self.__flush_pending()
+
+	def close(self):
+		self.__flush_pending()
+		with self.__lock:
+			self.__filehandle.close()
 
 	def crashes(self):
 		return self.__crashes
@@ -41,13 +174,19 @@ class errorhandler:
 		return len(item[1])
 
 	def exceptions(self):
-		return sorted(self.__exceptions.items(), key=self.__exception_sort)
+		with self.__lock:
+			if self.__exceptions_sorted is None:
+				self.__exceptions_sorted = sorted(self.__exceptions.items(), key=self.__exception_sort)
+			return self.__exceptions_sorted
 
 	def missing(self):
 		return self.__missing
 
+	def timeouts(self):
+		return self.__timeouts
+
+	def ooms(self):
+		return self.__ooms
+
 	def numofexceptions(self):
-		ret = 0
-		for item in self.__exceptions.items():
-			ret = ret + len(item[1])
-		return ret
\ No newline at end of file
+		return self.__numofexceptions
@@ -0,0 +1,112 @@
+__author__ = 'Renchen'
+
+import os.path
+import hashlib
+import json
+import threading
+
+class hash_index(object):
+	'''
+	Shared SHA-1 index for source documents. Entries are keyed on the
+	absolute path and are only trusted while (size, mtime, inode) still
+	match, so unchanged documents are never re-read. The index is persisted
+	to a sidecar json file between runs.
+	'''
+	def __init__(self, path=None, chunk_size=1024 * 1024):
+		self.__path = path
+		self.__chunk_size = chunk_size
+		self.__lock = threading.Lock()
+
+		# abs path -> [size, mtime_ns, inode, sha1 hexdigest]
+		self.__entries = {}
+
+		# abs path -> lock, so concurrent callers hash a file only once
+		self.__inflight = {}
+		self.__dirty = False
+
+		if self.__path and os.path.exists(self.__path):
+			try:
+				with open(self.__path, 'rb') as file:
+					self.__entries = json.loads(file.read().decode('utf-8'))
+			except Exception as e:
+				print(e)
+				self.__entries = {}
+
+	def __stamp(self, st):
+		return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+	def __lookup(self, key, stamp):
+		entry = self.__entries.get(key)
+		if entry and entry[:3] == stamp:
+			return entry[3]
+		return None
+
+	def digest(self, fpath):
+		'''
+		Return the sha1 hexdigest of fpath, hashing it in chunks only if it
+		is not in the index or has changed since it was indexed.
+		'''
+		key = os.path.abspath(fpath)
+		stamp = self.__stamp(os.stat(key))
+		with self.__lock:
+			found = self.__lookup(key, stamp)
+			if found:
+				return found
+			file_lock = self.__inflight.setdefault(key, threading.Lock())
+
+		with file_lock:
+			try:
+				with self.__lock:
+					found = self.__lookup(key, stamp)
+				if found:
+					return found
+
+				sha1 = hashlib.sha1()
+				with open(key, 'rb') as file:
+					while True:
+						chunk = file.read(self.__chunk_size)
+						if not chunk:
+							break
+						sha1.update(chunk)
+
+				digest = sha1.hexdigest()
+				with self.__lock:
+					self.__entries[key] = stamp + [digest]
+					self.__dirty = True
+				return digest
+			finally:
+				# Also when the read failed, so later callers don't wait on a stale lock
+				with self.__lock:
+					if self.__inflight.get(key) is file_lock:
+						del self.__inflight[key]
+
+	def document_hash(self, fpath):
+		'''
+		The document key used throughout the regression: sha1 + '_' + file name.
+		Returns None if the file cannot be read.
+		'''
+		try:
+			# Append file name in order to avoid conflicts
+			return self.digest(fpath) + '_' + os.path.basename(fpath)
+		except Exception as e:
+			print(e)
+
+	def save(self):
+		if not self.__path:
+			return
+		with self.__lock:
+			if not self.__dirty:
+				return
+			json_str = json.dumps(self.__entries)
+			self.__dirty = False
+
+		tmp_path = self.__path + '.tmp'
+		try:
+			parent = os.path.dirname(self.__path)
+			if parent and not os.path.exists(parent):
+				os.makedirs(parent)
+			with open(tmp_path, 'wb') as file:
+				file.write(json_str.encode('utf-8'))
+			os.replace(tmp_path, self.__path)
+		except Exception as e:
+			print(e)
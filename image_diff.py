@@ -3,61 +3,410 @@ from PIL import Image
 import os
 import argparse
 import json
+import hashlib
+import diff_artifact
 
-def ImageCompare(im1, im2):
-		try:
-			diffcount = 0.0
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+try:
+	from scipy import ndimage
+except ImportError:
+	ndimage = None
+
+# Changed pixels closer than this many pixels are counted as one region
+REGION_CELL = 8
+
+# Renders are compared in TILE x TILE blocks (a multiple of REGION_CELL). Identical
+# blocks are skipped after a byte comparison and only changed ones are differenced
+TILE = 256
+
+# Longest side of the grayscale thumbnails the SSIM score is computed on, and its window
+SSIM_SIZE = 256
+SSIM_WINDOW = 8
+
+def NormalizeModes(im1, im2):
+	'''
+	Bring both renders into a common mode so they can be differenced.
+	Palette and bilevel images are expanded, and mismatched modes fall back
+	to RGB (or RGBA if either side carries alpha).
+	'''
+	def expand(im):
+		if im.mode == 'P':
+			return im.convert('RGBA' if 'transparency' in im.info else 'RGB')
+		if im.mode == '1':
+			return im.convert('L')
+		if im.mode not in ('L', 'LA', 'RGB', 'RGBA'):
+			return im.convert('RGBA' if 'A' in im.getbands() else 'RGB')
+		return im
+
+	im1 = expand(im1)
+	im2 = expand(im2)
+	if im1.mode != im2.mode:
+		mode = 'RGBA' if 'A' in im1.getbands() + im2.getbands() else 'RGB'
+		im1 = im1.convert(mode)
+		im2 = im2.convert(mode)
+
+	# ImageChops.difference only compares the overlapping area
+	if im1.size != im2.size:
+		box = (0, 0, min(im1.size[0], im2.size[0]), min(im1.size[1], im2.size[1]))
+		im1 = im1.crop(box)
+		im2 = im2.crop(box)
+	return im1, im2
+
+def _cells(mask):
+	# Merge a boolean mask into REGION_CELL sized cells
+	height, width = mask.shape
+	rows = (height + REGION_CELL - 1) // REGION_CELL
+	cols = (width + REGION_CELL - 1) // REGION_CELL
+	padded = numpy.zeros((rows * REGION_CELL, cols * REGION_CELL), dtype=bool)
+	padded[:height, :width] = mask
+	return padded.reshape(rows, REGION_CELL, cols, REGION_CELL).any(axis=(1, 3))
+
+def CountRegions(mask):
+	'''
+	Number of 8-connected regions of a boolean mask, after merging it into
+	REGION_CELL sized cells so anti-aliasing specks around one glyph count once
+	'''
+	return _count_cells(_cells(mask))
+
+def _label_cells(cells):
+	# Label array of the 8-connected regions of a cell grid (0 is unchanged) and their number
+	if ndimage is not None:
+		labels, count = ndimage.label(cells, structure=numpy.ones((3, 3)))
+		return labels, int(count)
+
+	# Flood fill over the changed cells only
+	labels = numpy.zeros(cells.shape, dtype=numpy.int32)
+	remaining = set(zip(*numpy.nonzero(cells)))
+	count = 0
+	while remaining:
+		count += 1
+		start = remaining.pop()
+		labels[start] = count
+		stack = [start]
+		while stack:
+			row, col = stack.pop()
+			for dr in (-1, 0, 1):
+				for dc in (-1, 0, 1):
+					neighbour = (row + dr, col + dc)
+					if neighbour in remaining:
+						remaining.remove(neighbour)
+						labels[neighbour] = count
+						stack.append(neighbour)
+	return labels, count
+
+def _count_cells(cells):
+	return _label_cells(cells)[1]
+
+def RegionBoxes(cells, size):
+	'''
+	Pixel boxes (left, upper, right, lower) of the 8-connected regions of a
+	REGION_CELL grid, clipped to an image of the given size
+	'''
+	labels, count = _label_cells(cells)
+	if ndimage is not None:
+		slices = ndimage.find_objects(labels)
+	else:
+		slices = []
+		for label in range(1, count + 1):
+			rows, cols = numpy.nonzero(labels == label)
+			slices.append((slice(rows.min(), rows.max() + 1), slice(cols.min(), cols.max() + 1)))
+	boxes = []
+	for rows, cols in slices:
+		boxes.append((int(cols.start) * REGION_CELL, int(rows.start) * REGION_CELL,
+					  min(int(cols.stop) * REGION_CELL, size[0]), min(int(rows.stop) * REGION_CELL, size[1])))
+	return boxes
+
+def _box_mean(a, size):
+	# Mean over every size x size window, through an integral image
+	integral = numpy.pad(a.cumsum(axis=0).cumsum(axis=1), ((1, 0), (1, 0)))
+	total = integral[size:, size:] - integral[:-size, size:] - integral[size:, :-size] + integral[:-size, :-size]
+	return total / float(size * size)
+
+def StructuralSimilarity(im1, im2):
+	'''
+	Mean SSIM of grayscale thumbnails of both renders (1.0 means identical)
+	'''
+	scale = float(SSIM_SIZE) / max(im1.size)
+	size = im1.size
+	if scale < 1:
+		size = (max(1, int(im1.size[0] * scale)), max(1, int(im1.size[1] * scale)))
+	# Downsample first, so no full-size grayscale copy is made
+	x = numpy.asarray(im1.resize(size, Image.BOX).convert('L'), dtype=numpy.float64)
+	y = numpy.asarray(im2.resize(size, Image.BOX).convert('L'), dtype=numpy.float64)
+	window = min(SSIM_WINDOW, x.shape[0], x.shape[1])
+
+	c1 = (0.01 * 255) ** 2
+	c2 = (0.03 * 255) ** 2
+	mu_x = _box_mean(x, window)
+	mu_y = _box_mean(y, window)
+	var_x = _box_mean(x * x, window) - mu_x * mu_x
+	var_y = _box_mean(y * y, window) - mu_y * mu_y
+	covar = _box_mean(x * y, window) - mu_x * mu_y
+	ssim = ((2 * mu_x * mu_y + c1) * (2 * covar + c2)) / ((mu_x * mu_x + mu_y * mu_y + c1) * (var_x + var_y + c2))
+	return float(ssim.mean())
+
+def ChangedTiles(im1, im2):
+	'''
+	Yield the (left, upper, right, lower) boxes of the tiles whose pixels differ.
+	Both renders must have the same mode and size (see NormalizeModes)
+	'''
+	width, height = im1.size
+	for top in range(0, height, TILE):
+		for left in range(0, width, TILE):
+			box = (left, top, min(left + TILE, width), min(top + TILE, height))
+			if im1.crop(box).tobytes() != im2.crop(box).tobytes():
+				yield box
+
+class TiledImage(object):
+	'''
+	Difference image kept as its changed tiles: size, mode and crop() like a
+	PIL image, but only the cropped box is ever allocated. Unchanged areas
+	are zero
+	'''
+	def __init__(self, size, mode, tiles):
+		self.size = size
+		self.mode = mode
+		# (box, tile image) pairs
+		self.tiles = tiles
+
+	def crop(self, box):
+		ret = Image.new(self.mode, (box[2] - box[0], box[3] - box[1]))
+		for tile_box, tile in self.tiles:
+			left = max(box[0], tile_box[0])
+			upper = max(box[1], tile_box[1])
+			right = min(box[2], tile_box[2])
+			lower = min(box[3], tile_box[3])
+			if left < right and upper < lower:
+				part = tile.crop((left - tile_box[0], upper - tile_box[1], right - tile_box[0], lower - tile_box[1]))
+				ret.paste(part, (left - box[0], upper - box[1]))
+		return ret
 
-			imgcompdiff = ImageChops.difference (im1, im2)
-			diffboundrect = imgcompdiff.getbbox ()
-			imgdiffcrop = imgcompdiff.crop (diffboundrect)
+	def compose(self):
+		return self.crop((0, 0) + self.size)
 
-			data = imgdiffcrop.getdata()
+def TiledDiffStats(im1, im2, tolerance=0, tiles=None, compose=True):
+	'''
+	ComputeDiffStats for normalized renders, computed tile by tile: only the
+	changed tiles (ChangedTiles, unless given) are differenced. The difference
+	image is None if nothing changed, otherwise composed out of those tiles,
+	or with compose=False a TiledImage of them, so no full-page image is made.
+	'cells' is the REGION_CELL grid of every changed pixel, regardless of
+	tolerance.
+	'''
+	width, height = im1.size
+	bands = im1.getbands()
+	if tiles is None:
+		tiles = list(ChangedTiles(im1, im2))
 
-			seq = []
-			for row in data:
-				seq += list(row)
+	grid = ((height + REGION_CELL - 1) // REGION_CELL, (width + REGION_CELL - 1) // REGION_CELL)
+	cells = numpy.zeros(grid, dtype=bool)
+	tolerant_cells = numpy.zeros(grid, dtype=bool) if tolerance else cells
+	max_delta = numpy.zeros(len(bands), dtype=numpy.uint8)
+	diffcount = 0
+	tolerant_count = 0
+	bbox = None
+	diff_tiles = []
+	for box in tiles:
+		tile = ImageChops.difference(im1.crop(box), im2.crop(box))
+		data = numpy.asarray(tile)
+		if data.ndim == 2:
+			data = data.reshape(data.shape[0], data.shape[1], 1)
+		channel_max = data.max(axis=2)
+		count = int(numpy.count_nonzero(channel_max))
+		if not count:
+			continue
+		diffcount += count
+		tolerant = channel_max > tolerance
+		tolerant_count += int(numpy.count_nonzero(tolerant)) if tolerance else count
+		max_delta = numpy.maximum(max_delta, data.reshape(-1, len(bands)).max(axis=0))
 
-			for i in range (0, imgdiffcrop.size[0] * imgdiffcrop.size[1] * 3, 3):
-				if seq[i] != 0 or seq[i+1] != 0 or seq[i+2] != 0:
-					diffcount = diffcount + 1.0
+		row = box[1] // REGION_CELL
+		col = box[0] // REGION_CELL
+		tile_cells = _cells(channel_max != 0)
+		cells[row:row + tile_cells.shape[0], col:col + tile_cells.shape[1]] |= tile_cells
+		if tolerance:
+			tile_cells = _cells(tolerant)
+			tolerant_cells[row:row + tile_cells.shape[0], col:col + tile_cells.shape[1]] |= tile_cells
 
-			diffImgLen = imgcompdiff.size[0] * imgcompdiff.size[1] * 1.0
-			diffpercent = (diffcount * 100) / diffImgLen
-			return diffpercent
+		tile_bbox = tile.getbbox()
+		if tile_bbox:
+			tile_bbox = (tile_bbox[0] + box[0], tile_bbox[1] + box[1], tile_bbox[2] + box[0], tile_bbox[3] + box[1])
+			bbox = tile_bbox if not bbox else (min(bbox[0], tile_bbox[0]), min(bbox[1], tile_bbox[1]), max(bbox[2], tile_bbox[2]), max(bbox[3], tile_bbox[3]))
+
+		diff_tiles.append((box, tile))
+
+	diff_img = None
+	if diff_tiles:
+		diff_img = TiledImage((width, height), diff_tiles[0][1].mode, diff_tiles)
+		if compose:
+			diff_img = diff_img.compose()
+
+	total = width * height * 1.0
+	return {
+		'diff_pixels': diffcount,
+		'diff_percentage': (diffcount * 100) / total if total else 0.0,
+		'tolerance_pixels': tolerant_count,
+		'tolerance_percentage': (tolerant_count * 100) / total if total else 0.0,
+		'bbox': bbox,
+		'max_delta': dict(zip(bands, max_delta.tolist())),
+		'region_count': _count_cells(tolerant_cells) if tolerant_count else 0,
+		'ssim': StructuralSimilarity(im1, im2) if diffcount else 1.0,
+		'diff_image': diff_img,
+		'cells': cells
+	}
+
+def ComputeDiffStats(im1, im2, tolerance=0):
+	'''
+	Compare two renders and return a dict with the number and percentage of
+	changed pixels (a pixel is changed if any of its channels differ), the
+	same above a per-channel tolerance, the bounding box of the changes, the
+	per-channel max delta, the number of changed regions (above tolerance),
+	an SSIM score and the difference image itself (None if nothing changed,
+	with numpy). Without numpy the region count and SSIM score are None.
+	'''
+	im1, im2 = NormalizeModes(im1, im2)
+	if numpy is not None:
+		return TiledDiffStats(im1, im2, tolerance)
+
+	# PIL-native fallback: build changed-pixel masks out of the bands
+	# of a full difference image and count them through the histogram
+	diff_img = ImageChops.difference(im1, im2)
+	width, height = diff_img.size
+	bands = diff_img.getbands()
+	region_count = None
+	ssim = None
+	mask = None
+	tolerant_mask = None
+	max_delta = []
+	for band in diff_img.split():
+		max_delta.append(band.getextrema()[1])
+		band_mask = band.point(lambda v: 255 if v else 0)
+		mask = band_mask if mask is None else ImageChops.lighter(mask, band_mask)
+		band_mask = band.point(lambda v: 255 if v > tolerance else 0)
+		tolerant_mask = band_mask if tolerant_mask is None else ImageChops.lighter(tolerant_mask, band_mask)
+	diffcount = width * height - mask.histogram()[0] if mask else 0
+	tolerant_count = width * height - tolerant_mask.histogram()[0] if tolerant_mask else 0
+
+	total = width * height * 1.0
+	return {
+		'diff_pixels': diffcount,
+		'diff_percentage': (diffcount * 100) / total if total else 0.0,
+		'tolerance_pixels': tolerant_count,
+		'tolerance_percentage': (tolerant_count * 100) / total if total else 0.0,
+		'bbox': diff_img.getbbox() if diffcount else None,
+		'max_delta': dict(zip(bands, max_delta)),
+		'region_count': region_count,
+		'ssim': ssim,
+		'diff_image': diff_img
+	}
+
+def ImageCompare(im1, im2):
+		try:
+			return ComputeDiffStats(im1, im2)['diff_percentage']
 		except IOError:
 			#raise Exception, 'Input file does not exist'
 			pass
 
-def RunImageDiffImpl(tuple):
-		path1, path2, outpath = tuple
-		try:
-			# The first path is the reference path
-			assert os.path.exists(path1)
+def FileDigest(path, chunk_size=1024 * 1024):
+	sha1 = hashlib.sha1()
+	with open(path, 'rb') as file:
+		while True:
+			chunk = file.read(chunk_size)
+			if not chunk:
+				break
+			sha1.update(chunk)
+	return sha1.hexdigest()
 
-			if not os.path.exists(path2):
-				print(path2 + " doesn't exist! Skipped!")
-				return
-			else:
-				im1 = Image.open(path1)
-				img2 = Image.open(path2)
-				#enhancer = ImageEnhance.Sharpness(img2)
-				#img2 = enhancer.enhance(8)
-				diff_img = ImageChops.difference(im1, img2)
-				diff_image_path = os.path.join(outpath, os.path.basename(path1))
+def PixelsIdentical(im1, im2):
+	'''
+	Compare decoded pixel data tile by tile without building a difference
+	image, stopping at the first changed tile. Like the diff stats, only the
+	overlapping area of renders of different sizes is compared
+	'''
+	im1, im2 = NormalizeModes(im1, im2)
+	return next(ChangedTiles(im1, im2), None) is None
+
+def ImageDiff(path1, path2, outpath, tolerance=0, compact=False):
+	'''
+	Library entry point used by the regression worker pool. Returns a dict
+	with diff_image_path, diff_percentage and the metrics of ComputeDiffStats
+	(tolerance, tolerance_percentage, max_delta over all channels,
+	region_count, ssim), or None if the target page is missing. Errors
+	propagate to the caller.
+
+	Checks are tiered from cheap to expensive: file digests, then a byte
+	comparison of the decoded pixels tile by tile, then a diff of only the
+	tiles that changed. Identical pages report 0 and have
+	an empty diff_image_path, since no diff image is written for them.
+
+	With compact (and numpy), no PNG is written either: the changes are
+	returned under 'artifact' as a diff_artifact page record, for the caller
+	to store in the document's diff artifact.
+	'''
+	# The first path is the reference path
+	assert os.path.exists(path1)
 
+	if not os.path.exists(path2):
+		return None
 
-				diff_percentage = ImageCompare(im1, img2)
-				if diff_percentage != 0 or True:
-					# Only save diff if they are different
-					diff_img.save(diff_image_path, 'PNG')
-					msg = {}
-					msg['diff_image_path'] = diff_image_path
-					msg['diff_percentage'] = diff_percentage
+	msg = {}
+	msg['diff_image_path'] = ''
+	msg['diff_percentage'] = 0.0
+	msg['tolerance'] = tolerance
+	msg['tolerance_percentage'] = 0.0
+	msg['max_delta'] = 0
+	msg['region_count'] = 0
+	msg['ssim'] = 1.0
 
-					print(json.dumps(msg))
+	if os.path.getsize(path1) == os.path.getsize(path2) and FileDigest(path1) == FileDigest(path2):
+		return msg
 
+	im1 = Image.open(path1)
+	img2 = Image.open(path2)
+	if numpy is not None:
+		# Two stages: find the changed tiles, then difference only those
+		im1, img2 = NormalizeModes(im1, img2)
+		tiles = list(ChangedTiles(im1, img2))
+		if not tiles:
+			return msg
+		# Compact artifacts crop their patches out of the changed tiles
+		stats = TiledDiffStats(im1, img2, tolerance, tiles, compose=not compact)
+	else:
+		if PixelsIdentical(im1, img2):
+			return msg
+		stats = ComputeDiffStats(im1, img2, tolerance)
 
+	#enhancer = ImageEnhance.Sharpness(img2)
+	#img2 = enhancer.enhance(8)
+	diff_percentage = stats['diff_percentage']
+	if diff_percentage != 0:
+		# Only save diff if they are different
+		if compact and 'cells' in stats:
+			msg['artifact'] = diff_artifact.encode_page(stats['diff_image'], RegionBoxes(stats['cells'], stats['diff_image'].size))
+		else:
+			diff_image_path = os.path.join(outpath, os.path.basename(path1))
+			stats['diff_image'].save(diff_image_path, 'PNG')
+			msg['diff_image_path'] = diff_image_path
+		msg['diff_percentage'] = diff_percentage
+		msg['tolerance_percentage'] = stats['tolerance_percentage']
+		msg['max_delta'] = max(stats['max_delta'].values())
+		msg['region_count'] = stats['region_count']
+		msg['ssim'] = stats['ssim']
+	return msg
+
+def RunImageDiffImpl(tuple):
+		path1, path2, outpath = tuple[:3]
+		tolerance = tuple[3] if len(tuple) > 3 else 0
+		try:
+			msg = ImageDiff(path1, path2, outpath, tolerance)
+			if msg is None:
+				print(path2 + " doesn't exist! Skipped!")
+				return
+			print(json.dumps(msg))
 		except Exception as e:
 			print(e)
 
@@ -79,8 +428,13 @@ def main():
 							type=str,
 							default=None,
 							help="The ouput path")
+		parser.add_argument("-t",
+							"--tolerance",
+							type=int,
+							default=0,
+							help="Per-channel delta under which a pixel doesn't count as changed")
 		args = parser.parse_args()
-		tuple = (args.file1, args.file2, args.output)
+		tuple = (args.file1, args.file2, args.output, args.tolerance)
 
 		RunImageDiffImpl(tuple)
 	except Exception as e:
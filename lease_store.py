@@ -0,0 +1,131 @@
+__author__ = 'Renchen'
+
+import sqlite3
+import threading
+import json
+import time
+from pymongo import UpdateOne, ReturnDocument
+
+# Lease stores for sharded runs. A lease is a batch of documents of one run
+# (paths relative to the source folder) that a single worker converts, diffs
+# and persists. A worker claims a pending lease, or one whose owner stopped
+# renewing it, renews it while working, and completes it at the end.
+#
+# Both stores expose the same methods:
+#   create(run, leases)            leases: map between lease name and files
+#   claim(run, owner, ttl)         lease dict ({'_id', 'files', ...}) or None
+#   renew(lease_id, owner, ttl)    False if the lease was given to someone else
+#   complete(lease_id, owner)
+#   release(lease_id, owner)       back to pending, e.g. after an error
+#   progress(run)                  map between state and number of leases
+#   finished(run)
+
+class mongo_lease_store(object):
+	'''
+	Leases in a Mongo collection, for workers on several hosts
+	'''
+	def __init__(self, collection):
+		self.__collection = collection
+
+	def create(self, run, leases):
+		# Idempotent, so a restarted coordinator doesn't reset leases already done
+		requests = []
+		for name, files in leases.items():
+			lease = {'run': run, 'files': files, 'state': 'pending', 'owner': None, 'expires': 0, 'attempts': 0}
+			requests.append(UpdateOne({'_id': run + '/' + name}, {'$setOnInsert': lease}, upsert=True))
+		if requests:
+			self.__collection.bulk_write(requests, ordered=False)
+
+	def claim(self, run, owner, ttl):
+		now = time.time()
+		return self.__collection.find_one_and_update(
+			{'run': run, '$or': [{'state': 'pending'}, {'state': 'leased', 'expires': {'$lt': now}}]},
+			{'$set': {'state': 'leased', 'owner': owner, 'expires': now + ttl}, '$inc': {'attempts': 1}},
+			sort=[('_id', 1)],
+			return_document=ReturnDocument.AFTER)
+
+	def renew(self, lease_id, owner, ttl):
+		ret = self.__collection.update_one({'_id': lease_id, 'state': 'leased', 'owner': owner}, {'$set': {'expires': time.time() + ttl}})
+		return ret.matched_count == 1
+
+	def complete(self, lease_id, owner):
+		ret = self.__collection.update_one({'_id': lease_id, 'state': 'leased', 'owner': owner}, {'$set': {'state': 'done'}})
+		return ret.matched_count == 1
+
+	def release(self, lease_id, owner):
+		self.__collection.update_one({'_id': lease_id, 'state': 'leased', 'owner': owner}, {'$set': {'state': 'pending', 'owner': None}})
+
+	def progress(self, run):
+		ret = {}
+		for item in self.__collection.aggregate([{'$match': {'run': run}}, {'$group': {'_id': '$state', 'count': {'$sum': 1}}}]):
+			ret[item['_id']] = item['count']
+		return ret
+
+	def finished(self, run):
+		return self.__collection.count_documents({'run': run, 'state': {'$ne': 'done'}}) == 0
+
+
+class sqlite_lease_store(object):
+	'''
+	Leases in an SQLite file, for workers on the same host (and tests)
+	'''
+	def __init__(self, path):
+		self.__lock = threading.Lock()
+		# Autocommit mode, transactions are opened explicitly
+		self.__connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+		self.__connection.execute('PRAGMA journal_mode=WAL')
+		self.__connection.execute('''CREATE TABLE IF NOT EXISTS leases (
+			id TEXT PRIMARY KEY,
+			run TEXT NOT NULL,
+			files TEXT,
+			state TEXT,
+			owner TEXT,
+			expires REAL,
+			attempts INTEGER)''')
+		self.__connection.execute('CREATE INDEX IF NOT EXISTS leases_run_state ON leases (run, state)')
+
+	def create(self, run, leases):
+		with self.__lock:
+			self.__connection.execute('BEGIN IMMEDIATE')
+			self.__connection.executemany('INSERT OR IGNORE INTO leases VALUES (?, ?, ?, \'pending\', NULL, 0, 0)',
+										  [(run + '/' + name, run, json.dumps(files)) for name, files in leases.items()])
+			self.__connection.execute('COMMIT')
+
+	def claim(self, run, owner, ttl):
+		now = time.time()
+		with self.__lock:
+			# BEGIN IMMEDIATE takes the write lock, so two processes can't claim the same lease
+			self.__connection.execute('BEGIN IMMEDIATE')
+			try:
+				row = self.__connection.execute('SELECT id, files, attempts FROM leases WHERE run = ? AND '
+												'(state = \'pending\' OR (state = \'leased\' AND expires < ?)) ORDER BY id LIMIT 1',
+												(run, now)).fetchone()
+				if row:
+					self.__connection.execute('UPDATE leases SET state = \'leased\', owner = ?, expires = ?, attempts = attempts + 1 WHERE id = ?',
+											  (owner, now + ttl, row[0]))
+			finally:
+				self.__connection.execute('COMMIT')
+		if not row:
+			return None
+		return {'_id': row[0], 'run': run, 'files': json.loads(row[1]), 'state': 'leased', 'owner': owner, 'expires': now + ttl, 'attempts': row[2] + 1}
+
+	def __update(self, sql, args):
+		with self.__lock:
+			return self.__connection.execute(sql, args).rowcount == 1
+
+	def renew(self, lease_id, owner, ttl):
+		return self.__update('UPDATE leases SET expires = ? WHERE id = ? AND state = \'leased\' AND owner = ?', (time.time() + ttl, lease_id, owner))
+
+	def complete(self, lease_id, owner):
+		return self.__update('UPDATE leases SET state = \'done\' WHERE id = ? AND state = \'leased\' AND owner = ?', (lease_id, owner))
+
+	def release(self, lease_id, owner):
+		self.__update('UPDATE leases SET state = \'pending\', owner = NULL WHERE id = ? AND state = \'leased\' AND owner = ?', (lease_id, owner))
+
+	def progress(self, run):
+		with self.__lock:
+			return dict(self.__connection.execute('SELECT state, COUNT(*) FROM leases WHERE run = ? GROUP BY state', (run,)).fetchall())
+
+	def finished(self, run):
+		with self.__lock:
+			return self.__connection.execute('SELECT COUNT(*) FROM leases WHERE run = ? AND state != \'done\'', (run,)).fetchone()[0] == 0
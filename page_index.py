@@ -0,0 +1,108 @@
+__author__ = 'Renchen'
+
+import os
+import threading
+
+def page_number(name, stem):
+	'''
+	Page number of a render named after the document stem, or None if name isn't one.
+	The converters don't number the output of single page documents: stem.png is page 1
+	'''
+	if not name.endswith('.png') or not name.startswith(stem):
+		return None
+	rest = name[len(stem):-len('.png')]
+	if not rest:
+		return 1
+	if rest[0] == '_' and rest[1:].isdigit():
+		return int(rest[1:])
+	return None
+
+def scan_pages(directory, stem):
+	'''
+	Map between page number and {'path', 'size', 'mtime'} of the renders of
+	the document named stem in directory, in a single os.scandir pass
+	'''
+	pages = {}
+	try:
+		with os.scandir(directory) as entries:
+			for entry in entries:
+				page_num = page_number(entry.name, stem)
+				if page_num is None or not entry.is_file():
+					continue
+				stat = entry.stat()
+				pages[page_num] = {'path': entry.path, 'size': stat.st_size, 'mtime': stat.st_mtime}
+	except FileNotFoundError:
+		pass
+	return pages
+
+def iter_tree(root, exts):
+	'''
+	Walk root with os.scandir and yield (directory, paths) for every directory
+	holding files with one of the extensions in exts (lowercase), as soon as
+	that directory has been read
+	'''
+	stack = [root]
+	while stack:
+		directory = stack.pop()
+		paths = []
+		try:
+			with os.scandir(directory) as entries:
+				for entry in entries:
+					if entry.is_dir():
+						stack.append(entry.path)
+					elif os.path.splitext(entry.name)[1].lower() in exts:
+						paths.append(entry.path)
+		except Exception as e:
+			print(e)
+		if paths:
+			yield directory, paths
+
+def scan_tree(root, exts):
+	'''
+	Paths of all the files under root with one of the extensions in exts
+	'''
+	return [path for directory, paths in iter_tree(root, exts) for path in paths]
+
+class page_index(object):
+	'''
+	Index of the page renders under out_dir, keyed on (hash, role, version).
+	role is 'ref', 'tar' or 'diff', and version is the reference version,
+	None for targets, or the "<ref>-<tar>" folder name for diffs. A directory
+	is scanned on first use and then only when a conversion or a diff
+	rewrote it.
+	'''
+	def __init__(self, out_dir):
+		self.__out_dir = out_dir
+		self.__lock = threading.Lock()
+		# (hash, role, version) -> page num -> {'path', 'size', 'mtime'}
+		self.__pages = {}
+
+	def directory(self, hash, role, version=None):
+		if version:
+			return os.path.join(self.__out_dir, hash, role, version)
+		return os.path.join(self.__out_dir, hash, role)
+
+	def __stem(self, hash):
+		# Document hashes are <sha1>_<file name>
+		return os.path.splitext(hash.split('_', 1)[1])[0]
+
+	def pages(self, hash, role, version=None):
+		key = (hash, role, version)
+		with self.__lock:
+			pages = self.__pages.get(key)
+		if pages is None:
+			pages = self.refresh(hash, role, version)
+		return pages
+
+	def refresh(self, hash, role, version=None):
+		'''
+		Re-scan one directory, e.g. after a conversion finished writing into it
+		'''
+		pages = scan_pages(self.directory(hash, role, version), self.__stem(hash))
+		with self.__lock:
+			self.__pages[(hash, role, version)] = pages
+		return pages
+
+	def invalidate(self, hash, role, version=None):
+		with self.__lock:
+			self.__pages.pop((hash, role, version), None)
@@ -0,0 +1,138 @@
+__author__ = 'Renchen'
+
+import os
+import re
+import zipfile
+import threading
+
+# Page tree nodes of a PDF, whose /Count is the number of pages below them
+_PDF_OBJECT = re.compile(br'\bobj\b(.*?)\bendobj\b', re.S)
+_PDF_PAGES = re.compile(br'/Type\s*/Pages(?![A-Za-z0-9])')
+_PDF_COUNT = re.compile(br'/Count\s+(\d+)')
+# Page (docx) or slide (pptx) count saved by Office in the document properties
+_OFFICE_COUNT = re.compile(br'<(?:Pages|Slides)>(\d+)</')
+
+def probe_page_count(path):
+	'''
+	Page count of a document without rendering it, or None if it can't be
+	told cheaply: the root of a PDF's page tree (unless it's inside a
+	compressed object stream), or the properties of a docx or pptx
+	'''
+	try:
+		ext = os.path.splitext(path)[1].lower()
+		if ext == '.pdf':
+			with open(path, 'rb') as file:
+				data = file.read()
+			counts = [int(count) for obj in _PDF_OBJECT.finditer(data) if _PDF_PAGES.search(obj.group(1))
+					  for count in _PDF_COUNT.findall(obj.group(1))]
+			return max(counts) if counts else None
+		if ext in ['.docx', '.pptx']:
+			with zipfile.ZipFile(path) as archive:
+				found = _OFFICE_COUNT.search(archive.read('docProps/app.xml'))
+			return int(found.group(1)) if found else None
+	except Exception as e:
+		print(e)
+	return None
+
+class page_policy(object):
+	'''
+	Decides which pages of a document are rendered, diffed and stored.
+	The selection for a document is made once per run and cached, so the
+	converters, the image diff and the database layers all see the same pages.
+
+	mode:
+		'all'     every page
+		'first'   pages 1..max_pages
+		'sampled' max_pages pages spread evenly over the document. The page
+		          count comes from previous runs, or from probe_page_count the
+		          first time (all pages if it can't be probed)
+		'changed' pages that differed in the last run, topped up with the first pages
+	'''
+	MODES = ['all', 'first', 'sampled', 'changed']
+
+	def __init__(self, mode='first', max_pages=10, page_count=None, changed_pages=None):
+		'''
+		page_count(hash) and changed_pages(hash) look up what previous runs
+		know about a document; either may return None when nothing is known.
+		'''
+		assert mode in self.MODES
+		self.__mode = mode
+		self.__max_pages = max_pages
+		self.__page_count = page_count
+		self.__changed_pages = changed_pages
+		self.__lock = threading.Lock()
+		# hash -> sorted list of page numbers, or None for all pages
+		self.__selections = {}
+
+	def mode(self):
+		return self.__mode
+
+	def __first(self, count=None):
+		last = min(self.__max_pages, count) if count else self.__max_pages
+		return list(range(1, last + 1))
+
+	def __sampled(self, hash, path=None):
+		count = self.__page_count(hash) if self.__page_count else None
+		if not count and path:
+			count = probe_page_count(path)
+		if not count:
+			# Never converted and can't be probed: render everything once to learn how long the document is
+			return None
+		if count <= self.__max_pages:
+			return list(range(1, count + 1))
+		if self.__max_pages == 1:
+			return [1]
+		# Always keep the first and last pages
+		step = (count - 1) / float(self.__max_pages - 1)
+		return sorted(set(int(round(i * step)) + 1 for i in range(self.__max_pages)))
+
+	def __changed(self, hash):
+		changed = self.__changed_pages(hash) if self.__changed_pages else None
+		pages = sorted(set(changed))[:self.__max_pages] if changed else []
+		for page_num in self.__first():
+			if len(pages) >= self.__max_pages:
+				break
+			if page_num not in pages:
+				pages.append(page_num)
+		return sorted(pages)
+
+	def select(self, hash, path=None):
+		'''
+		Sorted list of the page numbers to process, or None for all of them.
+		path is the source document, probed for its page count if needed
+		'''
+		if self.__mode == 'all' or not self.__max_pages:
+			return None
+		with self.__lock:
+			if hash in self.__selections:
+				return self.__selections[hash]
+		if self.__mode == 'first':
+			pages = self.__first()
+		elif self.__mode == 'sampled':
+			pages = self.__sampled(hash, path)
+		else:
+			pages = self.__changed(hash)
+		with self.__lock:
+			return self.__selections.setdefault(hash, pages)
+
+	def includes(self, hash, page_num, path=None):
+		pages = self.select(hash, path)
+		return pages is None or page_num in pages
+
+	def page_range(self, hash):
+		'''
+		Selection as a converter page range, e.g. "1-3,7,9-10", or None for all pages
+		'''
+		pages = self.select(hash)
+		if pages is None:
+			return None
+		ranges = []
+		start = prev = pages[0]
+		for page_num in pages[1:] + [None]:
+			if page_num is not None and page_num == prev + 1:
+				prev = page_num
+				continue
+			ranges.append(str(start) if start == prev else '%d-%d' % (start, prev))
+			if page_num is not None:
+				start = prev = page_num
+		return ','.join(ranges)
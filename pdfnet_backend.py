@@ -0,0 +1,199 @@
+__author__ = 'Renchen'
+
+import os.path
+import importlib
+import threading
+import multiprocessing
+
+# PDFNetPython module of the build loaded by this worker process
+_pdfnet = None
+
+def _init_worker(lib_name):
+	global _pdfnet
+	_pdfnet = importlib.import_module(lib_name + '.PDFNetPython')
+	_pdfnet.PDFNet.Initialize()
+
+def _version():
+	return str(_pdfnet.PDFNet.GetVersion())
+
+def _render(filepath, output_dir, dpi, pages=None):
+	'''
+	Rasterize the pages of filepath (all of them, or the page numbers in pages)
+	into output_dir, using the same naming as pdf2image: name.png for single
+	page documents, name_<n>.png otherwise.
+	Returns a status object shaped like the converters' bson block.
+	'''
+	try:
+		doc = _pdfnet.PDFDoc(filepath)
+		doc.InitSecurityHandler()
+		draw = _pdfnet.PDFDraw()
+		if dpi:
+			draw.SetDPI(dpi)
+
+		name = os.path.splitext(os.path.basename(filepath))[0]
+		count = doc.GetPageCount()
+		itr = doc.GetPageIterator()
+		page_num = 1
+		while itr.HasNext():
+			if pages is None or page_num in pages:
+				out = os.path.join(output_dir, name + ('.png' if count == 1 else '_%d.png' % page_num))
+				draw.Export(itr.Current(), out, 'PNG')
+			itr.Next()
+			page_num += 1
+		doc.Close()
+		return {'status': 'ok', 'pages': count}
+	except Exception as e:
+		return {'status': 'exception', 'exception_info': {'failure_reason': str(e)}}
+
+def _worker_main(conn, lib_name):
+	# Loop of a worker process: load the build, then render one document per message until told to stop
+	try:
+		_init_worker(lib_name)
+		conn.send(('ready', _version()))
+	except Exception as e:
+		conn.send(('error', str(e)))
+		return
+	while True:
+		try:
+			job = conn.recv()
+		except EOFError:
+			return
+		if job is None:
+			return
+		conn.send(('done', _render(*job)))
+
+class _worker(object):
+	'''
+	A worker process and the pipe to it. Each worker renders one document at
+	a time, so a crash or a timeout only concerns the document it was given
+	'''
+	def __init__(self, context, lib_name):
+		self.conn, child = context.Pipe()
+		self.process = context.Process(target=_worker_main, args=(child, lib_name), daemon=True)
+		self.process.start()
+		child.close()
+		try:
+			kind, value = self.conn.recv()
+		except EOFError:
+			kind, value = 'error', 'worker exited with code %s' % self.process.exitcode
+		if kind != 'ready':
+			self.kill()
+			raise RuntimeError(value)
+		self.version = value
+
+	def stop(self):
+		try:
+			self.conn.send(None)
+		except Exception:
+			pass
+		self.process.join(5)
+		self.kill()
+
+	def kill(self):
+		if self.process.is_alive():
+			self.process.kill()
+		self.process.join()
+		self.conn.close()
+
+class pdfnet_backend(object):
+	'''
+	Renders PDFs in-process with one of the bundled PDFNetPython builds
+	(reference_lib or target_lib). The build is loaded and initialized once
+	per long-lived worker process, and a backend's workers are pinned to a
+	single build since two builds can't share an interpreter. At most concur
+	workers exist; one that crashed or timed out is killed and replaced.
+
+	The builds must match the interpreter: on Python 3 the bundled Python 2
+	builds can't be loaded, available() is False and every document goes
+	through the converter binaries.
+	'''
+	EXTS = ['.pdf']
+
+	def __init__(self, lib_name, concur=4, dpi=None):
+		self.__lib_name = lib_name
+		self.__dpi = dpi
+		# Never fork: the parent runs converter threads (see Regression.__diff_executor)
+		methods = multiprocessing.get_all_start_methods()
+		self.__context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+		# Workers are counted here, a slot is taken for as long as a worker renders
+		self.__slots = threading.Semaphore(max(1, concur))
+		self.__idle = []
+		self.__lock = threading.Lock()
+		self.__probe_lock = threading.Lock()
+		self.__available = None
+		self.__version = None
+
+	def __acquire(self):
+		self.__slots.acquire()
+		with self.__lock:
+			if self.__idle:
+				return self.__idle.pop()
+		try:
+			return _worker(self.__context, self.__lib_name)
+		except Exception:
+			self.__slots.release()
+			raise
+
+	def __release(self, worker, healthy):
+		if healthy:
+			with self.__lock:
+				self.__idle.append(worker)
+		else:
+			worker.kill()
+		self.__slots.release()
+
+	def available(self):
+		'''
+		False if the build can't be loaded here, in which case callers should fall back to the subprocess converters
+		'''
+		with self.__probe_lock:
+			if self.__available is not None:
+				return self.__available
+			try:
+				worker = self.__acquire()
+				self.__version = worker.version
+				self.__release(worker, True)
+				self.__available = True
+			except Exception as e:
+				print('%s: in-process rendering unavailable, falling back to subprocess. Reason: %s' % (self.__lib_name, e))
+				self.__available = False
+			return self.__available
+
+	def version(self):
+		return self.__version
+
+	def supports(self, filepath):
+		return os.path.splitext(filepath)[1].lower() in self.EXTS and self.available()
+
+	def convert(self, filepath, output_dir, timeout=None, pages=None):
+		'''
+		Returns (failure, status) where failure is None, 'timeout' or 'crash',
+		and status is the bson-like status object of the conversion. The
+		timeout starts once a worker has the document, not while it waits for one
+		'''
+		try:
+			worker = self.__acquire()
+		except Exception as e:
+			# The build loaded when probed, so this is the machine rather than the document
+			print(e)
+			return 'crash', None
+		healthy = False
+		try:
+			worker.conn.send((filepath, output_dir, self.__dpi, pages))
+			if not worker.conn.poll(timeout):
+				return 'timeout', None
+			kind, status = worker.conn.recv()
+			healthy = True
+			return None, status
+		except (EOFError, OSError):
+			# The worker died on this document
+			return 'crash', None
+		finally:
+			self.__release(worker, healthy)
+
+	def shutdown(self):
+		with self.__lock:
+			idle = self.__idle
+			self.__idle = []
+		for worker in idle:
+			worker.stop()
@@ -0,0 +1,94 @@
+__author__ = 'Renchen'
+
+import threading
+import queue
+
+class pipeline(object):
+	'''
+	Per-document convert -> diff -> persist scheduler. Each stage has its own
+	worker threads and the stages are connected by bounded queues, so a slow
+	stage applies backpressure to the one feeding it instead of letting work
+	pile up in memory.
+
+	convert(item) returns the object handed to diff, or None to drop the item.
+	diff(obj) returns the object handed to persist, or None to drop it.
+	persist(objs) receives batches of up to persist_batch objects.
+	'''
+	def __init__(self, convert, diff, persist, convert_concur=4, diff_concur=4, persist_batch=100, queue_size=None):
+		self.__convert = convert
+		self.__diff = diff
+		self.__persist = persist
+		self.__convert_concur = max(1, convert_concur)
+		self.__diff_concur = max(1, diff_concur)
+		self.__persist_batch = max(1, persist_batch)
+		queue_size = queue_size if queue_size else 2 * max(self.__convert_concur, self.__diff_concur)
+
+		self.__convert_queue = queue.Queue(queue_size)
+		self.__diff_queue = queue.Queue(queue_size)
+		self.__persist_queue = queue.Queue(queue_size)
+
+	# Put in a queue once per consumer thread to tell it to stop
+	__DONE = object()
+
+	def __call(self, stage, func, arg):
+		try:
+			return func(arg)
+		except Exception as e:
+			print('pipeline: %s stage failed. Reason: %s' % (stage, e))
+			return None
+
+	def __convert_worker(self):
+		while True:
+			item = self.__convert_queue.get()
+			if item is self.__DONE:
+				return
+			ret = self.__call('convert', self.__convert, item)
+			if ret is not None:
+				self.__diff_queue.put(ret)
+
+	def __diff_worker(self):
+		while True:
+			item = self.__diff_queue.get()
+			if item is self.__DONE:
+				return
+			ret = self.__call('diff', self.__diff, item)
+			if ret is not None:
+				self.__persist_queue.put(ret)
+
+	def __persist_worker(self):
+		done = False
+		while not done:
+			batch = [self.__persist_queue.get()]
+			# Flush whatever is ready instead of waiting for a full batch
+			while len(batch) < self.__persist_batch:
+				try:
+					batch.append(self.__persist_queue.get_nowait())
+				except queue.Empty:
+					break
+			if self.__DONE in batch:
+				done = True
+				batch = [item for item in batch if item is not self.__DONE]
+			if batch:
+				self.__call('persist', self.__persist, batch)
+
+	def __start(self, target, count):
+		threads = [threading.Thread(target=target) for i in range(count)]
+		for thread in threads:
+			thread.daemon = True
+			thread.start()
+		return threads
+
+	def run(self, items):
+		convert_threads = self.__start(self.__convert_worker, self.__convert_concur)
+		diff_threads = self.__start(self.__diff_worker, self.__diff_concur)
+		persist_threads = self.__start(self.__persist_worker, 1)
+
+		for item in items:
+			self.__convert_queue.put(item)
+
+		# Drain the stages one after another
+		for stage_queue, threads in [(self.__convert_queue, convert_threads), (self.__diff_queue, diff_threads), (self.__persist_queue, persist_threads)]:
+			for thread in threads:
+				stage_queue.put(self.__DONE)
+			for thread in threads:
+				thread.join()
@@ -0,0 +1,243 @@
+__author__ = 'Renchen'
+
+import os
+import json
+import time
+import uuid
+import shutil
+import hashlib
+
+# Content-addressed store of reference renders, shared by the runs of one or
+# several machines so a reference version is rendered once. An entry holds the
+# pages one renderer (see renderer_key) produced for one document (its hash):
+#
+#   <root>/objects/<hash[:2]>/<hash>/<renderer>/<selection>/
+#       <stem>_<n>.png   the pages, named as the converter wrote them
+#       COMPLETE         {'format', 'hash', 'renderer', 'selection', 'pages': {file name: {'sha1', 'size'}}}
+#
+# <selection> is 'all', or 'p' followed by a digest of the selected page numbers.
+# Entries are built under <root>/tmp and renamed into place once COMPLETE is
+# written, so a folder under objects is always complete and never modified
+# afterwards. Works on a local folder and on a shared mount (NFS, SMB), as long
+# as rename is atomic within root.
+#
+# The reference folders of a run (out_dir/<hash>/ref/<version>) carry the same
+# COMPLETE marker, written once a conversion succeeded. A folder without it,
+# e.g. left behind by a crash, is converted again (see mark, is_complete).
+
+FORMAT = 1
+MARKER = 'COMPLETE'
+# Publishers that crashed leave their temporary folders behind for this long
+STALE_AGE = 24 * 3600
+
+def renderer_key(version, bin_digest, settings=None):
+	'''
+	Key of a renderer: the reference version name, the sha1 of its binary and
+	whatever else changes the renders (dpi, in-process library...)
+	'''
+	obj = {'version': version, 'bin': bin_digest, 'settings': settings}
+	return hashlib.sha1(json.dumps(obj, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+def _selection_name(selection):
+	if not selection:
+		return 'all'
+	return 'p' + hashlib.sha1(','.join(str(page_num) for page_num in sorted(selection)).encode('utf-8')).hexdigest()[:16]
+
+def _covers(marker, selection):
+	# Pages past the end of the document are never rendered, so an entry made for
+	# a larger selection has every page of a smaller one
+	if marker['selection'] is None:
+		return True
+	return bool(selection) and set(selection) <= set(marker['selection'])
+
+def _copy(src, dst, link=False):
+	'''
+	Copy (or hard link) src to dst and return the sha1 of its content
+	'''
+	if link:
+		try:
+			os.link(src, dst)
+		except OSError:
+			# Another file system, e.g. a shared mount
+			link = False
+	digest = hashlib.sha1()
+	with open(src, 'rb') as input:
+		if link:
+			for data in iter(lambda: input.read(1 << 20), b''):
+				digest.update(data)
+		else:
+			with open(dst, 'wb') as output:
+				for data in iter(lambda: input.read(1 << 20), b''):
+					digest.update(data)
+					output.write(data)
+	return digest.hexdigest()
+
+def _write_json(path, obj, fsync=False):
+	with open(path, 'wb') as file:
+		file.write(json.dumps(obj, sort_keys=True).encode('utf-8'))
+		if fsync:
+			file.flush()
+			os.fsync(file.fileno())
+
+def read_marker(directory):
+	'''
+	The COMPLETE marker of a folder, or None
+	'''
+	try:
+		with open(os.path.join(directory, MARKER), 'rb') as file:
+			marker = json.loads(file.read().decode('utf-8'))
+		return marker if marker.get('format', 0) <= FORMAT else None
+	except FileNotFoundError:
+		return None
+	except Exception as e:
+		print(e)
+		return None
+
+def mark(directory, hash, renderer, pages, selection=None):
+	'''
+	Mark an output folder as complete. pages maps the file names of the
+	renders to their sha1
+	'''
+	entries = {}
+	for name, digest in pages.items():
+		entries[name] = {'sha1': digest, 'size': os.path.getsize(os.path.join(directory, name))}
+	marker = {'format': FORMAT, 'hash': hash, 'renderer': renderer, 'selection': sorted(selection) if selection else None, 'pages': entries}
+	tmp_path = os.path.join(directory, MARKER + '.tmp')
+	_write_json(tmp_path, marker)
+	os.replace(tmp_path, os.path.join(directory, MARKER))
+	return marker
+
+def is_complete(directory, renderer, selection=None):
+	'''
+	Whether an output folder holds a complete conversion by renderer that
+	covers selection. Pages are checked by size, checksums are only verified
+	when pages come out of the store
+	'''
+	marker = read_marker(directory)
+	if not marker or marker['renderer'] != renderer or not _covers(marker, selection):
+		return False
+	try:
+		return all(os.path.getsize(os.path.join(directory, name)) == entry['size'] for name, entry in marker['pages'].items())
+	except OSError:
+		return False
+
+class reference_store(object):
+	'''
+	Filesystem store of reference renders, see above. With link, pages are
+	hard linked between the store and the output folders when they are on the
+	same file system, and copied otherwise
+	'''
+	def __init__(self, root, link=True, fsync=True):
+		self.__root = root
+		self.__link = link
+		# Flush pages and marker before publishing, so other machines never see an entry before its data
+		self.__fsync = fsync
+		self.__tmp = os.path.join(root, 'tmp')
+		os.makedirs(self.__tmp, exist_ok=True)
+		self.__sweep()
+
+	def root(self):
+		return self.__root
+
+	def __sweep(self):
+		now = time.time()
+		try:
+			with os.scandir(self.__tmp) as entries:
+				for entry in entries:
+					if now - entry.stat().st_mtime > STALE_AGE:
+						shutil.rmtree(entry.path, ignore_errors=True)
+		except Exception as e:
+			print(e)
+
+	def __folder(self, hash, renderer):
+		return os.path.join(self.__root, 'objects', hash[:2], hash, renderer)
+
+	def lookup(self, hash, renderer, selection=None):
+		'''
+		(folder, marker) of a published entry covering selection, or None
+		'''
+		folder = self.__folder(hash, renderer)
+		names = ['all']
+		if selection:
+			try:
+				names += sorted(name for name in os.listdir(folder) if name.startswith('p'))
+			except FileNotFoundError:
+				return None
+		for name in names:
+			marker = read_marker(os.path.join(folder, name))
+			if marker and _covers(marker, selection):
+				return os.path.join(folder, name), marker
+		return None
+
+	def fetch(self, hash, renderer, selection, output_dir):
+		'''
+		Copy the pages of a published entry into output_dir (emptied first by
+		the caller), verify their checksums and mark output_dir complete.
+		Returns the number of pages, or None if there is no usable entry
+		'''
+		found = self.lookup(hash, renderer, selection)
+		if not found:
+			return None
+		folder, marker = found
+		os.makedirs(output_dir, exist_ok=True)
+		pages = {}
+		try:
+			for name, entry in marker['pages'].items():
+				pages[name] = _copy(os.path.join(folder, name), os.path.join(output_dir, name), self.__link)
+				if pages[name] != entry['sha1']:
+					raise ValueError('Checksum mismatch: ' + os.path.join(folder, name))
+		except Exception as e:
+			print(e)
+			for name in pages.keys():
+				try:
+					os.unlink(os.path.join(output_dir, name))
+				except OSError:
+					pass
+			if isinstance(e, ValueError):
+				self.__evict(folder)
+			return None
+		mark(output_dir, hash, renderer, pages, marker['selection'])
+		return len(pages)
+
+	def publish(self, hash, renderer, selection, pages):
+		'''
+		Publish the renders of a successful conversion. pages maps page
+		numbers to their paths. Nothing happens if an entry for the same
+		selection was published in the meantime
+		'''
+		target = os.path.join(self.__folder(hash, renderer), _selection_name(selection))
+		if os.path.exists(target) or not pages:
+			return False
+		tmp = os.path.join(self.__tmp, uuid.uuid4().hex)
+		try:
+			os.makedirs(tmp)
+			entries = {}
+			for path in pages.values():
+				name = os.path.basename(path)
+				# Output folders are emptied before a conversion, never rewritten in place, so linking is safe
+				entries[name] = {'sha1': _copy(path, os.path.join(tmp, name), self.__link), 'size': os.path.getsize(path)}
+				if self.__fsync:
+					with open(os.path.join(tmp, name), 'rb+') as file:
+						os.fsync(file.fileno())
+			marker = {'format': FORMAT, 'hash': hash, 'renderer': renderer, 'selection': sorted(selection) if selection else None, 'pages': entries}
+			_write_json(os.path.join(tmp, MARKER), marker, self.__fsync)
+			os.makedirs(os.path.dirname(target), exist_ok=True)
+			# Atomic, and fails if somebody else published first
+			os.rename(tmp, target)
+			return True
+		except OSError as e:
+			if not os.path.exists(target):
+				print(e)
+			return False
+		finally:
+			if os.path.exists(tmp):
+				shutil.rmtree(tmp, ignore_errors=True)
+
+	def __evict(self, folder):
+		# Move a corrupt entry out of the way (atomically) before deleting it
+		tmp = os.path.join(self.__tmp, uuid.uuid4().hex)
+		try:
+			os.rename(folder, tmp)
+			shutil.rmtree(tmp, ignore_errors=True)
+		except OSError as e:
+			print(e)
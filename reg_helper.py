@@ -5,9 +5,171 @@ from multiprocessing.dummy import Pool as ThreadPool
 import os.path
 import argparse
 import subprocess
-import re
 import json
 import sys
+import signal
+import threading
+import time
+import asyncio
+import re
+import tempfile
+from hash_index import hash_index
+from page_index import page_index, scan_pages
+from reference_store import mark, is_complete
+
+try:
+	import resource
+except ImportError:
+	# Not available on Windows
+	resource = None
+
+class converter_output(object):
+	'''
+	Incremental reader for a converter's stdout. The {bson_begin}...{bson_end}
+	block is extracted with a small state machine and everything else goes to
+	a log file through a bounded write buffer, so memory stays constant no
+	matter how much the converter prints.
+
+	With a list of log paths, the output is a batch of documents converted in
+	order: one block per document, and what the converter prints before a
+	block goes to the log of that document.
+	'''
+	BSON_BEGIN = b'{bson_begin}'
+	BSON_END = b'{bson_end}'
+	# What a converter (C++ runtime, libc or an embedded Python) prints when an allocation fails
+	OUT_OF_MEMORY = re.compile(br'bad_alloc|out of memory|cannot allocate memory|MemoryError', re.I)
+	OUT_OF_MEMORY_TAIL = 24
+
+	def __init__(self, log_path=None, max_line=64 * 1024, max_bson=4 * 1024 * 1024, buffer_size=64 * 1024):
+		self.__max_line = max_line
+		self.__max_bson = max_bson
+		self.__buffer_size = buffer_size
+		self.__batch = isinstance(log_path, (list, tuple))
+		self.__log_paths = list(log_path) if self.__batch else [log_path]
+		self.__log = None
+		self.__open_log(0)
+
+		# outside -> inside (capturing) -> done, or back to outside in a batch
+		self.__state = 'outside'
+		self.__bson_chunks = []
+		self.__bson_size = 0
+		self.__overflow = False
+		self.__pending = b''
+		# Raw blocks, None for the ones over max_bson
+		self.__blocks = []
+		# Whether the output reported a failed allocation, see out_of_memory
+		self.__out_of_memory = False
+		self.__tail = b''
+
+	def __open_log(self, index):
+		self.close()
+		if index < len(self.__log_paths) and self.__log_paths[index]:
+			self.__log = open(self.__log_paths[index], 'wb', buffering=self.__buffer_size)
+
+	def __end_block(self):
+		self.__blocks.append(None if self.__overflow else b''.join(self.__bson_chunks))
+		self.__bson_chunks = []
+		self.__bson_size = 0
+		self.__overflow = False
+		if not self.__batch:
+			self.__state = 'done'
+			return
+		self.__state = 'outside'
+		# Output past the last document stays in its log
+		if len(self.__blocks) < len(self.__log_paths):
+			self.__open_log(len(self.__blocks))
+
+	def __log_write(self, data):
+		if self.__log and data:
+			self.__log.write(data)
+
+	def __emit(self, data):
+		if self.__state != 'inside':
+			self.__log_write(data)
+			return
+		self.__bson_size += len(data)
+		if self.__bson_size > self.__max_bson:
+			self.__overflow = True
+			self.__bson_chunks = []
+		elif not self.__overflow:
+			self.__bson_chunks.append(data)
+
+	def __partial_marker(self, data, marker):
+		# Length of the longest tail of data that could be the start of marker
+		for n in range(min(len(marker) - 1, len(data)), 0, -1):
+			if data.endswith(marker[:n]):
+				return n
+		return 0
+
+	def feed(self, data, final=False):
+		if not self.__out_of_memory and data:
+			# Kept short, a message may straddle two chunks
+			window = self.__tail + data
+			self.__out_of_memory = self.OUT_OF_MEMORY.search(window) is not None
+			self.__tail = window[-self.OUT_OF_MEMORY_TAIL:]
+		data = self.__pending + data
+		self.__pending = b''
+		while data:
+			if self.__state == 'done':
+				self.__log_write(data)
+				return
+			marker = self.BSON_BEGIN if self.__state == 'outside' else self.BSON_END
+			pos = data.find(marker)
+			if pos < 0:
+				# The marker may straddle two chunks, hold its possible start back
+				keep = 0 if final else self.__partial_marker(data, marker)
+				if keep:
+					self.__pending = data[-keep:]
+					data = data[:-keep]
+				self.__emit(data)
+				return
+			self.__emit(data[:pos])
+			if self.__state == 'outside':
+				self.__state = 'inside'
+			else:
+				self.__end_block()
+			data = data[pos + len(marker):]
+
+	def consume(self, stream):
+		try:
+			for line in iter(lambda: stream.readline(self.__max_line), b''):
+				self.feed(line)
+			self.feed(b'', final=True)
+		finally:
+			self.close()
+
+	def close(self):
+		if self.__log:
+			self.__log.close()
+			self.__log = None
+
+	def bson(self):
+		'''
+		The parsed bson block, or None if the converter didn't print a complete one
+		'''
+		if not self.__blocks or self.__blocks[0] is None:
+			return None
+		return json.loads(self.__blocks[0].strip().decode('utf-8'))
+
+	def out_of_memory(self):
+		'''
+		Whether the converter printed that an allocation failed
+		'''
+		return self.__out_of_memory
+
+	def blocks(self):
+		'''
+		The parsed blocks of a batch, in order, None for the ones that can't be read
+		'''
+		ret = []
+		for block in self.__blocks:
+			try:
+				ret.append(json.loads(block.strip().decode('utf-8')) if block is not None else None)
+			except ValueError as e:
+				print(e)
+				ret.append(None)
+		return ret
+
 
 class regression_core_task(object):
 	def __init__(self,
@@ -20,9 +182,26 @@ class regression_core_task(object):
 				 concur=4,
 				 ref_bin_dir=None,
 				 tar_bin_dir=None,
-				 ref_version_name=None):
+				 ref_version_name=None,
+				 hash_cache=None,
+				 manifest=None,
+				 bin_fingerprint=None,
+				 timeout=None,
+				 cpu_limit=None,
+				 mem_limit=None,
+				 stats=None,
+				 backend=None,
+				 page_policy=None,
+				 page_cache=None,
+				 sanity=None,
+				 renderer=None,
+				 ref_store=None,
+				 batch_size=1,
+				 batch_timeout=None):
 
 		self.__error_handler = error_handler
+		# Shared with the Regression so each document is hashed once per run
+		self.__hash_cache = hash_cache if hash_cache else hash_index()
 		self.__bin_path = None
 
 		assert (ref_bin_dir or tar_bin_dir)
@@ -64,16 +243,62 @@ class regression_core_task(object):
 			assert os.path.exists(self.__bin_path)
 
 		self.__concurency = concur
+		# Bounds RunOneAsync, created inside the event loop on first use
+		self.__semaphore = None
+		self.__semaphore_loop = None
+
+		# Incremental mode: run_manifest of the previous runs under out_dir and
+		# the fingerprint of the binary used by this task
+		self.__manifest = manifest if self.__centrailize_mode else None
+		self.__bin_fingerprint = bin_fingerprint
+		self.__version = self.__ref_version_name if self.__ref_or_tar == 'ref' else None
 
+		# Per conversion limits: wall-clock seconds, CPU seconds and address space bytes
+		self.__timeout = timeout
+		# Applied to the converter right after it started (resource.prlimit is Linux only)
+		self.__cpu_limit = cpu_limit if hasattr(resource, 'prlimit') else None
+		self.__mem_limit = mem_limit if hasattr(resource, 'prlimit') else None
+
+		# conversion_stats recording how long each document took
+		self.__stats = stats
+
+		# Optional in-process renderer (pdfnet_backend) pinned to this task's build.
+		# Documents it doesn't support go through the converter binary.
+		self.__backend = backend
+
+		# page_policy deciding which pages get rendered, None renders every page
+		self.__page_policy = page_policy
+		# Whether the converter binary takes --pages, see __supports_page_range
+		self.__page_range_support = None
+		self.__probe_lock = threading.Lock()
+
+		# Centralized mode: page_index of out_dir, shared with the Regression and
+		# refreshed as soon as a conversion finishes
+		self.__page_index = None
+		if self.__centrailize_mode:
+			self.__page_index = page_cache if page_cache else page_index(self.__output_dir)
+
+		# Optional sanity_report told about the pages each document ends up with
+		self.__sanity = sanity
+
+		# Centralized mode: references are marked complete with the key of the renderer that
+		# made them (see reference_store.renderer_key), fetched from and published to the
+		# optional reference_store shared with other runs
+		self.__renderer = renderer if renderer else self.__version
+		self.__ref_store = ref_store if self.__centrailize_mode and self.__ref_or_tar == 'ref' else None
+
+		# Number of documents converted by each converter process in Run, see __convert_batch.
+		# A batch gets timeout seconds per document, up to batch_timeout (4 timeouts by default):
+		# the documents a batch that timed out didn't get to are converted again in smaller batches
+		self.__batch_size = max(1, batch_size)
+		self.__batch_timeout = batch_timeout if batch_timeout else (4 * timeout if timeout else None)
 
 	def __hash(self, fpath):
-		import hashlib
-		try:
-			with open(fpath, 'rb') as file:
-				sha1 = hashlib.sha1(file.read())
-				return sha1.hexdigest() + '_' + os.path.basename(fpath)
-		except Exception as e:
-			print(e)
+		return self.__hash_cache.document_hash(fpath)
+
+	def __report(self, filepath, hash, pages):
+		if self.__sanity:
+			self.__sanity.record(filepath, hash, self.__ref_or_tar, pages)
 
 	def __delete_all(self, folder):
 		import os, shutil
@@ -93,10 +318,15 @@ class regression_core_task(object):
 		except Exception as e:
 			pass
 
-	def __run_impl(self, filepath):
+	def __prepare(self, filepath):
+		'''
+		Everything that happens before the converter starts. Returns the conversion
+		job, or None if the document doesn't need to be converted
+		'''
 		hash = self.__hash(filepath)
 		if not hash:
-			return
+			self.__report(filepath, None, 0)
+			return None
 		assert self.__bin_path
 		fullbinpath = self.__bin_path
 
@@ -112,57 +342,476 @@ class regression_core_task(object):
 			output_dir = os.path.join(self.__output_dir, basename, tail)
 			output_dir = os.path.normpath(output_dir)
 
+		selection = self.__page_policy.select(hash, filepath) if self.__page_policy else None
+
 		if self.__centrailize_mode:
-			# Only delete target runs
-			if os.path.exists(output_dir) and self.__ref_or_tar != 'ref':
+			if self.__manifest and self.__ref_or_tar == 'tar' and os.path.exists(output_dir) and \
+					self.__manifest.conversion_current(hash, self.__ref_or_tar, self.__bin_fingerprint, output_dir, selection=selection):
+				sys.stdout.write('Unchanged, skipped: ' + filepath + '\n')
+				sys.stdout.flush()
+				self.__report(filepath, hash, len(self.__page_index.pages(hash, self.__ref_or_tar)))
+				return None
+
+			# References are generated once: kept if a previous conversion completed them with the
+			# pages the policy asks for, otherwise fetched from the reference store or converted.
+			# A folder left behind by a failed or interrupted conversion has no COMPLETE marker
+			if self.__ref_or_tar == 'ref' and is_complete(output_dir, self.__renderer, selection):
+				self.__report(filepath, hash, len(self.__page_index.pages(hash, self.__ref_or_tar, self.__version)))
+				return None
+
+			if os.path.exists(output_dir):
 				self.__delete_all(output_dir)
-			elif os.path.exists(output_dir) and self.__ref_or_tar == 'ref':
-				return
 			else:
 				self.__make_dirs(output_dir)
 
+			if self.__ref_store and self.__fetch(hash, filepath, output_dir, selection):
+				return None
+
 		fullbinpath = os.path.abspath(fullbinpath)
 		filepath = os.path.abspath(filepath)
 		output_dir = os.path.abspath(output_dir)
 		program_name = os.path.splitext(os.path.split(fullbinpath)[1])[0]
 		sys.stdout.write('Converting: ' + filepath)
 		sys.stdout.flush()
+		job = {'hash': hash, 'filepath': filepath, 'output_dir': output_dir, 'selection': selection, 'program_name': program_name, 'commands': None}
+		if self.__backend and self.__backend.supports(filepath):
+			# Rendered in-process, no command line
+			return job
+
+		page_range = None
 		if program_name == 'docpub':
 			if os.path.splitext(filepath)[1].lower() in ['.docx', '.pptx']:
-				commands = [fullbinpath, '-f', 'pdf', '--builtin_docx=true', '--toimages=true', filepath, '-o', output_dir]
+				options = ['-f', 'pdf', '--builtin_docx=true', '--toimages=true']
 			else:
-				commands = [fullbinpath, '-f', 'pdf', '--toimages=true', filepath, '-o', output_dir]
+				options = ['-f', 'pdf', '--toimages=true']
 		elif program_name == 'office2pdf':
 			if os.path.splitext(filepath)[1].lower() in ['.docx', '.pptx', '.doc']:
-				commands = [fullbinpath, '--qa', filepath, '-o', output_dir]
+				options = ['--qa']
 		else:
-			commands = [fullbinpath, filepath, '-o', output_dir]
-		process = subprocess.Popen(commands, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-		if process.returncode:
-			self.__error_handler.write(filepath, object=self.__ref_or_tar, iscrash=True)
-			print(self.__ref_or_tar + ': An error occurred when converting: ' + filepath)
+			# pdf2image only rasterizes the requested pages
+			page_range = self.__page_policy.page_range(hash) if selection and self.__supports_page_range(fullbinpath) else None
+			options = []
+		job['commands'] = [fullbinpath] + options + (['--pages', page_range] if page_range else []) + [filepath, '-o', output_dir]
+		# Batch mode: documents with the same options share a converter process, see __run_batch
+		job['options'] = options
+		job['page_range'] = page_range
+		# Converters that can't be given the selection render every page, the others are dropped afterwards
+		job['prune'] = bool(selection) and not page_range
+		return job
 
-		stdout = process.communicate()[0]
+	def __run_impl(self, filepath):
+		job = self.__prepare(filepath)
+		if job:
+			self.__convert(job)
+
+	def __convert(self, job):
+		if not job['commands']:
+			self.__run_in_process(job['hash'], job['filepath'], job['output_dir'], job['selection'])
+			return
+		returncode, timed_out, output, duration, ok = self.__execute(job['commands'], self.__log_path(job['hash'], job['filepath'], job['output_dir']), self.__timeout)
+		self.__finish(job, returncode, timed_out, output.bson() if output else None, duration, ok, output.out_of_memory() if output else False)
+
+	def __execute(self, commands, log_path, timeout):
+		'''
+		Run a converter and read its output. Returns (returncode, timed out,
+		converter_output, duration, ok)
+		'''
+		ok = True
+		start_time = time.time()
+		# stderr too: it goes to the log, and it's where runtimes report failed allocations
+		process = subprocess.Popen(commands, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, **self.__popen_kwargs())
+		self.__limit_resources(process)
+
+		# Wall-clock limit, enforced by killing the whole process group
+		timed_out = threading.Event()
+		timer = None
+		if timeout:
+			timer = threading.Timer(timeout, self.__kill, [process, timed_out])
+			timer.daemon = True
+			timer.start()
+
+		output = None
 		try:
-			if program_name == 'office2pdf':
-				pattern = b'{bson_begin}\s(.*)\s{bson_end}'
-				ret = re.search(pattern, stdout, re.DOTALL)
-				if not ret:
-					self.__error_handler.write(filepath, object=self.__ref_or_tar, iscrash=True)
+			output = converter_output(log_path)
+			output.consume(process.stdout)
+		except Exception as e:
+			ok = False
+			print(e)
+		process.wait()
+		if timer:
+			timer.cancel()
+		return process.returncode, timed_out.is_set(), output, time.time() - start_time, ok
+
+	def __run_batch(self, files):
+		'''
+		Batch mode: convert files with one converter process per group of
+		documents sharing the same options, instead of one per document
+		'''
+		groups = {}
+		for filepath in files:
+			job = self.__prepare(filepath)
+			if not job:
+				continue
+			if not job['commands']:
+				self.__convert(job)
+				continue
+			groups.setdefault(tuple(job['options']), []).append(job)
+		for jobs in groups.values():
+			self.__convert_batch(jobs)
+
+	def __convert_batch(self, jobs):
+		'''
+		The converter gets a list file, one "<document>\t<output dir>\t<page range>"
+		line per document, and prints a {bson_begin} block with the document's
+		"file" and status after each one. If it fails, the documents it
+		printed a block for are done, and the others are converted again in
+		two halves, until the document that made it fail is converted alone
+		and the failure can be attributed to it
+		'''
+		if len(jobs) == 1:
+			self.__convert(jobs[0])
+			return
+
+		sys.stdout.write('\nBatch of %d documents\n' % len(jobs))
+		sys.stdout.flush()
+		list_file = tempfile.NamedTemporaryFile('wb', suffix='.txt', delete=False)
+		try:
+			with list_file:
+				for job in jobs:
+					list_file.write(('%s\t%s\t%s\n' % (job['filepath'], job['output_dir'], job['page_range'] or '')).encode('utf-8'))
+			commands = [job['commands'][0]] + jobs[0]['options'] + ['--batch', list_file.name]
+			log_paths = [self.__log_path(job['hash'], job['filepath'], job['output_dir']) for job in jobs]
+			timeout = self.__timeout * len(jobs) if self.__timeout else None
+			if self.__batch_timeout:
+				timeout = min(timeout, self.__batch_timeout) if timeout else self.__batch_timeout
+			returncode, timed_out, output, duration, ok = self.__execute(commands, log_paths, timeout)
+		finally:
+			os.unlink(list_file.name)
+
+		# Blocks are matched by file, or by position if the converter doesn't say
+		statuses = {}
+		blocks = output.blocks() if output else []
+		for i, block in enumerate(blocks):
+			if block is None:
+				continue
+			filepath = block.get('file', jobs[i]['filepath'] if i < len(jobs) else None)
+			if filepath:
+				statuses[os.path.abspath(filepath)] = block
+
+		failure = self.__classify_exit(returncode, timed_out, output.out_of_memory() if output else False)
+		remaining = []
+		for job in jobs:
+			status = statuses.get(job['filepath'])
+			if status is not None:
+				self.__finish(job, 0, False, status, duration / len(jobs), ok)
+			elif not failure:
+				# Exited normally without a status, same as a single conversion without one
+				self.__finish(job, returncode, False, None, duration / len(jobs), ok)
+			else:
+				remaining.append(job)
+		if not remaining:
+			return
+
+		print(self.__ref_or_tar + ': A batch failed (%s), converting %d documents again' % (failure, len(remaining)))
+		if self.__centrailize_mode:
+			# In simple mode documents share output folders, their pages are just overwritten
+			for job in remaining:
+				self.__delete_all(job['output_dir'])
+		middle = (len(remaining) + 1) // 2
+		self.__convert_batch(remaining[:middle])
+		self.__convert_batch(remaining[middle:])
+
+	async def __run_async(self, filepath):
+		# Hashing, folder cleanup, page scans and stats block, so they run on the
+		# default executor and only the converter's process is awaited on the loop
+		loop = asyncio.get_event_loop()
+		job = await loop.run_in_executor(None, self.__prepare, filepath)
+		if not job:
+			return
+		if not job['commands']:
+			await loop.run_in_executor(None, self.__run_in_process, job['hash'], job['filepath'], job['output_dir'], job['selection'])
+			return
+
+		ok = True
+		timed_out = False
+		start_time = time.time()
+		process = await asyncio.create_subprocess_exec(*job['commands'], stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, **self.__popen_kwargs())
+		self.__limit_resources(process)
+		output = converter_output(self.__log_path(job['hash'], job['filepath'], job['output_dir']))
+		try:
+			await asyncio.wait_for(self.__stream(process, output), self.__timeout)
+		except asyncio.TimeoutError:
+			timed_out = True
+			self.__kill(process)
+		except asyncio.CancelledError:
+			# Ctrl-C or the run was cancelled: don't leave the converter behind
+			self.__kill(process)
+			await process.wait()
+			raise
+		except Exception as e:
+			ok = False
+			print(e)
+		finally:
+			output.close()
+		await process.wait()
+		await loop.run_in_executor(None, self.__finish, job, process.returncode, timed_out, output.bson(), time.time() - start_time, ok, output.out_of_memory())
+
+	async def __stream(self, process, output):
+		while True:
+			data = await process.stdout.read(64 * 1024)
+			if not data:
+				break
+			output.feed(data)
+		output.feed(b'', final=True)
+		await process.wait()
+
+	def __finish(self, job, returncode, timed_out, bsonobj, duration, ok, out_of_memory=False):
+		'''
+		Everything that happens after the converter exited: error classification,
+		stats and run manifest. bsonobj is the converter's status block, if any,
+		and out_of_memory whether its output reported a failed allocation
+		'''
+		hash = job['hash']
+		filepath = job['filepath']
+		selection = job['selection']
+		program_name = job['program_name']
+
+		pages = self.__scan(hash, filepath, job['output_dir'])
+		if job['prune']:
+			# Every page was rendered, drop the ones outside the selection right away
+			self.__prune_pages(pages, selection)
+
+		if self.__stats:
+			self.__record_stats(hash, filepath, pages, duration, selection)
+
+		failure = self.__classify_exit(returncode, timed_out, out_of_memory)
+		if failure:
+			ok = False
+			self.__error_handler.write(filepath, message='exit code %s' % returncode, object=self.__ref_or_tar,
+									   iscrash=failure == 'crash', istimeout=failure == 'timeout', isoom=failure == 'oom',
+									   hash=hash, duration=duration)
+			print(self.__ref_or_tar + ': An error occurred when converting: ' + filepath + ' (' + failure + ')')
+
+		try:
+			if program_name == 'office2pdf' and not failure:
+				if not bsonobj:
+					ok = False
+					self.__error_handler.write(filepath, object=self.__ref_or_tar, iscrash=True, hash=hash, duration=duration)
 				else:
-					json_content = ret.group(1)
-					bsonobj = json.loads(json_content.decode('utf-8'))
 					if bsonobj['status'] == 'exception':
-						self.__error_handler.write(filepath, bsonobj['exception_info']['failure_reason'], object=self.__ref_or_tar, isexception=True)
-
-			sys.stdout.buffer.write(stdout)
-			sys.stdout.flush()
+						ok = False
+						self.__error_handler.write(filepath, bsonobj['exception_info']['failure_reason'], object=self.__ref_or_tar, isexception=True, hash=hash, duration=duration)
 		except Exception as e:
+			ok = False
 			print(e)
+
+		self.__report(filepath, hash, len(pages))
+		self.__record(hash, job['output_dir'], pages, ok, selection)
 		return
 
+	def __run_in_process(self, hash, filepath, output_dir, selection):
+		start_time = time.time()
+		failure, status = self.__backend.convert(filepath, output_dir, self.__timeout, selection)
+		duration = time.time() - start_time
+		ok = not failure
+
+		pages = self.__scan(hash, filepath, output_dir)
+		if self.__stats:
+			self.__record_stats(hash, filepath, pages, duration, selection)
+
+		if failure:
+			self.__error_handler.write(filepath, message='in-process ' + failure, object=self.__ref_or_tar,
+									   iscrash=failure == 'crash', istimeout=failure == 'timeout',
+									   hash=hash, duration=duration)
+			print(self.__ref_or_tar + ': An error occurred when converting: ' + filepath + ' (' + failure + ')')
+		elif status['status'] == 'exception':
+			ok = False
+			self.__error_handler.write(filepath, status['exception_info']['failure_reason'], object=self.__ref_or_tar, isexception=True, hash=hash, duration=duration)
+
+		self.__report(filepath, hash, len(pages))
+		self.__record(hash, output_dir, pages, ok, selection)
+
+	def __limit_resources(self, process):
+		# Set from the parent with prlimit: preexec_fn isn't safe with the converter threads running.
+		# The converter may run for a moment before its limits are set, which only matters for
+		# the memory it allocates in that moment
+		try:
+			if self.__cpu_limit:
+				# SIGXCPU at the soft limit, SIGKILL shortly after
+				resource.prlimit(process.pid, resource.RLIMIT_CPU, (self.__cpu_limit, self.__cpu_limit + 5))
+			if self.__mem_limit:
+				resource.prlimit(process.pid, resource.RLIMIT_AS, (self.__mem_limit, self.__mem_limit))
+		except (ProcessLookupError, PermissionError):
+			# Already gone
+			pass
+
+	def __popen_kwargs(self):
+		if os.name != 'posix':
+			# No rlimits on Windows, but a separate process group can still be killed as a whole
+			return {'creationflags': subprocess.CREATE_NEW_PROCESS_GROUP}
+		return {'start_new_session': True}
+
+	def __kill(self, process, timed_out=None):
+		if timed_out:
+			timed_out.set()
+		try:
+			if os.name == 'posix':
+				os.killpg(process.pid, signal.SIGKILL)
+			else:
+				process.kill()
+		except Exception as e:
+			print(e)
+
+	def __classify_exit(self, returncode, timed_out, out_of_memory=False):
+		'''
+		Returns None on success, otherwise 'timeout', 'oom' or 'crash'. Finding
+		crashes is the point of the regression, so a failure is only put down to
+		the limits when there is evidence for it: the timer killed the converter,
+		the CPU limit signalled it (SIGXCPU), or its output reported a failed
+		allocation. Anything else, segfaults and aborts under a memory limit or
+		SIGKILLs nobody here sent included, is a crash
+		'''
+		if not returncode:
+			# Also when the timer fired after the converter exited, but before it was reaped
+			return None
+		if timed_out and (os.name != 'posix' or returncode == -signal.SIGKILL):
+			return 'timeout'
+		if out_of_memory:
+			return 'oom'
+		if os.name == 'posix' and returncode == -signal.SIGXCPU:
+			return 'timeout'
+		return 'crash'
+
+	def __record_stats(self, hash, filepath, pages, duration, selection=None):
+		try:
+			self.__stats.record(hash, self.__ref_or_tar, duration, len(pages), os.path.getsize(filepath), partial=selection is not None)
+		except Exception as e:
+			print(e)
+
+	def __scan(self, hash, filepath, output_dir):
+		'''
+		Pages rendered for filepath (page num -> path, size, mtime), scanned once per conversion
+		'''
+		if self.__page_index:
+			return self.__page_index.refresh(hash, self.__ref_or_tar, self.__version)
+		return scan_pages(output_dir, os.path.splitext(os.path.basename(filepath))[0])
+
+	def __supports_page_range(self, fullbinpath):
+		# Older pdf2image builds don't know --pages and would fail on it, asked once per task
+		with self.__probe_lock:
+			if self.__page_range_support is None:
+				try:
+					usage = subprocess.run([fullbinpath, '--help'], stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+										   stderr=subprocess.STDOUT, timeout=30).stdout
+					self.__page_range_support = b'--pages' in usage
+				except Exception as e:
+					print(e)
+					self.__page_range_support = False
+				if not self.__page_range_support:
+					print(self.__ref_or_tar + ': ' + fullbinpath + ' has no --pages option, pages outside the selection are rendered and dropped')
+			return self.__page_range_support
+
+	def __prune_pages(self, pages, selection):
+		# Updates pages in place, so the page_index entry stays in sync
+		for page_num in list(pages.keys()):
+			if page_num not in selection:
+				try:
+					os.unlink(pages[page_num]['path'])
+					del pages[page_num]
+				except Exception as e:
+					print(e)
+
+	def __fetch(self, hash, filepath, output_dir, selection):
+		'''
+		Fill output_dir with the pages another run published to the reference store
+		'''
+		count = self.__ref_store.fetch(hash, self.__renderer, selection, output_dir)
+		if count is None:
+			return False
+		sys.stdout.write('Fetched from the reference store: ' + filepath + '\n')
+		sys.stdout.flush()
+		pages = self.__page_index.refresh(hash, self.__ref_or_tar, self.__version)
+		self.__report(filepath, hash, len(pages))
+		if self.__manifest:
+			self.__manifest.record_conversion(hash, self.__ref_or_tar, self.__bin_fingerprint, self.__digests(pages), True, self.__version, selection)
+		return True
+
+	def __log_path(self, hash, filepath, output_dir):
+		# Converter output for each document is kept next to its renders
+		if self.__centrailize_mode:
+			name = self.__ref_or_tar + ('_' + self.__version if self.__version else '') + '.log'
+			return os.path.join(self.__output_dir, hash, name)
+		return os.path.join(output_dir, os.path.basename(filepath) + '.log')
+
+	def __digests(self, pages):
+		return dict((os.path.basename(entry['path']), self.__hash_cache.digest(entry['path'])) for entry in pages.values())
+
+	def __record(self, hash, output_dir, pages, ok, selection=None):
+		'''
+		A conversion finished: record it in the run manifest and, for a successful
+		reference conversion, mark output_dir complete and publish it
+		'''
+		reference = self.__centrailize_mode and self.__ref_or_tar == 'ref'
+		if not self.__manifest and not (reference and ok):
+			return
+		digests = {}
+		try:
+			digests = self.__digests(pages)
+		except Exception as e:
+			ok = False
+			print(e)
+		ok = ok and len(digests) > 0
+		if reference and ok:
+			try:
+				mark(output_dir, hash, self.__renderer, digests, selection)
+				if self.__ref_store:
+					self.__ref_store.publish(hash, self.__renderer, selection, dict((page_num, entry['path']) for page_num, entry in pages.items()))
+			except Exception as e:
+				print(e)
+		if self.__manifest:
+			self.__manifest.record_conversion(hash, self.__ref_or_tar, self.__bin_fingerprint, digests, ok, self.__version, selection)
+
+	def RunOne(self, filepath):
+		# Convert a single document, used by the pipelined scheduler
+		self.__run_impl(filepath)
+
+	async def RunOneAsync(self, filepath, semaphore=None):
+		'''
+		Convert a single document as an asyncio subprocess. At most concur conversions of
+		this task's binary run at once, and semaphore optionally bounds the whole stage
+		'''
+		loop = asyncio.get_event_loop()
+		if not self.__semaphore or self.__semaphore_loop is not loop:
+			self.__semaphore = asyncio.Semaphore(self.__concurency)
+			self.__semaphore_loop = loop
+		async with self.__semaphore:
+			if semaphore:
+				async with semaphore:
+					await self.__run_async(filepath)
+			else:
+				await self.__run_async(filepath)
+
+	async def RunAsync(self):
+		await asyncio.gather(*[self.RunOneAsync(filepath) for filepath in self.__files])
+
+	def __batches(self):
+		batch = []
+		for filepath in self.__files:
+			batch.append(filepath)
+			if len(batch) == self.__batch_size:
+				yield batch
+				batch = []
+		if batch:
+			yield batch
+
 	def Run(self):
+		# Files come in scheduling order (longest first), so hand them out one at a time
 		pool = ThreadPool(self.__concurency)
-		ret = pool.map(self.__run_impl, self.__files)
+		if self.__batch_size > 1:
+			work = pool.imap_unordered(self.__run_batch, self.__batches(), chunksize=1)
+		else:
+			work = pool.imap_unordered(self.__run_impl, self.__files, chunksize=1)
+		for ret in work:
+			pass
 		pool.close()
 		pool.join()
@@ -1,16 +1,36 @@
 __author__ = 'Renchen'
 
 import documents
+import image_diff
+import diff_artifact
 import pymongo
 from multiprocessing.dummy import Pool as ThreadPool
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
 
 import os.path
 import sys
 import subprocess
 import json
 import re
+import time
+import socket
+import threading
+import asyncio
 from reg_helper import regression_core_task
 from errorhandler import errorhandler
+from hash_index import hash_index
+from run_manifest import run_manifest
+from pipeline import pipeline
+from conversion_stats import conversion_stats
+from pdfnet_backend import pdfnet_backend
+from page_policy import page_policy
+from page_index import page_index, scan_tree
+from corpus_manifest import corpus_manifest
+from sanity_report import sanity_report
+from reference_store import reference_store, renderer_key
+from results_store import results_store
+from lease_store import mongo_lease_store
 
 
 class Regression(object):
@@ -27,9 +47,47 @@ class Regression(object):
 				 do_docx=False,
 				 do_doc=False,
 				 do_pptx=False,
-				 do_diff=False):
-
-		self.__error_handler = errorhandler('error.txt')
+				 do_diff=False,
+				 db_chunk_size=1000,
+				 incremental=False,
+				 timeout=None,
+				 cpu_limit=None,
+				 mem_limit=None,
+				 pipelined=True,
+				 diff_concur=None,
+				 queue_size=None,
+				 backend='subprocess',
+				 ref_lib='reference_lib',
+				 tar_lib='target_lib',
+				 dpi=None,
+				 page_selection='first',
+				 max_pages=10,
+				 worker_id=None,
+				 scheduler='threads',
+				 convert_concur=None,
+				 diff_tolerance=0,
+				 diff_format='compact',
+				 tags=None,
+				 changed_since=None,
+				 refresh_corpus=True,
+				 ref_store=None,
+				 batch_size=1,
+				 batch_converter=False,
+				 batch_timeout=None):
+
+		if out_dir and not os.path.exists(out_dir):
+			os.makedirs(out_dir)
+
+		# Sharded mode: name of this worker. Workers sharing an out_dir keep their
+		# own error log and results store
+		self.__worker_id = worker_id
+		suffix = '.' + worker_id if worker_id else ''
+		self.__file_suffix = suffix
+
+		# Errors are scoped to the run: kept under out_dir in centralized mode
+		self.__error_handler = errorhandler(os.path.join(out_dir if out_dir else '', 'errors' + suffix + '.jsonl'))
+		# Filled in by the conversion tasks, see __sanity_check
+		self.__sanity = sanity_report(self.__error_handler, concur)
 		self.__exts = []
 		if do_pdf:
 			self.__exts.append('.pdf')
@@ -44,6 +102,15 @@ class Regression(object):
 			self.__exts.append('.pptx')
 
 		self.__do_diff = do_diff
+		# Per-channel delta under which a pixel isn't counted by the tolerance_percentage metric
+		self.__diff_tolerance = diff_tolerance
+		# Centralized mode: 'compact' keeps the diffs of a document in one diff_artifact
+		# file, 'png' writes a full-page difference PNG per page (always the case in simple mode)
+		assert diff_format in ['compact', 'png']
+		self.__diff_format = diff_format
+		# Diff folder -> artifact being collected for the document ({'path', 'page_nums', 'keep', 'pages'})
+		self.__diff_artifacts = {}
+		self.__diff_artifacts_lock = threading.Lock()
 		self.__ref_out = ref_outdir
 		self.__tar_out = tar_outdir
 		self.__diff_out = diff_outdir
@@ -61,6 +128,15 @@ class Regression(object):
 
 		self.__src_testdir = src_testdir
 
+		# Persistent (path, size, mtime, inode) -> sha1 index shared by every subsystem
+		self.__hash_cache = hash_index(os.path.join(self.__out_dir if self.__out_dir else '.', 'hash_index.json'))
+
+		# Image diff results, recorded as each diff completes and looked up by page path
+		results_dir = self.__out_dir if self.__out_dir else self.__diff_out
+		if results_dir and not os.path.exists(results_dir):
+			os.makedirs(results_dir)
+		self.__results = results_store(os.path.join(results_dir if results_dir else '.', 'results' + suffix + '.sqlite'), self.__error_handler.run())
+
 		if self.__ref_out and not os.path.exists(self.__ref_out):
 			os.makedirs(self.__ref_out)
 
@@ -77,6 +153,8 @@ class Regression(object):
 		assert os.path.exists(self.__src_testdir)
 
 		self.__concurency = concur
+		# Number of documents (and of requests per bulk_write) sent to the database at once
+		self.__db_chunk_size = db_chunk_size
 		self.__ref_bin_dir = ref_bin_dir if ref_bin_dir else ''
 		self.__tar_bin_dir = tar_bin_dir if tar_bin_dir else ''
 
@@ -85,18 +163,6 @@ class Regression(object):
 		self.__pages = []
 		self.__differences = []
 
-		# map from ref path to diff metrics
-		self.__diff_metrics_ref_map = {}
-
-		# map from tar path to diff metrics
-		self.__diff_metrics_tar_map = {}
-
-		# map between ref out path to diff path
-		self.__ref_out_diff_paths_map = {}
-
-		# map between tar out path to diff path
-		self.__tar_out_diff_paths_map = {}
-
 		# map between src file path to hash code
 		self.__src_path_hashmap = {}
 
@@ -107,14 +173,88 @@ class Regression(object):
 
 		self.__ref_version, self.__tar_version = self.get_versions()
 
-		# Set maximum number of pages to run image diff
-		self.__num_pages_to_diff = 10
-
-
-	# Retun the relationship between ref out files and diff files
-	# store their paths
-	def ref_out_diff_map(self):
-		return self.__ref_out_diff_paths_map
+		# Per conversion limits: wall-clock seconds, CPU seconds and address space bytes
+		self.__conversion_limits = {'timeout': timeout, 'cpu_limit': cpu_limit, 'mem_limit': mem_limit}
+
+		# Conversion history, used to convert the most expensive documents first
+		self.__conversion_stats = conversion_stats(os.path.join(self.__out_dir if self.__out_dir else '.', 'conversion_stats.json'))
+
+		# Listing of the source tree (sizes, hashes, tags, page counts), refreshed folder by folder
+		# from folder mtimes. Runs can be restricted to documents with one of tags, or changed since
+		# changed_since, without touching the rest of the tree. Without refresh_corpus the
+		# manifest is trusted as it is
+		self.__corpus = corpus_manifest(os.path.join(self.__out_dir if self.__out_dir else '.', 'corpus_manifest.json'),
+										src_testdir, self.__hash_cache, page_count=self.__conversion_stats.pages, refresh=refresh_corpus)
+		self.__tags = tags
+		self.__changed_since = changed_since
+		self.__refresh_corpus = refresh_corpus
+
+		# Pipelined scheduling (centralized mode): number of documents diffed at once and
+		# the bound of the queues between the convert, diff and persist stages
+		self.__pipelined = pipelined
+		self.__diff_concur = diff_concur if diff_concur else concur
+		self.__queue_size = queue_size
+
+		# 'threads' or 'asyncio' (centralized mode, see run_async). With asyncio, concur
+		# bounds the conversions of each binary and convert_concur the whole stage
+		assert scheduler in ['threads', 'asyncio']
+		self.__scheduler = scheduler
+		self.__convert_concur = convert_concur if convert_concur else 2 * concur
+
+		# Number of documents handed to each converter process, for converter binaries that
+		# take a --batch list (batch_converter). Batches are converted by the staged scheduler
+		# (run_alln_files) only, the other schedulers convert one document at a time.
+		# batch_timeout bounds a whole batch, 4 timeouts by default
+		assert batch_size == 1 or batch_converter, 'batch_size needs a converter that takes --batch (batch_converter=True)'
+		assert batch_size == 1 or not (out_dir and (pipelined or scheduler == 'asyncio')), 'batch_size needs the staged scheduler (pipelined=False)'
+		self.__batch_size = batch_size
+		self.__batch_timeout = batch_timeout
+
+		# 'pdfnet' renders PDFs in-process with the bundled PDFNetPython builds (one pool of
+		# workers per build), 'subprocess' always runs the converter binaries
+		self.__backends = {}
+		if backend == 'pdfnet':
+			self.__backends['ref'] = pdfnet_backend(ref_lib, concur, dpi)
+			self.__backends['tar'] = pdfnet_backend(tar_lib, concur, dpi)
+		# Part of the reference renderer key, with the version and the binary
+		self.__ref_settings = {'backend': backend, 'lib': ref_lib, 'dpi': dpi} if backend == 'pdfnet' else None
+
+		# Centralized mode: folder (local, or a shared mount) of the reference_store through which
+		# runs on this and other machines share their reference renders
+		self.__ref_store = reference_store(ref_store) if ref_store and self.__out_dir else None
+
+		# Process pool running image_diff.ImageDiff, created on first use
+		self.__diff_pool = None
+		self.__diff_pool_lock = threading.Lock()
+
+		# Pipelined mode: conversion tasks and database writer, created on first use
+		self.__pipeline_tasks = []
+		self.__pipeline_writer = None
+		self.__pipeline_serialized = []
+		self.__pipeline_persisted = 0
+
+		# Incremental mode (centralized only): only convert and diff documents whose
+		# source or binary changed since the last run, or that failed last time
+		self.__manifest = None
+		self.__manifest_diff_keys = {}
+		if incremental and self.__out_dir:
+			self.__manifest = run_manifest(os.path.join(self.__out_dir, 'run_manifest.json'))
+
+		# Centralized mode: renders of every document by (hash, role, version), scanned
+		# once per directory and refreshed by the conversion tasks
+		self.__page_index = page_index(self.__out_dir) if self.__out_dir else None
+
+		# Centralized mode: pages rendered, diffed and stored, 'all', 'first', 'sampled' or 'changed'
+		# (needs incremental). Pages outside the selection are never rasterized. Simple mode renders
+		# every page, like it always did
+		self.__page_policy = page_policy(page_selection if self.__out_dir else 'all', max_pages,
+										 page_count=self.__conversion_stats.pages,
+										 changed_pages=self.__manifest.changed_pages if self.__manifest else None)
+
+
+	# Image diff results of this and previous runs, by ref or tar page path
+	def results(self):
+		return self.__results
 
 	def out_dir(self):
 		return self.__out_dir
@@ -137,41 +277,131 @@ class Regression(object):
 	def src_file_paths(self):
 		return self.__src_file_paths
 
-	def diff_metrics_ref_map(self):
-		return self.__diff_metrics_ref_map
-
-	def diff_metrics_tar_map(self):
-		return self.__diff_metrics_tar_map
+	def get_page_policy(self):
+		return self.__page_policy
+
+	def get_page_index(self):
+		return self.__page_index
+
+	def diff_result(self, tar_path):
+		'''
+		(DifferenceMetric, diff image path) of a tar page, or None if it wasn't
+		diffed. The path is empty for identical pages, and is a diff_artifact
+		page path in compact mode
+		'''
+		result = self.__results.by_tar(tar_path)
+		if result is None:
+			return None
+		diff_metrics = documents.DifferenceMetric()
+		for key in documents.DifferenceMetric.METRICS:
+			if key in result:
+				diff_metrics.set(key, result[key])
+		return diff_metrics, result.get('diff_image_path')
+
+	def __diff_executor(self):
+		# Long-lived diff workers, so each page pair doesn't pay for an interpreter start and a PIL import.
+		# Workers must not be forked from this process: converter threads may be inside Popen at that
+		# moment, and a forked worker would inherit (and keep open) Popen's exec status pipe.
+		# Called from every diff thread at once in pipelined mode, only one of them may create the pool
+		with self.__diff_pool_lock:
+			if not self.__diff_pool:
+				methods = multiprocessing.get_all_start_methods()
+				context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+				self.__diff_pool = ProcessPoolExecutor(max_workers=self.__diff_concur, mp_context=context)
+			return self.__diff_pool
+
+	def __shutdown_diff_executor(self):
+		with self.__diff_pool_lock:
+			pool = self.__diff_pool
+			self.__diff_pool = None
+		if pool:
+			pool.shutdown()
+
+	def __shutdown_backends(self):
+		for backend in self.__backends.values():
+			backend.shutdown()
 
 	def __run_image_diff_impl(self, tuple):
-		args = [sys.executable, 'image_diff.py', '--file1', tuple[0], '--file2', tuple[1], '--output', tuple[2]]
 		try:
 			sys.stdout.buffer.write(('Running diff for %s and %s\n' % (tuple[0], tuple[1])).encode('utf-8'))
 			sys.stdout.flush()
 		except:
 			pass
-		process = subprocess.Popen(args, stdout=subprocess.PIPE)
-		stdout = process.communicate()[0].decode('utf-8')
-		if stdout:
-			try:
-				retdict = json.loads(stdout)
-				diff_image_path = retdict['diff_image_path']
-				diff_percentage = retdict['diff_percentage']
-				diff_metrics = documents.DifferenceMetric()
-				diff_metrics.set('diff_percentage', diff_percentage)
-
-				self.__ref_out_diff_paths_map[tuple[0]] = diff_image_path
-				self.__tar_out_diff_paths_map[tuple[1]] = diff_image_path
-				self.__diff_metrics_ref_map[tuple[0]] = diff_metrics
-				self.__diff_metrics_tar_map[tuple[1]] = diff_metrics
-			except Exception as e:
-				str = 'image_diff: %s and %s image diff operation failed. Reason: %s' % (tuple[0], tuple[1], e)
-				self.__error_handler.writemessage(str.encode('utf-8'))
-				print(e)
+		compact = bool(self.__out_dir) and self.__diff_format == 'compact'
+		return self.__diff_executor().submit(image_diff.ImageDiff, tuple[0], tuple[1], tuple[2], self.__diff_tolerance, compact)
+
+	def __reuse_image_diff(self, hash, diff_name, tuple):
+		'''
+		Incremental mode: reuse the last result for this pair of page renders
+		if both are byte-identical to last time. Otherwise remember the key
+		the new result should be recorded under.
+		'''
+		key = (hash, diff_name, os.path.basename(tuple[0]), self.__hash_cache.digest(tuple[0]), self.__hash_cache.digest(tuple[1]))
+		result = self.__manifest.diff_result(*key)
+		# Identical pages have no diff image. Results computed with another tolerance
+		# (or before the metrics existed) are recomputed
+		if result and result.get('tolerance') == self.__diff_tolerance and \
+				(not result['diff_image_path'] or diff_artifact.exists(result['diff_image_path'])):
+			self.__store_image_diff(tuple, result)
+			return True
+		self.__manifest_diff_keys[tuple] = key
+		return False
+
+	def __delete_stale_diffs(self, diffpath, names):
+		for name in os.listdir(diffpath):
+			if name not in names:
+				try:
+					os.unlink(os.path.join(diffpath, name))
+				except Exception as e:
+					print(e)
+
+	def __record_image_diff(self, tuple, future):
+		try:
+			retdict = future.result()
+			if not retdict:
+				return
+			if 'artifact' in retdict:
+				# Kept until the whole document is diffed, see __write_diff_artifact
+				with self.__diff_artifacts_lock:
+					artifact = self.__diff_artifacts[tuple[2]]
+				page_num = artifact['page_nums'][tuple[0]]
+				artifact['pages'][page_num] = retdict.pop('artifact')
+				retdict['diff_image_path'] = diff_artifact.page_path(artifact['path'], page_num)
+			self.__store_image_diff(tuple, retdict)
+			if tuple in self.__manifest_diff_keys:
+				self.__manifest.record_diff(*(self.__manifest_diff_keys.pop(tuple) + (retdict,)))
+		except Exception as e:
+			str = 'image_diff: %s and %s image diff operation failed. Reason: %s' % (tuple[0], tuple[1], e)
+			self.__error_handler.writemessage(str.encode('utf-8'))
+			print(e)
+
+	def __store_image_diff(self, tuple, retdict):
+		self.__results.record(tuple[0], tuple[1], retdict)
+
+	def __diff_folder(self, hash):
+		return os.path.join(self.__out_dir, hash, 'diff', self.__ref_version + '-' + self.__tar_version)
+
+	def __write_diff_artifact(self, file):
+		'''
+		Compact mode: write the diff artifact of a document once all its pages are diffed
+		'''
+		try:
+			hash = self.__hash(file)
+			if not hash:
+				return
+			with self.__diff_artifacts_lock:
+				artifact = self.__diff_artifacts.pop(self.__diff_folder(hash), None)
+			if artifact:
+				diff_artifact.write(artifact['path'], artifact['pages'], artifact['keep'])
+		except Exception as e:
+			str = 'image_diff: failed to write the diff artifact of %s. Reason: %s' % (file, e)
+			self.__error_handler.writemessage(str.encode('utf-8'))
+			print(e)
 
 	def __populate_file_paths(self):
 		if not self.__src_file_paths:
-				self.__get_files_recursively(self.__src_testdir, self.__exts, self.__src_file_paths)
+			for root, files in self.__corpus.scan(self.__exts, self.__tags, self.__changed_since, self.__refresh_corpus):
+				self.__src_file_paths.extend(files)
 
 		if self.__out_dir:
 			# if this is a centralize mode, then we don't need to populate ref_out, tar_out, diff_out, because the outputs reside in each document's hash
@@ -202,157 +432,256 @@ class Regression(object):
 			print(e)
 
 	def __cache(self):
-		dict = {}
-		dict['out_dir'] = '' if self.__out_dir else self.__out_dir
-		dict['ref_out'] = '' if self.__ref_out else self.__ref_out
-		dict['tar_out'] = '' if self.__tar_out else self.__tar_out
-		dict['ref_bin'] = self.__ref_bin_dir
-		dict['tar_bin'] = self.__tar_bin_dir
-		dict['diff_metrics_ref_map'] = self.__diff_metrics_ref_map
-		dict['diff_metrics_tar_map'] = self.__diff_metrics_tar_map
-		dict['ref_out_diff_map'] = self.__ref_out_diff_paths_map
-		dict['tar_out_diff_map'] = self.__tar_out_diff_paths_map
-		with open('cache.json', 'wb') as file:
-			json_str = json.dumps(dict, ensure_ascii=False, cls=documents.JsonEncoder)
-			file.write(json_str.encode('utf-8'))
-
-	def __filter_files(self, dir, pattern):
-		result = {} # page num -> path
-		for file in os.listdir(dir):
-			ret = re.search(pattern, file)
-			if not ret:
-				continue
-			page_num = int(ret.group(1)) if ret.group(1) else 1
-			result[page_num] = os.path.join(dir, file)
-		return result
+		# Diff results are already in the store, only remember the binaries used
+		self.__results.set_setting('ref_bin', self.__ref_bin_dir)
+		self.__results.set_setting('tar_bin', self.__tar_bin_dir)
+		self.__results.flush()
+
+	def __document_diff_args(self, file):
+		'''
+		Prepare the diff folder of a document and return the (ref page, tar page, diff folder)
+		tuples that still have to be diffed
+		'''
+		args = []
+		try:
+			hash = self.__hash(file)
+			if not hash:
+				return args
+			ref_image_paths = []
+			tar_image_paths = []
+			ref_outs = self.__page_index.pages(hash, 'ref', self.__ref_version)
+			tar_outs = self.__page_index.pages(hash, 'tar')
+			# Results of pages that aren't diffed again must not outlive this run
+			self.__results.forget([entry['path'] for entry in tar_outs.values()])
+
+			ref_image_names = []
+			tar_image_names = []
+			page_nums = {}
+			for key in sorted(ref_outs.keys()):
+				if not self.__page_policy.includes(hash, key, file):
+					continue
+				ref_image_names.append(os.path.split(ref_outs[key]['path'])[1])
+				ref_image_paths.append(ref_outs[key]['path'])
+				page_nums[ref_outs[key]['path']] = key
+
+			for key in sorted(tar_outs.keys()):
+				if not self.__page_policy.includes(hash, key, file):
+					continue
+				tar_image_names.append(os.path.split(tar_outs[key]['path'])[1])
+				tar_image_paths.append(tar_outs[key]['path'])
+
+			folder_name = self.__ref_version + '-' + self.__tar_version
+			diffpath = self.__diff_folder(hash)
+			artifact = None
+			if self.__diff_format == 'compact':
+				artifact = {'path': os.path.join(diffpath, os.path.splitext(os.path.basename(file))[0] + diff_artifact.EXT),
+							'page_nums': page_nums, 'keep': set(), 'pages': {}}
+			if os.path.exists(diffpath):
+				if self.__manifest:
+					# Keep diffs that can be reused, drop the ones for pages that are gone
+					names = [name for name in ref_image_names if name in tar_image_names]
+					if artifact:
+						# Pages are dropped from the artifact when it is written
+						names.append(os.path.basename(artifact['path']))
+					self.__delete_stale_diffs(diffpath, names)
+				else:
+					self.__delete_all(diffpath)
+			else:
+				os.makedirs(diffpath)
+			# Scanned again once the diffs are written
+			self.__page_index.invalidate(hash, 'diff', folder_name)
+
+			for image_path in ref_image_paths:
+				if os.path.split(image_path)[1] in tar_image_names:
+					arg = (image_path, os.path.join(self.__out_dir, hash, 'tar', os.path.split(image_path)[1]), diffpath)
+					if self.__manifest and self.__reuse_image_diff(hash, folder_name, arg):
+						if artifact:
+							artifact['keep'].add(page_nums[image_path])
+						continue
+					args.append(arg)
+			if artifact:
+				with self.__diff_artifacts_lock:
+					self.__diff_artifacts[diffpath] = artifact
+		except Exception as e:
+			self.__error_handler.writemessage(str(e).encode('utf-8'))
+			print(e)
+		return args
 
 	def run_image_diff(self):
 		self.__populate_file_paths()
-		pool = ThreadPool(self.__concurency)
-		args = []
+		# (document, diff args) pairs, a single one without a document in simple mode
+		groups = []
 
 		if self.__out_dir:
 			for file in self.__src_file_paths:
-				pattern = re.escape(os.path.splitext(os.path.basename(file))[0]) + '(?:\.png|_(\d+).png)'
-				try:
-					hash = self.__hash(file)
-					if not hash:
-						continue
-					ref_image_paths = []
-					tar_image_paths = []
-					ref_outs = self.__filter_files(os.path.join(self.__out_dir, hash, 'ref', self.__ref_version), pattern)
-					tar_outs = self.__filter_files(os.path.join(self.__out_dir, hash, 'tar'), pattern)
-
-					ref_image_names = []
-					tar_image_names = []
-					for key in ref_outs.keys():
-						if key > self.__num_pages_to_diff:
-							continue
-						ref_image_names.append(os.path.split(ref_outs[key])[1])
-						ref_image_paths.append(ref_outs[key])
-						if len(ref_image_paths) == self.__num_pages_to_diff:
-							break
-
-					for key in tar_outs.keys():
-						if key > self.__num_pages_to_diff:
-							continue
-						tar_image_names.append(os.path.split(tar_outs[key])[1])
-						tar_image_paths.append(tar_outs[key])
-						if len(tar_image_paths) == self.__num_pages_to_diff:
-							break
-
-					folder_name = self.__ref_version + '-' + self.__tar_version
-					diffpath = os.path.join(self.__out_dir, hash, 'diff', folder_name)
-					if os.path.exists(diffpath):
-						self.__delete_all(diffpath)
-					else:
-						os.makedirs(diffpath)
-
-					for image_path in ref_image_paths:
-						if os.path.split(image_path)[1] in tar_image_names:
-							import time
-							args.append((image_path, os.path.join(self.__out_dir, hash, 'tar', os.path.split(image_path)[1]), diffpath))
-						else:
-							tl=False
-				except Exception as e:
-					self.__error_handler.writemessage(str(e).encode('utf-8'))
-					print(e)
+				groups.append((file, self.__document_diff_args(file)))
 		else:
+			args = []
 			for file in self.__ref_out_paths:
 				tar_file = os.path.join(self.__tar_out, os.path.relpath(file, self.__ref_out))
 				args.append((file, tar_file, self.__diff_out))
+			groups.append((None, args))
+
+		# The artifact of a document is written as soon as its last page is diffed, so
+		# only the documents still being diffed hold patches in memory
+		remaining = [len(args) for file, args in groups]
+		futures = {}
+		for index, (file, args) in enumerate(groups):
+			for arg in args:
+				futures[self.__run_image_diff_impl(arg)] = (index, arg)
+			if file and not args:
+				# Nothing left to diff, the artifact keeps the pages of the last run
+				self.__write_diff_artifact(file)
+		for future in as_completed(list(futures)):
+			index, arg = futures.pop(future)
+			self.__record_image_diff(arg, future)
+			remaining[index] -= 1
+			if not remaining[index] and groups[index][0]:
+				self.__write_diff_artifact(groups[index][0])
+		self.__shutdown_diff_executor()
+
+		self.__corpus.save()
+		if self.__manifest:
+			self.__manifest.save()
+		self.__cache()
 
-		pool.map(self.__run_image_diff_impl, args)
-		pool.close()
-		pool.join()
 
-		self.__cache()
+	def __prepare_out_dirs(self, root):
+		# Simple mode: mirror a source folder under ref_out and tar_out, emptied
+		relpath = os.path.relpath(root, self.__src_testdir)
+		for out in [self.__ref_out, self.__tar_out]:
+			if not out:
+				continue
+			path = os.path.join(out, os.path.basename(self.__src_testdir), relpath)
+			if not os.path.exists(path):
+				os.makedirs(path)
+			else:
+				self.__delete_all(path)
 
+	def __announce(self, files):
+		# Queue documents found by __discover
+		try:
+			sys.stdout.buffer.write(''.join(file + ' added to queue\n' for file in files).encode('utf-8'))
+			sys.stdout.flush()
+		except Exception as e:
+			str = 'get_all_files: failed. Reason %s' % e
+			self.__error_handler.writemessage(str.encode('utf-8'))
+		self.__src_file_paths.extend(files)
+
+	def __discover(self):
+		'''
+		Yield the source documents folder by folder while src_testdir is being
+		walked, so conversions start before the walk is over. Each batch is
+		ordered longest-first by conversion_stats, output folders are prepared
+		once per folder, and the documents are added to src_file_paths.
+
+		In centralized mode, the documents the corpus manifest already knows
+		come first, in one batch ordered longest-first across the whole corpus,
+		so the longest known documents start right away wherever they are. The
+		walk then only yields the new ones.
+		'''
+		if self.__src_file_paths:
+			yield self.__src_file_paths
+			return
+		known = set()
+		if self.__out_dir:
+			keys = self.__corpus.known(self.__exts, self.__tags, self.__changed_since)
+			if self.__refresh_corpus:
+				keys = [key for key in keys if os.path.isfile(key[0])]
+			files = self.__conversion_stats.rank(keys)
+			known = set(files)
+			if files:
+				self.__announce(files)
+				yield files
+		for root, files in self.__corpus.scan(self.__exts, self.__tags, self.__changed_since, self.__refresh_corpus):
+			try:
+				files = [file for file in files if file not in known]
+				if not files:
+					continue
+				if not self.__out_dir:
+					self.__prepare_out_dirs(root)
+				files = self.__conversion_stats.order(files, self.__hash)
+				self.__announce(files)
+			except Exception as e:
+				str = 'get_all_files: failed. Reason %s' % e
+				self.__error_handler.writemessage(str.encode('utf-8'))
+				print(e)
+				continue
+			yield files
 
-	def __get_all_files(self, dir, ext_list):
-		if not self.__src_file_paths:
-			for root, subFolders, files in os.walk(dir):
-				for file in files:
-					try:
-						if os.path.splitext(file)[1].lower() in ext_list:
-							if not self.__out_dir:
-								relpath = os.path.relpath(root, self.__src_testdir)
-								if self.__ref_out:
-									path = os.path.join(self.__ref_out, os.path.basename(self.__src_testdir), relpath)
-									if not os.path.exists(path):
-										os.makedirs(path)
-									else:
-										self.__delete_all(path)
-
-								if self.__tar_out:
-									path = os.path.join(self.__tar_out, os.path.basename(self.__src_testdir), relpath)
-									if not os.path.exists(path):
-										os.makedirs(path)
-									else:
-										self.__delete_all(path)
-							try:
-								sys.stdout.buffer.write((os.path.join(root, file) + ' added to queue\n').encode('utf-8'))
-								sys.stdout.flush()
-							except Exception as e:
-								str = 'get_all_files: failed. Reason %s' % e
-								self.__error_handler.writemessage(str.encode('utf-8'))
-								pass
-							self.__src_file_paths.append(os.path.join(root, file))
-					except Exception as e:
-						str = 'get_all_files: failed. Reason %s' % e
-						self.__error_handler.writemessage(str.encode('utf-8'))
-						print(e)
+	def __discover_files(self):
+		# __discover, one document at a time
+		for files in self.__discover():
+			for file in files:
+				yield file
+
+	def __get_all_files(self):
+		for files in self.__discover():
+			pass
 		return self.__src_file_paths
 
-	def __run_all_files_impl(self, files):
-		if not files:
-			return
+	def __core_task(self, files, is_ref):
+		if is_ref:
+			return regression_core_task(files,
+										self.__src_testdir,
+										error_handler=self.__error_handler,
+										ref_output_dir=self.__ref_out,
+										tar_output_dir=None,
+										out_dir=self.__out_dir,
+										concur=self.__concurency,
+										ref_bin_dir=self.__ref_bin_dir,
+										tar_bin_dir=None,
+										ref_version_name=self.__ref_version,
+										hash_cache=self.__corpus,
+										manifest=self.__manifest,
+										bin_fingerprint=self.__binary_fingerprint(self.__ref_bin_dir, self.__ref_version),
+										stats=self.__conversion_stats,
+										backend=self.__backends.get('ref'),
+										page_policy=self.__page_policy,
+										page_cache=self.__page_index,
+										sanity=self.__sanity,
+										renderer=self.__renderer(),
+										ref_store=self.__ref_store,
+										batch_size=self.__batch_size,
+										batch_timeout=self.__batch_timeout,
+										**self.__conversion_limits)
+		return regression_core_task(files,
+									self.__src_testdir,
+									error_handler=self.__error_handler,
+									ref_output_dir=None,
+									tar_output_dir=self.__tar_out,
+									out_dir=self.__out_dir,
+									concur=self.__concurency,
+									ref_bin_dir=None,
+									tar_bin_dir=self.__tar_bin_dir,
+									hash_cache=self.__corpus,
+									manifest=self.__manifest,
+									bin_fingerprint=self.__binary_fingerprint(self.__tar_bin_dir, self.__tar_version),
+									stats=self.__conversion_stats,
+									backend=self.__backends.get('tar'),
+									page_policy=self.__page_policy,
+									page_cache=self.__page_index,
+									sanity=self.__sanity,
+									batch_size=self.__batch_size,
+									batch_timeout=self.__batch_timeout,
+									**self.__conversion_limits)
 
-		if self.__ref_bin_dir:
-			core_task_ref = regression_core_task(files,
-											 self.__src_testdir,
-											 error_handler=self.__error_handler,
-											 ref_output_dir=self.__ref_out,
-											 tar_output_dir=None,
-											 out_dir=self.__out_dir,
-											 concur=self.__concurency,
-											 ref_bin_dir=self.__ref_bin_dir,
-											 tar_bin_dir=None,
-											 ref_version_name=self.__ref_version)
-			core_task_ref.Run()
+	def __run_all_files_impl(self, files):
+		for is_ref in [True, False]:
+			if not (self.__ref_bin_dir if is_ref else self.__tar_bin_dir):
+				continue
+			self.__core_task(files, is_ref).Run()
+			# The first task consumed the discovery, the next one gets the whole corpus
+			files = self.__conversion_stats.order(self.__src_file_paths, self.__hash)
 
-		if self.__tar_bin_dir:
-			core_task_tar = regression_core_task(files,
-											 self.__src_testdir,
-											 error_handler=self.__error_handler,
-											 ref_output_dir=None,
-											 tar_output_dir=self.__tar_out,
-											 out_dir=self.__out_dir,
-											 concur=self.__concurency,
-											 ref_bin_dir=None,
-											 tar_bin_dir=self.__tar_bin_dir)
-			core_task_tar.Run()
+		if not self.__src_file_paths:
+			return
 
+		self.__shutdown_backends()
+		self.__corpus.save()
+		self.__conversion_stats.save()
+		if self.__manifest:
+			self.__manifest.save()
 		self.__populate_file_paths()
 
 		if self.__do_diff:
@@ -363,8 +692,7 @@ class Regression(object):
 
 
 	def run_alln_files(self):
-		allfiles = self.__get_all_files(self.__src_testdir, self.__exts)
-		self.__run_all_files_impl(allfiles)
+		self.__run_all_files_impl(self.__discover_files())
 
 	def ref_dir_name(self):
 		return os.path.join('ref', self.__ref_version) if self.__out_dir else self.__ref_out
@@ -423,23 +751,25 @@ class Regression(object):
 	def __get_files_recursively(self, dir, exts, ret):
 		if not dir:
 			return
-		try:
-			for root, dirnames, filenames in os.walk(dir):
-				for filename in filenames:
-					if os.path.splitext(filename)[1] in exts:
-						ret.append(os.path.join(root, filename))
-		except Exception as e:
-			print (e)
+		ret.extend(scan_tree(dir, exts))
 
 	def __hash(self, filepath):
-		import hashlib
-		try:
-			with open(filepath, 'rb') as file:
-				sha1 = hashlib.sha1(file.read())
-				# Append file name in order to avoid conflicts
-				return sha1.hexdigest() + '_' + os.path.split(filepath)[1]
-		except Exception as e:
-			print(e)
+		return self.__corpus.document_hash(filepath)
+
+	def __renderer(self):
+		# Key of the reference renders, see reference_store.renderer_key
+		return renderer_key(self.__ref_version, self.__hash_cache.digest(self.__ref_bin_dir), self.__ref_settings)
+
+	def __binary_fingerprint(self, bin_path, version):
+		if not self.__manifest:
+			return None
+		st = os.stat(bin_path)
+		return {
+			'path': os.path.abspath(bin_path),
+			'version': version,
+			'mtime': st.st_mtime_ns,
+			'sha1': self.__hash_cache.digest(bin_path)
+		}
 
 	def __collections(self):
 		client = pymongo.MongoClient()
@@ -451,7 +781,11 @@ class Regression(object):
 		db_pages = db.pages
 		db_differences = db.differences
 		db_difference_metrics = db.difference_metrics
+		db_errors = db.errors
+		db_leases = db.leases
 		return {
+			'errors': db_errors,
+			'leases': db_leases,
 			'documents': db_documents,
 			'pages': db_pages,
 			'differences': db_differences,
@@ -460,55 +794,17 @@ class Regression(object):
 		}
 
 	def __recover_cache(self):
-		if not self.__diff_metrics_ref_map or not self.__diff_metrics_tar_map or not self.__ref_out_diff_paths_map or not self.__tar_out_diff_paths_map:
-			with open('cache.json', 'rb') as file:
-				dict = json.loads(file.read().decode('utf-8'))
-				diff_metrics_ref_map = dict['diff_metrics_ref_map']
-				diff_metrics_tar_map = dict['diff_metrics_tar_map']
-
-				if not self.__diff_metrics_ref_map:
-					for key in diff_metrics_ref_map.keys():
-						self.__diff_metrics_ref_map[key] = documents.DifferenceMetric(diff_metrics_ref_map[key])
-
-				if not self.__diff_metrics_tar_map:
-					for key in diff_metrics_tar_map.keys():
-						self.__diff_metrics_tar_map[key] = documents.DifferenceMetric(diff_metrics_tar_map[key])
-
-				if not self.__ref_out_diff_paths_map:
-					self.__ref_out_diff_paths_map = dict['ref_out_diff_map']
-
-				if not self.__tar_out_diff_paths_map:
-					self.__tar_out_diff_paths_map = dict['tar_out_diff_map']
-
-				if not self.__out_dir:
-					self.__out_dir = dict['out_dir']
-
-				if not self.__ref_out:
-					self.__ref_out = dict['ref_out']
-
-				if not self.__tar_out:
-					self.__tar_out = dict['tar_out']
-
-				if not self.__ref_bin_dir:
-					self.__ref_bin_dir = dict['ref_bin']
-
-				if not self.__tar_bin_dir:
-					self.__tar_bin_dir = dict['tar_bin']
+		# update_database may run in a later process than the conversions
+		if not self.__ref_bin_dir:
+			self.__ref_bin_dir = self.__results.setting('ref_bin') or ''
 
+		if not self.__tar_bin_dir:
+			self.__tar_bin_dir = self.__results.setting('tar_bin') or ''
 
 		self.__populate_file_paths()
 
 	def __get_document_tags(self, dpath):
-		lst = [dpath, self.__src_testdir]
-		prefix = os.path.commonprefix(lst)
-		relpath = os.path.relpath(dpath, prefix)
-		relpath_nofname = os.path.split(relpath)[0]
-		# using this relpath_nofname to get tags
-		ret = [os.path.split(self.__src_testdir)[1]]
-		while relpath_nofname:
-			(relpath_nofname, tag) = os.path.split(relpath_nofname)
-			ret.append(tag)
-		return ret
+		return self.__corpus.tags(dpath)
 
 	def __serialize_impl(self, args):
 		document = args[0]
@@ -517,40 +813,66 @@ class Regression(object):
 		document.serialize(obj)
 		container.append(obj)
 
-	def __dumpto_database_impl(self, args):
-		document = args[0]
-		collections = args[2]
-		document.bson(collections, self.__ref_version, self.__tar_version)
-		try:
-			sys.stdout.buffer.write((document.get('document_name') + ' dumped to database successfully\n').encode('utf-8'))
-			sys.stdout.flush()
-		except Exception as e:
-			str = document.get('document_name') + (' failed to dump to database. Reason: %s') % e
-			self.__error_handler.writemessage(str.encode('utf-8'))
-			print(e)
+	def __verify_reference(self, path):
+		# Fallback of the sanity check for documents no conversion task reported on
+		hash = self.__hash(path)
+		if not hash:
+			return None, 0
+		return hash, len(self.__page_index.pages(hash, 'ref', self.__ref_version))
 
 	def __sanity_check(self):
 		print('Performing sanity check...')
-		for path in self.__src_file_paths:
-			if self.__out_dir:
-				hash = self.__hash(path)
-				if not hash:
-					self.__error_handler.write(path, ismissing=True)
-					continue
+		summary, report = self.__sanity.build(self.__src_file_paths, self.__verify_reference if self.__out_dir else None)
+		self.__sanity.save(os.path.join(self.__out_dir if self.__out_dir else '.', 'sanity' + self.__file_suffix + '.json'), summary, report)
+		sys.stdout.buffer.write(json.dumps(summary, ensure_ascii=False, indent=4, separators=(',', ': ')).encode('utf-8'))
+		sys.stdout.buffer.write('\n'.encode('utf-8'))
+		self.__error_handler.flush()
 
-				ref_out = os.path.join(self.__out_dir, hash, 'ref', self.__ref_version)
-				if not os.path.exists(ref_out) or not os.listdir(ref_out):
-					self.__error_handler.write(path, ismissing=True)
-			else:
-				pass
-		crashes = self.__error_handler.crashes()
-		exceptions = self.__error_handler.exceptions()
-		missings = self.__error_handler.missing()
 
-		report = { 'crashses': crashes, 'exceptions': exceptions, 'missing': missings, 'crash_ratio': len(crashes)/len(self.__src_file_paths), 'exception_ratio': self.__error_handler.numofexceptions() / len(self.__src_file_paths), 'missing_ratio': len(missings) / len(self.__src_file_paths) }
-		sys.stdout.buffer.write(json.dumps(report, ensure_ascii=False, indent=4, separators=(',', ': ')).encode('utf-8'))
-		sys.stdout.buffer.write('\n'.encode('utf-8'))
+	def __build_document(self, path):
+		'''
+		Build the Document graph (reference, pages, difference, metrics) of a source file,
+		or return None if it has no reference output
+		'''
+		refversion = self.__ref_version
+		try:
+			hash = self.__hash(path)
+			if not hash:
+				self.__error_handler.writemessage((path + ' unhashable!\n').encode('utf-8'))
+				return None
+			if not self.__page_index.pages(hash, 'ref', self.__ref_version):
+				return None
+			benchmark = documents.Reference()
+			# Only used if the reference is brand new
+			benchmark.set('type', self.get_reference_run_type())
+			benchmark.set('version', refversion)
+
+			tags = self.__get_document_tags(path)
+
+			document = documents.Document()
+			document.get('references')[refversion] = benchmark
+			document.set('hash', hash)
+			document.set('tags', tags)
+			document.populate(path, self.__corpus)
+
+			benchmark.set('version', refversion)
+			benchmark.populate(self, document)
+			if self.__manifest:
+				self.__record_changed_pages(hash, benchmark)
+			return document
+		except Exception as e:
+			str = 'update_database: An error occurred while dumping %s to database, exception info: %s' % (path, e)
+			self.__error_handler.writemessage(str.encode('utf-8'))
+			print(e)
+		return None
 
+	def __record_changed_pages(self, hash, benchmark):
+		# Feeds the 'changed' page selection of the next run
+		difference = benchmark.get('diffs').get(self.__tar_version)
+		if not difference:
+			return
+		metrics = difference.get('metrics')
+		self.__manifest.record_changed_pages(hash, [page_num for page_num in metrics.keys() if metrics[page_num].get('diff_percentage')])
 
 	def update_database(self):
 		# Only possible through centralized mode
@@ -558,43 +880,15 @@ class Regression(object):
 			return
 
 		collections = self.__collections()
+		self.__error_handler.attach_collection(collections['errors'])
 		self.__recover_cache()
-		refversion, tarversion = self.get_versions()
+		self.get_versions()
 
 		alldocs = []
 		for path in self.__src_file_paths:
-			try:
-				hash = self.__hash(path)
-				if not hash:
-					self.__error_handler.writemessage((path + ' unhashable!\n').encode('utf-8'))
-					continue
-				ref_out = os.path.join(self.__out_dir, hash, 'ref', self.__ref_version)
-				if not os.path.exists(ref_out) or not os.listdir(ref_out):
-					continue
-				benchmark = documents.Reference()
-				found_benchmark = collections['references'].find_one({'version': refversion, 'hash': hash})
-				if found_benchmark:
-					pass
-				else:
-					# brand new
-					benchmark.set('type', self.get_reference_run_type())
-					benchmark.set('version', refversion)
-
-				tags = self.__get_document_tags(path)
-
-				document = documents.Document()
-				document.get('references')[refversion] = benchmark
-				document.set('hash', hash)
-				document.set('tags', tags)
-				document.populate(path)
-
-				benchmark.set('version', refversion)
-				benchmark.populate(self, document)
+			document = self.__build_document(path)
+			if document:
 				alldocs.append(document)
-			except Exception as e:
-				str = 'update_database: An error occurred while dumping %s to database, exception info: %s' % (path, e)
-				self.__error_handler.writemessage(str.encode('utf-8'))
-				print(e)
 
 		serialize_ret = []
 		args = [(document, serialize_ret, collections) for document in alldocs]
@@ -604,17 +898,298 @@ class Regression(object):
 		pool.close()
 		pool.join()
 
-		pool = ThreadPool(self.__concurency)
-		pool.map(self.__dumpto_database_impl, args)
-		pool.close()
-		pool.join()
+		writer = documents.BulkWriter(collections, self.__db_chunk_size)
+		for i in range(0, len(alldocs), self.__db_chunk_size):
+			chunk = alldocs[i:i + self.__db_chunk_size]
+			try:
+				writer.write(chunk)
+				sys.stdout.buffer.write(('%d documents dumped to database successfully\n' % (i + len(chunk))).encode('utf-8'))
+				sys.stdout.flush()
+			except Exception as e:
+				str = 'update_database: failed to dump documents %d-%d to database. Reason: %s' % (i, i + len(chunk), e)
+				self.__error_handler.writemessage(str.encode('utf-8'))
+				print(e)
 
 		with open('serializeout.json', 'wb') as file:
 			file.write(json.dumps(serialize_ret, ensure_ascii=False, indent=4, separators=(',', ': ')).encode('utf-8'))
 
+		self.__corpus.save()
+		if self.__manifest:
+			self.__manifest.save()
+
+	def __pipeline_convert(self, path):
+		for task in self.__pipeline_tasks:
+			task.RunOne(path)
+		return path
+
+	def __pipeline_diff(self, path):
+		if self.__do_diff:
+			futures = [(arg, self.__run_image_diff_impl(arg)) for arg in self.__document_diff_args(path)]
+			for arg, future in futures:
+				self.__record_image_diff(arg, future)
+			self.__write_diff_artifact(path)
+		return path
+
+	def __pipeline_persist(self, paths):
+		alldocs = []
+		for path in paths:
+			document = self.__build_document(path)
+			if document:
+				alldocs.append(document)
+		for document in alldocs:
+			self.__serialize_impl((document, self.__pipeline_serialized))
+		try:
+			self.__pipeline_writer.write(alldocs)
+			self.__pipeline_persisted += len(alldocs)
+			sys.stdout.buffer.write(('%d documents dumped to database successfully\n' % self.__pipeline_persisted).encode('utf-8'))
+			sys.stdout.flush()
+		except Exception as e:
+			str = 'update_database: failed to dump %d documents to database. Reason: %s' % (len(alldocs), e)
+			self.__error_handler.writemessage(str.encode('utf-8'))
+			print(e)
+
+	def __setup_pipeline(self, files):
+		if self.__pipeline_tasks:
+			return
+		# Tasks only need some files to validate their arguments, RunOne takes any document
+		if self.__ref_bin_dir:
+			self.__pipeline_tasks.append(self.__core_task(files, True))
+		if self.__tar_bin_dir:
+			self.__pipeline_tasks.append(self.__core_task(files, False))
+
+		collections = self.__collections()
+		self.__error_handler.attach_collection(collections['errors'])
+		self.__pipeline_writer = documents.BulkWriter(collections, self.__db_chunk_size)
+
+	def __run_pipeline(self, files):
+		self.__setup_pipeline(files)
+		scheduler = pipeline(self.__pipeline_convert,
+							 self.__pipeline_diff,
+							 self.__pipeline_persist,
+							 convert_concur=self.__concurency,
+							 diff_concur=self.__diff_concur,
+							 persist_batch=self.__db_chunk_size,
+							 queue_size=self.__queue_size)
+		scheduler.run(files)
+
+	def __save_state(self):
+		self.__corpus.save()
+		self.__conversion_stats.save()
+		if self.__manifest:
+			self.__manifest.save()
+		self.__cache()
+
+	def __finish_pipeline(self):
+		self.__shutdown_diff_executor()
+		self.__shutdown_backends()
+		self.__save_state()
+
+		with open('serializeout.json', 'wb') as file:
+			file.write(json.dumps(self.__pipeline_serialized, ensure_ascii=False, indent=4, separators=(',', ': ')).encode('utf-8'))
+
+	def run_pipelined(self):
+		'''
+		Centralized mode only: convert, diff and persist each document as soon as the
+		previous stage is done with it, instead of waiting for the whole corpus at
+		every stage. Documents are fed to the pipeline while src_testdir is walked
+		'''
+		assert self.__out_dir
+		assert self.__batch_size == 1, 'batch_size needs the staged scheduler (run_alln_files)'
+		self.__run_pipeline(self.__discover_files())
+		self.__finish_pipeline()
+
+	async def __diff_async(self, path, semaphore):
+		# Hashing, the diff folder, the results store and the artifact zip all block,
+		# keep them off the event loop
+		loop = asyncio.get_event_loop()
+
+		async def diff(arg):
+			async with semaphore:
+				future = self.__run_image_diff_impl(arg)
+				try:
+					await asyncio.wrap_future(future)
+				except Exception:
+					# Reported by __record_image_diff
+					pass
+			await loop.run_in_executor(None, self.__record_image_diff, arg, future)
+		args = await loop.run_in_executor(None, self.__document_diff_args, path)
+		await asyncio.gather(*[diff(arg) for arg in args])
+		await loop.run_in_executor(None, self.__write_diff_artifact, path)
+
+	async def __persist_async(self, queue):
+		loop = asyncio.get_event_loop()
+		done = False
+		while not done:
+			batch = [await queue.get()]
+			while len(batch) < self.__db_chunk_size and not queue.empty():
+				batch.append(queue.get_nowait())
+			if None in batch:
+				done = True
+				batch = [path for path in batch if path is not None]
+			if batch:
+				# pymongo blocks, keep it off the event loop
+				await loop.run_in_executor(None, self.__pipeline_persist, batch)
+
+	async def run_async(self):
+		'''
+		Centralized mode only: asyncio counterpart of run_pipelined. Converters run as
+		asyncio subprocesses whose output is streamed without a thread per child, so
+		the number of conversions (concur per binary, convert_concur overall) and of
+		diffs (diff_concur) in flight isn't tied to a thread count. Cancelling the
+		run (Ctrl-C) kills the converters that are still running.
+		'''
+		assert self.__out_dir
+		assert self.__batch_size == 1, 'batch_size needs the staged scheduler (run_alln_files)'
+		loop = asyncio.get_event_loop()
+		# Folders are read off the event loop, and their documents scheduled as they come
+		batches = self.__discover()
+		files = await loop.run_in_executor(None, next, batches, None)
+		if not files:
+			return
+		self.__setup_pipeline(files)
+
+		convert_semaphore = asyncio.Semaphore(self.__convert_concur)
+		diff_semaphore = asyncio.Semaphore(self.__diff_concur)
+		# Bounds the number of documents between conversion and persistence
+		inflight = asyncio.Semaphore(self.__queue_size if self.__queue_size else self.__convert_concur + self.__diff_concur)
+		persist_queue = asyncio.Queue()
+		persister = asyncio.ensure_future(self.__persist_async(persist_queue))
+
+		async def process(path):
+			try:
+				for task in self.__pipeline_tasks:
+					await task.RunOneAsync(path, convert_semaphore)
+				if self.__do_diff:
+					await self.__diff_async(path, diff_semaphore)
+				await persist_queue.put(path)
+			except asyncio.CancelledError:
+				raise
+			except Exception as e:
+				print('run_async: %s failed. Reason: %s' % (path, e))
+			finally:
+				inflight.release()
+
+		pending = set()
+		try:
+			while files:
+				for path in files:
+					await inflight.acquire()
+					future = asyncio.ensure_future(process(path))
+					pending.add(future)
+					future.add_done_callback(pending.discard)
+				files = await loop.run_in_executor(None, next, batches, None)
+			await asyncio.gather(*pending)
+			await persist_queue.put(None)
+			await persister
+		except asyncio.CancelledError:
+			for future in list(pending) + [persister]:
+				future.cancel()
+			await asyncio.gather(*pending, persister, return_exceptions=True)
+			raise
+		finally:
+			self.__finish_pipeline()
+
+	def lease_store(self):
+		'''
+		Default store of the sharded mode, the leases collection of the regression database
+		'''
+		return mongo_lease_store(self.__collections()['leases'])
+
+	def run_coordinator(self, store=None, run_id=None, lease_size=50, wait=True, poll_interval=10):
+		'''
+		Sharded mode: split the corpus by document hash into leases of about lease_size
+		documents and publish them in store for the workers (run_worker) to claim. With
+		wait, block until every lease is done and print the sanity report. Returns the run id
+		'''
+		assert self.__out_dir
+		store = store if store else self.lease_store()
+		run_id = run_id if run_id else self.__error_handler.run()
+		self.__error_handler.set_run(run_id)
+
+		files = self.__get_all_files()
+		num_leases = max(1, (len(files) + lease_size - 1) // lease_size)
+		leases = {}
+		for path in files:
+			hash = self.__hash(path)
+			if not hash:
+				continue
+			name = 'lease-%05d' % (int(hash[:8], 16) % num_leases)
+			# Relative to src_testdir, which may be mounted elsewhere on the workers
+			leases.setdefault(name, []).append(os.path.relpath(path, self.__src_testdir).replace(os.sep, '/'))
+		self.__corpus.save()
+		store.create(run_id, leases)
+		print('%s: %d documents in %d leases' % (run_id, len(files), len(leases)))
+
+		if wait:
+			while not store.finished(run_id):
+				print('%s: %s' % (run_id, store.progress(run_id)))
+				time.sleep(poll_interval)
+			self.__collect_worker_errors(run_id)
+			self.__sanity_check()
+		return run_id
+
+	def __collect_worker_errors(self, run_id):
+		# The workers' error logs are in out_dir next to this one, see run_worker
+		for name in sorted(os.listdir(self.__out_dir)):
+			if name.startswith('errors') and name.endswith('.jsonl'):
+				self.__error_handler.replay(os.path.join(self.__out_dir, name), run_id)
+
+	def __renew_lease(self, store, lease, owner, ttl, stop):
+		while not stop.wait(ttl / 3.0):
+			try:
+				if not store.renew(lease['_id'], owner, ttl):
+					print('%s: lost to another worker' % lease['_id'])
+					return
+			except Exception as e:
+				print(e)
+
+	def run_worker(self, run_id, store=None, lease_ttl=600):
+		'''
+		Sharded mode: claim leases of run_id until none is left, and convert, diff and
+		persist their documents into out_dir/<hash>/ like run_pipelined does. A lease
+		that isn't renewed within lease_ttl seconds goes to another worker
+		'''
+		assert self.__out_dir
+		assert self.__batch_size == 1, 'batch_size needs the staged scheduler (run_alln_files)'
+		store = store if store else self.lease_store()
+		owner = self.__worker_id if self.__worker_id else '%s-%d' % (socket.gethostname(), os.getpid())
+		# Read back by the coordinator for its sanity report
+		self.__error_handler.set_run(run_id)
+		while True:
+			lease = store.claim(run_id, owner, lease_ttl)
+			if not lease:
+				break
+			print('%s: claimed %s (%d documents)' % (owner, lease['_id'], len(lease['files'])))
+			files = [os.path.join(self.__src_testdir, *path.split('/')) for path in lease['files']]
+			self.__src_file_paths.extend(files)
+
+			stop = threading.Event()
+			heartbeat = threading.Thread(target=self.__renew_lease, args=(store, lease, owner, lease_ttl, stop))
+			heartbeat.daemon = True
+			heartbeat.start()
+			try:
+				self.__run_pipeline(self.__conversion_stats.order(files, self.__hash))
+				self.__save_state()
+				store.complete(lease['_id'], owner)
+			except Exception as e:
+				print(e)
+				store.release(lease['_id'], owner)
+			finally:
+				stop.set()
+				heartbeat.join()
+
+		if self.__src_file_paths:
+			self.__finish_pipeline()
+		self.__error_handler.flush()
+
 	def run(self):
-		self.run_alln_files()
-		self.update_database()
+		if self.__out_dir and self.__scheduler == 'asyncio':
+			asyncio.run(self.run_async())
+		elif self.__out_dir and self.__pipelined:
+			self.run_pipelined()
+		else:
+			self.run_alln_files()
+			self.update_database()
 		self.__sanity_check()
 
 def main():
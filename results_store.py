@@ -0,0 +1,96 @@
+__author__ = 'Renchen'
+
+import sqlite3
+import threading
+import json
+import time
+
+class results_store(object):
+	'''
+	Image diff results of the runs under out_dir, in an SQLite database.
+	Each result is written as soon as its diff completes and committed in
+	small batches. Lookups by ref or tar page path go through an index, so
+	nothing is loaded up front. WAL journaling lets other processes read the
+	store while a run writes to it.
+	'''
+	def __init__(self, path, run='', commit_every=100):
+		self.__path = path
+		self.__run = run
+		self.__commit_every = commit_every
+		self.__uncommitted = 0
+		self.__lock = threading.Lock()
+		# One connection shared by the diff and persist threads, serialized by __lock
+		self.__connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+		self.__connection.execute('PRAGMA journal_mode=WAL')
+		self.__connection.execute('PRAGMA synchronous=NORMAL')
+		self.__connection.execute('''CREATE TABLE IF NOT EXISTS diffs (
+			tar_path TEXT PRIMARY KEY,
+			ref_path TEXT NOT NULL,
+			diff_image_path TEXT,
+			diff_percentage REAL,
+			result TEXT,
+			run TEXT,
+			updated REAL)''')
+		self.__connection.execute('CREATE INDEX IF NOT EXISTS diffs_ref_path ON diffs (ref_path)')
+		self.__connection.execute('CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)')
+		self.__connection.commit()
+
+	def path(self):
+		return self.__path
+
+	def __commit(self, force=False):
+		# Must be called with the lock held
+		if force or self.__uncommitted >= self.__commit_every:
+			self.__connection.commit()
+			self.__uncommitted = 0
+
+	def record(self, ref_path, tar_path, result):
+		'''
+		result: the dictionary returned by image_diff.ImageDiff
+		'''
+		with self.__lock:
+			self.__connection.execute('INSERT OR REPLACE INTO diffs VALUES (?, ?, ?, ?, ?, ?, ?)',
+									  (tar_path, ref_path, result.get('diff_image_path'), result.get('diff_percentage'),
+									   json.dumps(result, ensure_ascii=False), self.__run, time.time()))
+			self.__uncommitted += 1
+			self.__commit()
+
+	def forget(self, tar_paths):
+		'''
+		Drop the results of these tar pages, e.g. before their document is diffed again
+		'''
+		with self.__lock:
+			self.__connection.executemany('DELETE FROM diffs WHERE tar_path = ?', [(path,) for path in tar_paths])
+			self.__uncommitted += 1
+			self.__commit()
+
+	def __lookup(self, column, path):
+		with self.__lock:
+			row = self.__connection.execute('SELECT result FROM diffs WHERE %s = ?' % column, (path,)).fetchone()
+		return json.loads(row[0]) if row else None
+
+	def by_tar(self, tar_path):
+		return self.__lookup('tar_path', tar_path)
+
+	def by_ref(self, ref_path):
+		return self.__lookup('ref_path', ref_path)
+
+	def set_setting(self, key, value):
+		with self.__lock:
+			self.__connection.execute('INSERT OR REPLACE INTO settings VALUES (?, ?)', (key, value))
+			self.__uncommitted += 1
+			self.__commit()
+
+	def setting(self, key):
+		with self.__lock:
+			row = self.__connection.execute('SELECT value FROM settings WHERE key = ?', (key,)).fetchone()
+		return row[0] if row else None
+
+	def flush(self):
+		with self.__lock:
+			self.__commit(True)
+
+	def close(self):
+		with self.__lock:
+			self.__commit(True)
+			self.__connection.close()
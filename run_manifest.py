@@ -0,0 +1,111 @@
+__author__ = 'Renchen'
+
+import os.path
+import json
+import threading
+
+class run_manifest(object):
+	'''
+	Records, per document hash, what the last run under out_dir produced:
+	the binary fingerprint each output was converted with, whether the
+	conversion succeeded, the digests of the produced pages and the diff
+	result of each page, with the digests of the ref and tar pages it was
+	computed from. Incremental runs use it to skip documents whose inputs and
+	binaries are unchanged.
+	'''
+	# Format 1 kept every (ref digest, tar digest) pair ever diffed
+	FORMAT = 2
+
+	def __init__(self, path):
+		self.__path = path
+		self.__lock = threading.Lock()
+		self.__documents = {}
+		if os.path.exists(self.__path):
+			try:
+				with open(self.__path, 'rb') as file:
+					obj = json.loads(file.read().decode('utf-8'))
+				self.__documents = obj['documents']
+				if obj.get('format', 1) < self.FORMAT:
+					# Diffs are recomputed once, conversions are still valid
+					for document in self.__documents.values():
+						document.pop('diffs', None)
+			except Exception as e:
+				print(e)
+				self.__documents = {}
+
+	def __conversion_key(self, role, version):
+		return role + '/' + version if version else role
+
+	def conversion_current(self, hash, role, fingerprint, output_dir, version=None, selection=None):
+		'''
+		True if the last conversion of this document for role succeeded with
+		the same binary and page selection, and all of its pages are still on disk
+		'''
+		with self.__lock:
+			entry = self.__documents.get(hash, {}).get('conversions', {}).get(self.__conversion_key(role, version))
+		if not entry or entry['status'] != 'ok' or entry['binary'] != fingerprint:
+			return False
+		if entry.get('selection') != selection:
+			return False
+		for name in entry['pages'].keys():
+			if not os.path.exists(os.path.join(output_dir, name)):
+				return False
+		return True
+
+	def conversion_failed(self, hash, role, version=None):
+		with self.__lock:
+			entry = self.__documents.get(hash, {}).get('conversions', {}).get(self.__conversion_key(role, version))
+		return bool(entry) and entry['status'] != 'ok'
+
+	def record_conversion(self, hash, role, fingerprint, pages, ok, version=None, selection=None):
+		'''
+		pages: map between page file name and its digest
+		selection: page numbers the converter was asked for, None for all pages
+		'''
+		with self.__lock:
+			document = self.__documents.setdefault(hash, {})
+			document.setdefault('conversions', {})[self.__conversion_key(role, version)] = {
+				'binary': fingerprint,
+				'status': 'ok' if ok else 'failed',
+				'pages': pages,
+				'selection': selection
+			}
+
+	def changed_pages(self, hash):
+		'''
+		Page numbers that differed from the reference in the last run, or None
+		'''
+		with self.__lock:
+			return self.__documents.get(hash, {}).get('changed_pages')
+
+	def record_changed_pages(self, hash, pages):
+		with self.__lock:
+			self.__documents.setdefault(hash, {})['changed_pages'] = sorted(pages)
+
+	def diff_result(self, hash, diff_name, page, ref_digest, tar_digest):
+		'''
+		The last result of page (its file name) if it was computed from the same ref and tar pages
+		'''
+		with self.__lock:
+			entry = self.__documents.get(hash, {}).get('diffs', {}).get(diff_name, {}).get(page)
+		if entry and entry['ref'] == ref_digest and entry['tar'] == tar_digest:
+			return entry['result']
+		return None
+
+	def record_diff(self, hash, diff_name, page, ref_digest, tar_digest, result):
+		# Replaces the previous result of the page, so the manifest doesn't grow with every changed render
+		with self.__lock:
+			document = self.__documents.setdefault(hash, {})
+			document.setdefault('diffs', {}).setdefault(diff_name, {})[page] = {'ref': ref_digest, 'tar': tar_digest, 'result': result}
+
+	def save(self):
+		with self.__lock:
+			json_str = json.dumps({'format': self.FORMAT, 'documents': self.__documents}, ensure_ascii=False)
+
+		tmp_path = self.__path + '.tmp'
+		try:
+			with open(tmp_path, 'wb') as file:
+				file.write(json_str.encode('utf-8'))
+			os.replace(tmp_path, self.__path)
+		except Exception as e:
+			print(e)
@@ -0,0 +1,102 @@
+__author__ = 'Renchen'
+
+import os
+import json
+import threading
+from multiprocessing.dummy import Pool as ThreadPool
+
+class sanity_report(object):
+	'''
+	Sanity report of a run (crashes, exceptions, missing references,
+	timeouts, ooms), built while the conversion tasks report what they left
+	on disk. Only documents no task reported on (e.g. in a coordinator, or
+	when the references were converted by another run) are verified at the
+	end, in parallel.
+	'''
+	# Exception groups listed in the summary
+	TOP_EXCEPTIONS = 10
+
+	def __init__(self, error_handler, concur=8):
+		self.__error_handler = error_handler
+		self.__concur = max(1, concur)
+		self.__lock = threading.Lock()
+		# path -> role -> (hash, number of pages on disk)
+		self.__outputs = {}
+
+	def record(self, filepath, hash, role, pages):
+		'''
+		Called by the conversion tasks once a document's output for role ('ref'
+		or 'tar') is final, converted or not. hash is None if it can't be hashed
+		'''
+		with self.__lock:
+			self.__outputs.setdefault(os.path.abspath(filepath), {})[role] = (hash, pages)
+
+	def __reference(self, path):
+		with self.__lock:
+			return self.__outputs.get(os.path.abspath(path), {}).get('ref')
+
+	def build(self, paths, verify=None):
+		'''
+		Flag the documents without reference pages as missing and return
+		(summary, report). verify(path) returns (hash, number of reference
+		pages) for the documents no task reported on; without it (simple
+		mode) nothing is flagged as missing.
+		'''
+		if verify:
+			unknown = []
+			for path in paths:
+				reference = self.__reference(path)
+				if reference is None:
+					unknown.append(path)
+				elif not reference[1]:
+					self.__error_handler.write(path, ismissing=True, hash=reference[0])
+
+			def check(path):
+				try:
+					return path, verify(path)
+				except Exception as e:
+					print(e)
+					return path, (None, 0)
+			pool = ThreadPool(self.__concur)
+			for path, (hash, pages) in pool.imap_unordered(check, unknown, chunksize=16):
+				if not pages:
+					self.__error_handler.write(path, ismissing=True, hash=hash)
+			pool.close()
+			pool.join()
+
+		total = len(paths)
+		crashes = self.__error_handler.crashes()
+		exceptions = self.__error_handler.exceptions()
+		missings = self.__error_handler.missing()
+		timeouts = self.__error_handler.timeouts()
+		ooms = self.__error_handler.ooms()
+		numofexceptions = self.__error_handler.numofexceptions()
+
+		def ratio(count):
+			return count / total if total else 0.0
+
+		report = {'crashses': crashes, 'exceptions': exceptions, 'missing': missings, 'timeouts': timeouts, 'ooms': ooms,
+				  'crash_ratio': ratio(len(crashes)), 'exception_ratio': ratio(numofexceptions), 'missing_ratio': ratio(len(missings)),
+				  'timeout_ratio': ratio(len(timeouts)), 'oom_ratio': ratio(len(ooms))}
+
+		# exceptions() is sorted by number of documents, ascending
+		top = [{'message': message, 'count': len(files), 'example': files[0]} for message, files in reversed(exceptions[-self.TOP_EXCEPTIONS:])]
+		summary = {'run': self.__error_handler.run(), 'documents': total,
+				   'crashes': len(crashes), 'exceptions': numofexceptions, 'exception_groups': len(exceptions),
+				   'missing': len(missings), 'timeouts': len(timeouts), 'ooms': len(ooms),
+				   'crash_ratio': report['crash_ratio'], 'exception_ratio': report['exception_ratio'], 'missing_ratio': report['missing_ratio'],
+				   'timeout_ratio': report['timeout_ratio'], 'oom_ratio': report['oom_ratio'],
+				   'top_exceptions': top}
+		return summary, report
+
+	def save(self, path, summary, report):
+		'''
+		Write the summary and the full lists as one json file
+		'''
+		tmp_path = path + '.tmp'
+		try:
+			with open(tmp_path, 'wb') as file:
+				file.write(json.dumps({'summary': summary, 'report': report}, ensure_ascii=False, indent=4, separators=(',', ': ')).encode('utf-8'))
+			os.replace(tmp_path, path)
+		except Exception as e:
+			print(e)
@@ -0,0 +1,121 @@
+__author__ = 'Renchen'
+
+import os
+import sys
+import stat
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Stand-in for the pdf2image binary. A source "document" is a text file whose
+# first line is "pages=<n>"; CRASH, HANG, SPIN (CPU), SEGV, KILL or ALLOC (fails to
+# allocate 8GB) anywhere in it makes the converter die, hang or spin. Even pages are shifted by SHIFT pixels, so two versions with a
+# different SHIFT produce diffs. With BATCH, "--batch <list file>" converts the
+# documents of the list and prints a status block after each one. With
+# FAKE_CONVERTER_FAIL set, every conversion crashes.
+FAKE_PDF2IMAGE = '''#!%(python)s
+import sys, os, json, time, signal
+from PIL import Image, ImageDraw
+VERSION = %(version)r
+SHIFT = %(shift)d
+BATCH = %(batch)r
+args = sys.argv[1:]
+if args == ['-v']:
+	print('PDFNet pdf2image version %%s.0' %% VERSION)
+	sys.exit(0)
+if args == ['--help']:
+	print('usage: pdf2image [--pages RANGE]' + (' [--batch LIST]' if BATCH else '') + ' file -o dir')
+	sys.exit(0)
+if os.environ.get('FAKE_CONVERTER_FAIL'):
+	os._exit(245)
+if '--batch' in args:
+	jobs = [line.rstrip('\\n').split('\\t') for line in open(args[args.index('--batch') + 1])]
+	log = os.environ.get('FAKE_BATCH_LOG')
+	if log:
+		with open(log, 'a') as file:
+			file.write('%%d\\n' %% len(jobs))
+else:
+	out = args[args.index('-o') + 1]
+	pages = args[args.index('--pages') + 1] if '--pages' in args else ''
+	jobs = [(arg, out, pages) for arg in args if arg.endswith(('.pdf', '.docx'))]
+for path, out, pages in jobs:
+	data = open(path, 'rb').read()
+	count = int(data.split(b'\\n')[0].split(b'=')[1])
+	name = os.path.splitext(os.path.basename(path))[0]
+	print('converting', path)
+	sys.stdout.flush()
+	if b'CRASH' in data:
+		os._exit(245)
+	if b'HANG' in data:
+		time.sleep(60)
+	if b'SPIN' in data:
+		while True:
+			pass
+	if b'SEGV' in data:
+		os.kill(os.getpid(), signal.SIGSEGV)
+	if b'KILL' in data:
+		os.kill(os.getpid(), signal.SIGKILL)
+	if b'ALLOC' in data:
+		# Give the parent time to set the limits
+		time.sleep(1)
+		try:
+			block = bytearray(8 << 30)
+		except MemoryError:
+			# What an uncaught std::bad_alloc looks like
+			sys.stderr.write("terminate called after throwing an instance of 'std::bad_alloc'\\n")
+			sys.stderr.flush()
+			os.abort()
+	selection = None
+	if pages:
+		selection = set()
+		for part in pages.split(','):
+			first, _, last = part.partition('-')
+			selection.update(range(int(first), int(last or first) + 1))
+	for page_num in range(1, count + 1):
+		if selection is not None and page_num not in selection:
+			continue
+		image = Image.new('RGB', (200, 260), 'white')
+		ImageDraw.Draw(image).text((20 + (SHIFT if page_num %% 2 == 0 else 0), 20), 'page %%d %%s' %% (page_num, name), fill='black')
+		image.save(os.path.join(out, name + ('.png' if count == 1 else '_%%d.png' %% page_num)))
+	print('{bson_begin}' + json.dumps({'file': path, 'status': 'success'}) + '{bson_end}')
+	sys.stdout.flush()
+'''
+
+@pytest.fixture
+def make_converter(tmp_path):
+	'''
+	make_converter(folder, version, shift=0, batch=False) -> path of a fake pdf2image
+	'''
+	def make(folder, version, shift=0, batch=False):
+		directory = tmp_path / folder
+		directory.mkdir(parents=True, exist_ok=True)
+		path = directory / 'pdf2image'
+		path.write_text(FAKE_PDF2IMAGE % {'python': sys.executable, 'version': version, 'shift': shift, 'batch': batch})
+		path.chmod(path.stat().st_mode | stat.S_IXUSR)
+		return str(path)
+	return make
+
+@pytest.fixture
+def make_corpus(tmp_path):
+	'''
+	make_corpus({relative path: pages or text}) -> source folder
+	'''
+	def make(documents, folder='src'):
+		root = tmp_path / folder
+		for relpath, content in documents.items():
+			path = root / relpath
+			path.parent.mkdir(parents=True, exist_ok=True)
+			path.write_text('pages=%d\n' % content if isinstance(content, int) else content)
+		return str(root)
+	return make
+
+@pytest.fixture
+def mongo(monkeypatch):
+	'''
+	In-memory database behind pymongo.MongoClient
+	'''
+	mongomock = pytest.importorskip('mongomock')
+	import pymongo
+	client = mongomock.MongoClient()
+	monkeypatch.setattr(pymongo, 'MongoClient', lambda *args, **kwargs: client)
+	return client
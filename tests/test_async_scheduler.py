@@ -0,0 +1,45 @@
+__author__ = 'Renchen'
+
+import json
+import os
+import threading
+import pytest
+
+regression = pytest.importorskip('regression')
+import reg_helper
+
+def test_prepare_and_finish_run_off_the_event_loop(tmp_path, monkeypatch, mongo, make_converter, make_corpus):
+	monkeypatch.chdir(tmp_path)
+	src = make_corpus({'a.pdf': 2, 'b.pdf': 1, 'c.pdf': 'pages=1\nCRASH\n'})
+	threads = {}
+	for name in ['_regression_core_task__prepare', '_regression_core_task__finish']:
+		def wrapper(self, *args, __original=getattr(reg_helper.regression_core_task, name), __name=name):
+			threads.setdefault(__name, set()).add(threading.current_thread() is threading.main_thread())
+			return __original(self, *args)
+		monkeypatch.setattr(reg_helper.regression_core_task, name, wrapper)
+
+	out_dir = str(tmp_path / 'out')
+	regression.Regression(src_testdir=src, out_dir=out_dir, concur=2, do_diff=True, scheduler='asyncio',
+						  ref_bin_dir=make_converter('ref_bin', '9.1'), tar_bin_dir=make_converter('tar_bin', '9.2', shift=3)).run()
+	assert threads == {'_regression_core_task__prepare': {False}, '_regression_core_task__finish': {False}}
+
+	with open(os.path.join(out_dir, 'sanity.json'), 'rb') as file:
+		summary = json.loads(file.read().decode('utf-8'))['summary']
+	assert summary['crashes'] == 2
+	assert mongo.pdftron_regression.difference_metrics.count_documents({}) == 3
+
+def test_diff_bookkeeping_runs_off_the_event_loop(tmp_path, monkeypatch, mongo, make_converter, make_corpus):
+	monkeypatch.chdir(tmp_path)
+	src = make_corpus({'a.pdf': 2, 'b.pdf': 4})
+	threads = {}
+	names = ['_Regression__document_diff_args', '_Regression__record_image_diff', '_Regression__write_diff_artifact']
+	for name in names:
+		def wrapper(self, *args, __original=getattr(regression.Regression, name), __name=name):
+			threads.setdefault(__name, set()).add(threading.current_thread() is threading.main_thread())
+			return __original(self, *args)
+		monkeypatch.setattr(regression.Regression, name, wrapper)
+
+	regression.Regression(src_testdir=src, out_dir=str(tmp_path / 'out'), concur=2, do_diff=True, scheduler='asyncio', diff_format='compact',
+						  ref_bin_dir=make_converter('ref_bin', '9.1'), tar_bin_dir=make_converter('tar_bin', '9.2', shift=3)).run()
+	assert threads == dict((name, {False}) for name in names)
+	assert mongo.pdftron_regression.difference_metrics.count_documents({}) == 6
@@ -0,0 +1,62 @@
+__author__ = 'Renchen'
+
+import json
+import os
+import time
+import pytest
+
+regression = pytest.importorskip('regression')
+
+def summary(out_dir):
+	with open(os.path.join(out_dir, 'sanity.json'), 'rb') as file:
+		return json.loads(file.read().decode('utf-8'))['summary']
+
+def batches(path):
+	with open(path) as file:
+		return [int(line) for line in file]
+
+@pytest.fixture
+def batch_log(tmp_path, monkeypatch):
+	path = str(tmp_path / 'batches.txt')
+	monkeypatch.setenv('FAKE_BATCH_LOG', path)
+	return path
+
+def test_failed_batch_is_bisected_down_to_the_crashing_document(tmp_path, monkeypatch, mongo, make_converter, make_corpus, batch_log):
+	monkeypatch.chdir(tmp_path)
+	src = make_corpus({'a.pdf': 2, 'b.pdf': 1, 'c.pdf': 'pages=1\nCRASH\n', 'd.pdf': 3, 'e.pdf': 1})
+	out_dir = str(tmp_path / 'out')
+	task = regression.Regression(src_testdir=src, out_dir=out_dir, concur=1, do_diff=False, pipelined=False,
+								 batch_size=5, batch_converter=True, ref_bin_dir=make_converter('ref_bin', '9.1', batch=True))
+	task.run()
+	report = summary(out_dir)
+	assert (report['documents'], report['crashes'], report['missing']) == (5, 1, 1)
+	# One batch of 5, then halves of what wasn't done, until c.pdf is converted alone
+	log = batches(batch_log)
+	assert log[0] == 5
+	assert all(size < 5 for size in log[1:])
+	crashes = [json.loads(line) for line in open(os.path.join(out_dir, 'errors.jsonl')) if '"crash"' in line]
+	assert [os.path.basename(record['path']) for record in crashes] == ['c.pdf']
+
+def test_batch_timeout_is_capped(tmp_path, monkeypatch, mongo, make_converter, make_corpus, batch_log):
+	monkeypatch.chdir(tmp_path)
+	src = make_corpus({'a.pdf': 1, 'b.pdf': 'pages=1\nHANG\n', 'c.pdf': 1, 'd.pdf': 1, 'e.pdf': 1, 'f.pdf': 1})
+	out_dir = str(tmp_path / 'out')
+	start = time.time()
+	regression.Regression(src_testdir=src, out_dir=out_dir, concur=1, do_diff=False, pipelined=False, timeout=2, batch_timeout=3,
+						  batch_size=6, batch_converter=True, ref_bin_dir=make_converter('ref_bin', '9.1', batch=True)).run()
+	# Batches of 6, 3 and 2 documents time out after 3 seconds each instead of 12, 6 and 4
+	assert time.time() - start < 18
+	report = summary(out_dir)
+	assert (report['documents'], report['timeouts'], report['missing']) == (6, 1, 1)
+
+def test_batch_mode_needs_a_batch_converter_and_the_staged_scheduler(tmp_path, make_converter, make_corpus):
+	src = make_corpus({'a.pdf': 1})
+	kw = dict(src_testdir=src, out_dir=str(tmp_path / 'out'), ref_bin_dir=make_converter('ref_bin', '9.1', batch=True), batch_size=4)
+	with pytest.raises(AssertionError):
+		regression.Regression(pipelined=False, **kw)
+	with pytest.raises(AssertionError):
+		regression.Regression(batch_converter=True, **kw)
+	with pytest.raises(AssertionError):
+		regression.Regression(batch_converter=True, pipelined=False, scheduler='asyncio', **kw)
+	with pytest.raises(AssertionError):
+		regression.Regression(batch_converter=True, pipelined=False, **kw).run_pipelined()
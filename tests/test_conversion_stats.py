@@ -0,0 +1,36 @@
+__author__ = 'Renchen'
+
+from conversion_stats import conversion_stats
+
+def history(path=None):
+	stats = conversion_stats(path)
+	for hash, duration in [('a', 10.0), ('b', 5.0)]:
+		for role in ['ref', 'tar']:
+			stats.record(hash, role, duration, 3, 100)
+	return stats
+
+def test_new_documents_are_costed_in_every_role():
+	stats = history()
+	# 0.075 seconds per byte and role: c costs 2 x 100 x 0.075 = 15 seconds, between a (20) and b (10)
+	assert stats.rank([('/b.pdf', 'b', 100), ('/c.pdf', 'c', 100), ('/a.pdf', 'a', 100)]) == ['/a.pdf', '/c.pdf', '/b.pdf']
+	assert stats.rank([('/b.pdf', 'b', 100), ('/c.pdf', 'c', 150), ('/a.pdf', 'a', 100)]) == ['/c.pdf', '/a.pdf', '/b.pdf']
+
+def test_missing_roles_are_estimated():
+	stats = history()
+	# Converted as a reference only: 4 seconds plus 7.5 for the target
+	stats.record('d', 'ref', 4.0, 1, 100)
+	assert stats.rank([('/b.pdf', 'b', 100), ('/d.pdf', 'd', 100)]) == ['/d.pdf', '/b.pdf']
+
+def test_without_history_larger_files_go_first(tmp_path):
+	stats = conversion_stats()
+	assert stats.rank([('/small.pdf', 's', 10), ('/large.pdf', 'l', 1000)]) == ['/large.pdf', '/small.pdf']
+
+def test_history_is_saved(tmp_path):
+	path = str(tmp_path / 'conversion_stats.json')
+	stats = history(path)
+	stats.record('b', 'tar', 5.0, 2, 100, partial=True)
+	stats.save()
+	loaded = conversion_stats(path)
+	assert loaded.pages('b') == 3
+	assert loaded.pages('c') is None
+	assert loaded.rank([('/b.pdf', 'b', 100), ('/a.pdf', 'a', 100)]) == ['/a.pdf', '/b.pdf']
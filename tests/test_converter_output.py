@@ -0,0 +1,79 @@
+__author__ = 'Renchen'
+
+import io
+import json
+
+from reg_helper import converter_output
+
+BLOCK = b'{bson_begin}' + json.dumps({'status': 'success', 'pages': 3}).encode('utf-8') + b'{bson_end}'
+
+def read(path):
+	with open(path, 'rb') as file:
+		return file.read()
+
+def test_block_is_extracted_and_the_rest_logged(tmp_path):
+	log_path = str(tmp_path / 'a.log')
+	output = converter_output(log_path)
+	output.consume(io.BytesIO(b'loading\n' + BLOCK + b'\ndone\n'))
+	assert output.bson() == {'status': 'success', 'pages': 3}
+	assert read(log_path) == b'loading\n\ndone\n'
+
+def test_markers_split_across_chunks(tmp_path):
+	data = b'x' * 10 + BLOCK + b'tail'
+	for size in [1, 3, 7, 11]:
+		log_path = str(tmp_path / ('%d.log' % size))
+		output = converter_output(log_path)
+		for start in range(0, len(data), size):
+			output.feed(data[start:start + size])
+		output.feed(b'', final=True)
+		output.close()
+		assert output.bson() == {'status': 'success', 'pages': 3}
+		assert read(log_path) == b'x' * 10 + b'tail'
+
+def test_partial_marker_at_the_end_is_logged(tmp_path):
+	log_path = str(tmp_path / 'a.log')
+	output = converter_output(log_path)
+	output.feed(b'abc{bson_')
+	output.feed(b'', final=True)
+	output.close()
+	assert output.bson() is None
+	assert read(log_path) == b'abc{bson_'
+
+def test_unterminated_or_oversized_block(tmp_path):
+	output = converter_output(None)
+	output.feed(b'{bson_begin}{"status": ', final=True)
+	assert output.bson() is None
+
+	output = converter_output(None, max_bson=8)
+	output.feed(BLOCK, final=True)
+	assert output.bson() is None
+
+def test_only_the_first_block_of_a_single_document(tmp_path):
+	log_path = str(tmp_path / 'a.log')
+	output = converter_output(log_path)
+	output.consume(io.BytesIO(BLOCK + b'{bson_begin}{}{bson_end}'))
+	assert output.bson() == {'status': 'success', 'pages': 3}
+	assert read(log_path) == b'{bson_begin}{}{bson_end}'
+
+def test_batch_output_goes_to_each_document_log(tmp_path):
+	log_paths = [str(tmp_path / ('%d.log' % i)) for i in range(3)]
+	output = converter_output(log_paths)
+	output.consume(io.BytesIO(b'first\n{bson_begin}{"file": "a"}{bson_end}\nsecond\n'
+							  b'{bson_begin}not json{bson_end}third\n'))
+	assert output.blocks() == [{'file': 'a'}, None]
+	# The first block is also the bson of the batch
+	assert output.bson() == {'file': 'a'}
+	assert [read(path) for path in log_paths] == [b'first\n', b'\nsecond\n', b'third\n']
+
+def test_failed_allocation_is_noticed_across_chunks(tmp_path):
+	data = b'page 1\nterminate called after throwing an instance of \'std::bad_alloc\'\n'
+	for size in [1, 5, 9]:
+		output = converter_output(str(tmp_path / ('%d.log' % size)))
+		for start in range(0, len(data), size):
+			output.feed(data[start:start + size])
+		output.feed(b'', final=True)
+		output.close()
+		assert output.out_of_memory()
+	output = converter_output(str(tmp_path / 'clean.log'))
+	output.consume(io.BytesIO(b'Segmentation fault\n' + BLOCK))
+	assert not output.out_of_memory()
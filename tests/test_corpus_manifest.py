@@ -0,0 +1,100 @@
+__author__ = 'Renchen'
+
+import os
+
+from corpus_manifest import corpus_manifest, document_tags
+from hash_index import hash_index
+
+def write(path, content):
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	with open(path, 'w') as file:
+		file.write(content)
+
+def listing(manifest, **kw):
+	return sorted(path for folder, docs in manifest.scan(['.pdf'], **kw) for path in docs)
+
+def manifest_of(tmp_path, src, refresh=True):
+	hashes = hash_index(str(tmp_path / 'hash_index.json'))
+	return corpus_manifest(str(tmp_path / 'corpus_manifest.json'), src, hashes, refresh=refresh)
+
+def test_document_tags():
+	assert document_tags('/corpus/PDFTest', '/corpus/PDFTest/Annotations/Forms/a.pdf') == ['PDFTest', 'Forms', 'Annotations']
+	assert document_tags('/corpus/PDFTest', '/corpus/PDFTest/a.pdf') == ['PDFTest']
+
+def test_scan_lists_documents_and_persists(tmp_path):
+	src = str(tmp_path / 'PDFTest')
+	write(os.path.join(src, 'a.pdf'), 'a')
+	write(os.path.join(src, 'Annotations', 'b.pdf'), 'b')
+	write(os.path.join(src, 'Annotations', 'notes.txt'), 'x')
+	manifest = manifest_of(tmp_path, src)
+	assert listing(manifest) == [os.path.join(src, 'Annotations', 'b.pdf'), os.path.join(src, 'a.pdf')]
+	assert manifest.tags(os.path.join(src, 'Annotations', 'b.pdf')) == ['PDFTest', 'Annotations']
+	hash = manifest.document_hash(os.path.join(src, 'a.pdf'))
+	assert hash.endswith('_a.pdf')
+	manifest.save()
+
+	reloaded = manifest_of(tmp_path, src, refresh=False)
+	assert reloaded.entry(os.path.join(src, 'a.pdf'))['hash'] == hash
+	assert listing(reloaded, refresh=False) == listing(manifest)
+
+def test_document_rewritten_in_place_is_hashed_again(tmp_path):
+	src = str(tmp_path / 'src')
+	path = os.path.join(src, 'a.pdf')
+	write(path, 'first')
+	manifest = manifest_of(tmp_path, src)
+	listing(manifest)
+	first = manifest.document_hash(path)
+	manifest.save()
+	folder_mtime = os.stat(src).st_mtime_ns
+
+	# Same folder mtime, different size and mtime
+	write(path, 'second version')
+	os.utime(path, ns=(os.stat(path).st_atime_ns, os.stat(path).st_mtime_ns + 10 ** 9))
+	os.utime(src, ns=(folder_mtime, folder_mtime))
+
+	# Without refresh the manifest is trusted
+	stale = manifest_of(tmp_path, src, refresh=False)
+	assert listing(stale, refresh=False) == [path]
+	assert stale.document_hash(path) == first
+
+	manifest = manifest_of(tmp_path, src)
+	listing(manifest)
+	assert manifest.entry(path)['size'] == len('second version')
+	second = manifest.document_hash(path)
+	assert second != first
+	# Also noticed by document_hash alone, between two scans
+	write(path, 'third')
+	os.utime(src, ns=(folder_mtime, folder_mtime))
+	assert manifest.document_hash(path) not in (first, second)
+
+def test_tag_filter_finds_new_subfolders_of_out_of_scope_folders(tmp_path):
+	src = str(tmp_path / 'src')
+	write(os.path.join(src, 'Other', 'a.pdf'), 'a')
+	write(os.path.join(src, 'Forms', 'b.pdf'), 'b')
+	manifest = manifest_of(tmp_path, src)
+	assert listing(manifest, tags=['Forms']) == [os.path.join(src, 'Forms', 'b.pdf')]
+	manifest.save()
+
+	# Other isn't in scope, but its new subfolder is
+	write(os.path.join(src, 'Other', 'Forms', 'c.pdf'), 'c')
+	manifest = manifest_of(tmp_path, src)
+	assert listing(manifest, tags=['Forms']) == [os.path.join(src, 'Forms', 'b.pdf'), os.path.join(src, 'Other', 'Forms', 'c.pdf')]
+
+def test_removed_folders_are_dropped(tmp_path):
+	src = str(tmp_path / 'src')
+	write(os.path.join(src, 'Old', 'a.pdf'), 'a')
+	write(os.path.join(src, 'b.pdf'), 'b')
+	manifest = manifest_of(tmp_path, src)
+	listing(manifest)
+	os.unlink(os.path.join(src, 'Old', 'a.pdf'))
+	os.rmdir(os.path.join(src, 'Old'))
+	assert listing(manifest) == [os.path.join(src, 'b.pdf')]
+	assert manifest.entry(os.path.join(src, 'Old', 'a.pdf')) is None
+
+def test_changed_since(tmp_path):
+	src = str(tmp_path / 'src')
+	write(os.path.join(src, 'old.pdf'), 'a')
+	write(os.path.join(src, 'new.pdf'), 'b')
+	os.utime(os.path.join(src, 'old.pdf'), (1000, 1000))
+	manifest = manifest_of(tmp_path, src)
+	assert listing(manifest, changed_since=2000) == [os.path.join(src, 'new.pdf')]
@@ -0,0 +1,97 @@
+__author__ = 'Renchen'
+
+import io
+import os
+import pytest
+
+numpy = pytest.importorskip('numpy')
+from PIL import Image
+
+import diff_artifact
+from diff_artifact import _rle, _unrle
+
+@pytest.mark.parametrize('mask', [
+	[[0, 0, 1], [1, 1, 0]],
+	[[1, 1], [1, 1]],
+	[[0, 0], [0, 0]],
+	[[1, 0, 1, 0, 1]],
+])
+def test_rle_round_trip(mask):
+	mask = numpy.array(mask, dtype=bool)
+	assert (_unrle(_rle(mask), mask.shape) == mask).all()
+
+def test_rle_starts_with_an_unchanged_run():
+	runs = numpy.frombuffer(_rle(numpy.array([[1, 1, 0]], dtype=bool)), dtype='<u4')
+	assert list(runs) == [0, 2, 1]
+
+def test_rle_random_masks():
+	random = numpy.random.RandomState(0)
+	for shape in [(1, 1), (7, 13), (64, 48)]:
+		mask = random.rand(*shape) > 0.7
+		assert (_unrle(_rle(mask), shape) == mask).all()
+
+def difference(size, boxes):
+	image = Image.new('RGB', size, 'black')
+	for left, top, right, bottom in boxes:
+		image.paste((200, 10, 10), (left, top, right, bottom))
+	return image
+
+def test_write_and_read_back(tmp_path):
+	path = str(tmp_path / ('a' + diff_artifact.EXT))
+	image = difference((40, 30), [(2, 3, 6, 5), (20, 20, 25, 28)])
+	pages = {1: diff_artifact.encode_page(image, [(0, 0, 10, 10), (18, 18, 30, 30)]), 3: diff_artifact.encode_page(image, [(0, 0, 40, 30)])}
+	diff_artifact.write(path, pages)
+	with diff_artifact.diff_artifact(path) as artifact:
+		assert artifact.pages() == [1, 3]
+		expected = numpy.asarray(image).max(axis=2) != 0
+		assert (artifact.mask(1) == expected).all()
+		assert (numpy.asarray(artifact.difference_image(3)) == numpy.asarray(image)).all()
+	assert diff_artifact.exists(diff_artifact.page_path(path, 3))
+	assert not diff_artifact.exists(diff_artifact.page_path(path, 2))
+	assert Image.open(io.BytesIO(diff_artifact.render(diff_artifact.page_path(path, 1)))).size == (40, 30)
+
+def test_rewrite_keeps_and_drops_pages(tmp_path):
+	path = str(tmp_path / ('a' + diff_artifact.EXT))
+	image = difference((10, 10), [(1, 1, 3, 3)])
+	page = diff_artifact.encode_page(image, [(0, 0, 10, 10)])
+	diff_artifact.write(path, {1: page, 2: page, 3: page})
+	diff_artifact.write(path, {4: page}, keep=[1, 3])
+	with diff_artifact.diff_artifact(path) as artifact:
+		assert artifact.pages() == [1, 3, 4]
+	diff_artifact.write(path, {})
+	assert not os.path.exists(path)
+
+def test_page_paths():
+	path = diff_artifact.page_path('/out/h/diff/a.rdiff', 12)
+	assert diff_artifact.split_page_path(path) == ('/out/h/diff/a.rdiff', 12)
+	assert diff_artifact.split_page_path('/out/h/diff/a#1.png') == ('/out/h/diff/a#1.png', None)
+
+def test_staged_run_writes_each_artifact_once_its_document_is_diffed(tmp_path, monkeypatch, mongo, make_converter, make_corpus):
+	regression = pytest.importorskip('regression')
+	monkeypatch.chdir(tmp_path)
+	events = []
+	record = regression.Regression._Regression__record_image_diff
+	write = diff_artifact.write
+
+	def recorded(self, arg, future):
+		record(self, arg, future)
+		held = [artifact for artifact in self._Regression__diff_artifacts.values() if artifact['pages']]
+		events.append(('record', os.path.basename(arg[0]).split('_')[0], len(held)))
+
+	def written(path, pages, keep=()):
+		events.append(('write', os.path.splitext(os.path.basename(path))[0], None))
+		return write(path, pages, keep)
+	monkeypatch.setattr(regression.Regression, '_Regression__record_image_diff', recorded)
+	monkeypatch.setattr(diff_artifact, 'write', written)
+
+	src = make_corpus({'a.pdf': 4, 'b.pdf': 4, 'c.pdf': 4})
+	regression.Regression(src_testdir=src, out_dir=str(tmp_path / 'out'), concur=1, diff_concur=1, do_diff=True, pipelined=False,
+						  ref_bin_dir=make_converter('ref_bin', '9.1'), tar_bin_dir=make_converter('tar_bin', '9.2', shift=3)).run()
+	writes = [index for index, event in enumerate(events) if event[0] == 'write']
+	assert [events[index][1] for index in writes] == ['a', 'b', 'c']
+	# Each artifact is written right after the last page of its document, and patches
+	# of one document at most are held at a time
+	for index, name in zip(writes, ['a', 'b', 'c']):
+		assert events[index - 1][:2] == ('record', name)
+	assert max(held for kind, name, held in events if kind == 'record') == 1
+	assert mongo.pdftron_regression.difference_metrics.count_documents({}) == 12
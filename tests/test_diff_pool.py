@@ -0,0 +1,35 @@
+__author__ = 'Renchen'
+
+import pytest
+
+regression = pytest.importorskip('regression')
+
+@pytest.fixture
+def pools(monkeypatch):
+	'''
+	Every diff pool created, with the page pairs submitted to it
+	'''
+	created = []
+	original = regression.ProcessPoolExecutor
+
+	class executor(original):
+		def __init__(self, *args, **kw):
+			original.__init__(self, *args, **kw)
+			self.pairs = []
+			created.append(self)
+
+		def submit(self, func, *args, **kw):
+			self.pairs.append(args[:2])
+			return original.submit(self, func, *args, **kw)
+	monkeypatch.setattr(regression, 'ProcessPoolExecutor', executor)
+	return created
+
+@pytest.mark.parametrize('pipelined', [False, True])
+def test_one_pool_diffs_every_page_of_the_run(tmp_path, monkeypatch, mongo, make_converter, make_corpus, pools, pipelined):
+	monkeypatch.chdir(tmp_path)
+	src = make_corpus({'a.pdf': 3, 'b.pdf': 2, 'c.pdf': 4})
+	regression.Regression(src_testdir=src, out_dir=str(tmp_path / 'out'), concur=3, diff_concur=2, do_diff=True, pipelined=pipelined,
+						  ref_bin_dir=make_converter('ref_bin', '9.1'), tar_bin_dir=make_converter('tar_bin', '9.2', shift=3)).run()
+	assert len(pools) == 1
+	assert len(pools[0].pairs) == 9
+	assert mongo.pdftron_regression.difference_metrics.count_documents({}) == 9
@@ -0,0 +1,46 @@
+__author__ = 'Renchen'
+
+import json
+import os
+import pytest
+
+regression = pytest.importorskip('regression')
+
+def queued(output):
+	return [line[:-len(' added to queue')] for line in output.splitlines() if line.endswith(' added to queue')]
+
+def test_known_documents_start_longest_first_across_folders(tmp_path, monkeypatch, capfd, mongo, make_converter, make_corpus):
+	monkeypatch.chdir(tmp_path)
+	src = make_corpus({'a.pdf': 1, 'b.pdf': 1, 'Deep/Deeper/long.pdf': 1, 'Other/c.pdf': 1})
+	out_dir = str(tmp_path / 'out')
+	kw = dict(src_testdir=src, out_dir=out_dir, concur=1, do_diff=False, ref_bin_dir=make_converter('ref_bin', '9.1'))
+	regression.Regression(**kw).run()
+	capfd.readouterr()
+
+	# long.pdf took far longer than the rest last time
+	path = os.path.join(out_dir, 'conversion_stats.json')
+	with open(path, 'rb') as file:
+		stats = json.loads(file.read().decode('utf-8'))
+	for hash, roles in stats.items():
+		if hash.endswith('_long.pdf'):
+			roles['ref']['duration'] = 1000.0
+	with open(path, 'wb') as file:
+		file.write(json.dumps(stats).encode('utf-8'))
+	make_corpus({'Other/new.pdf': 1})
+
+	regression.Regression(**kw).run()
+	order = queued(capfd.readouterr().out)
+	assert order[0] == os.path.join(src, 'Deep', 'Deeper', 'long.pdf')
+	# Known documents first, then the ones the walk found
+	assert sorted(order[:4]) == sorted(os.path.join(src, name) for name in ['a.pdf', 'b.pdf', 'Deep/Deeper/long.pdf', 'Other/c.pdf'])
+	assert order[4:] == [os.path.join(src, 'Other', 'new.pdf')]
+
+def test_removed_documents_are_not_queued(tmp_path, monkeypatch, capfd, mongo, make_converter, make_corpus):
+	monkeypatch.chdir(tmp_path)
+	src = make_corpus({'a.pdf': 1, 'Sub/b.pdf': 1})
+	kw = dict(src_testdir=src, out_dir=str(tmp_path / 'out'), concur=1, do_diff=False, ref_bin_dir=make_converter('ref_bin', '9.1'))
+	regression.Regression(**kw).run()
+	os.unlink(os.path.join(src, 'Sub', 'b.pdf'))
+	capfd.readouterr()
+	regression.Regression(**kw).run()
+	assert queued(capfd.readouterr().out) == [os.path.join(src, 'a.pdf')]
@@ -0,0 +1,97 @@
+__author__ = 'Renchen'
+
+import pytest
+
+mongomock = pytest.importorskip('mongomock')
+documents = pytest.importorskip('documents')
+from documents import Document, Reference, Difference, DifferenceMetric, Page, BulkWriter
+
+COLLECTIONS = ['documents', 'references', 'pages', 'differences', 'difference_metrics']
+
+def page(hash, version, page_num, path):
+	ret = Page()
+	for key, value in [('hash', hash), ('version', version), ('document_name', hash + '.pdf'), ('page_num', page_num), ('ext', 'png'), ('path', path)]:
+		ret.set(key, value)
+	return ret
+
+def document(hash, ref_version, tar_version, num_pages):
+	'''
+	What Reference.populate builds for a document with num_pages pages, the even ones changed
+	'''
+	reference = Reference()
+	reference.set('hash', hash)
+	reference.set('version', ref_version)
+	reference.set('type', 'pdf2image')
+	difference = Difference()
+	for key, value in [('hash', hash), ('version', tar_version), ('document_name', hash + '.pdf'), ('num_page_diffs', 0)]:
+		difference.set(key, value)
+	for page_num in range(1, num_pages + 1):
+		reference.get('pages')[page_num] = page(hash, ref_version, page_num, '/out/%s/ref/%d.png' % (hash, page_num))
+		percentage = 0.5 if page_num % 2 == 0 else 0
+		metric = DifferenceMetric({'diff_percentage': percentage, 'ssim': 1 - percentage, 'document_name': hash + '.pdf'})
+		for key, value in [('hash', hash), ('page_num', page_num), ('ref_version', ref_version), ('tar_version', tar_version)]:
+			metric.set(key, value)
+		difference.get('metrics')[page_num] = metric
+		if percentage:
+			difference.get('pages')[page_num] = page(hash, tar_version, page_num, '/out/%s/diff.rdiff#%d' % (hash, page_num))
+	reference.get('diffs')[tar_version] = difference
+	ret = Document()
+	for key, value in [('hash', hash), ('document_name', hash + '.pdf'), ('ext', '.pdf'), ('path', '/src/' + hash + '.pdf'), ('tags', ['src'])]:
+		ret.set(key, value)
+	ret.get('references')[ref_version] = reference
+	return ret
+
+def collections_of(db):
+	return dict((name, db[name]) for name in COLLECTIONS)
+
+def dump(db):
+	'''
+	Content of the collections with every _id replaced by the natural key of what it points to
+	'''
+	keys = {}
+	for name in COLLECTIONS:
+		for item in db[name].find():
+			natural = dict((field, item[field]) for field in ['hash', 'version', 'page_num', 'ref_version', 'tar_version'] if field in item)
+			keys[item['_id']] = (name, tuple(sorted(natural.items())))
+
+	def resolve(value):
+		if isinstance(value, dict):
+			return dict((key, resolve(item)) for key, item in value.items())
+		return keys.get(value, value) if not isinstance(value, (list, str, int, float)) else value
+
+	ret = {}
+	for name in COLLECTIONS:
+		items = [resolve(dict((key, value) for key, value in item.items() if key != '_id')) for item in db[name].find()]
+		ret[name] = sorted(items, key=repr)
+	return ret
+
+def write_both(runs):
+	client = mongomock.MongoClient()
+	sequential = collections_of(client.sequential)
+	bulk = collections_of(client.bulk)
+	for ref_version, tar_version, hashes in runs:
+		for hash, num_pages in hashes:
+			document(hash, ref_version, tar_version, num_pages).bson(sequential, ref_version, tar_version)
+		BulkWriter(bulk, chunk_size=2).write([document(hash, ref_version, tar_version, num_pages) for hash, num_pages in hashes])
+	return dump(client.sequential), dump(client.bulk)
+
+def test_bulk_writer_matches_document_bson():
+	sequential, bulk = write_both([('9.1', '9.2', [('a', 3), ('b', 1), ('c', 2)])])
+	assert bulk == sequential
+	assert len(bulk['difference_metrics']) == 6
+	# Pages of the reference and the changed pages of the target
+	assert len(bulk['pages']) == 6 + 2
+
+def test_bulk_writer_matches_document_bson_on_a_second_target():
+	sequential, bulk = write_both([('9.1', '9.2', [('a', 3), ('b', 1)]), ('9.1', '9.3', [('a', 3), ('b', 1), ('c', 2)])])
+	assert bulk == sequential
+	assert len(bulk['differences']) == 5
+	reference = [item for item in bulk['references'] if item['hash'] == 'a'][0]
+	assert sorted(reference['diffs'].keys()) == ['9_2', '9_3']
+
+def test_metrics_of_a_document_are_kept_per_page():
+	client = mongomock.MongoClient()
+	BulkWriter(collections_of(client.db)).write([document('a', '9.1', '9.2', 4)])
+	metrics = client.db.difference_metrics
+	assert metrics.count_documents({'hash': 'a'}) == 4
+	assert metrics.find_one({'hash': 'a', 'page_num': 2})['diff_percentage'] == 0.5
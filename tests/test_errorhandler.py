@@ -0,0 +1,66 @@
+__author__ = 'Renchen'
+
+import json
+import pytest
+
+from errorhandler import errorhandler
+
+class fake_collection(object):
+	def __init__(self):
+		self.inserts = []
+
+	def insert_many(self, records, ordered=True):
+		self.inserts.append([record['category'] for record in records])
+
+def test_records_are_written_to_the_log(tmp_path):
+	path = str(tmp_path / 'errors.jsonl')
+	handler = errorhandler(path)
+	handler.write('/src/a.pdf', 'exit code -11', object='ref', iscrash=True)
+	handler.write('/src/b.pdf', object='tar', istimeout=True)
+	handler.writemessage(b'something happened\n')
+	handler.close()
+	with open(path, 'rb') as file:
+		records = [json.loads(line.decode('utf-8')) for line in file]
+	assert [record['category'] for record in records] == ['crash', 'timeout', 'message']
+	assert records[2]['message'] == 'something happened'
+	assert handler.crashes() == ['/src/a.pdf']
+	assert handler.timeouts() == ['/src/b.pdf']
+
+def test_log_is_appended_to(tmp_path):
+	path = str(tmp_path / 'errors.jsonl')
+	for name in ['a', 'b']:
+		handler = errorhandler(path)
+		handler.write('/src/%s.pdf' % name, ismissing=True)
+		handler.close()
+	with open(path, 'rb') as file:
+		assert len(file.readlines()) == 2
+
+def test_records_are_inserted_in_batches(tmp_path):
+	collection = fake_collection()
+	handler = errorhandler(str(tmp_path / 'errors.jsonl'), collection, batch_size=2)
+	handler.write('/src/a.pdf', iscrash=True)
+	assert collection.inserts == []
+	handler.write('/src/b.pdf', ismissing=True)
+	handler.write('/src/c.pdf', 'Bad xref', isexception=True)
+	assert collection.inserts == [['crash', 'missing']]
+	handler.flush()
+	assert collection.inserts == [['crash', 'missing'], ['exception']]
+
+def test_late_collection_gets_earlier_records(tmp_path):
+	collection = fake_collection()
+	handler = errorhandler(str(tmp_path / 'errors.jsonl'), batch_size=100)
+	handler.write('/src/a.pdf', object='ref', iscrash=True)
+	handler.write('/src/b.pdf', object='tar', istimeout=True)
+	handler.attach_collection(collection)
+	handler.write('/src/c.pdf', ismissing=True)
+	handler.flush()
+	assert collection.inserts == [['crash', 'timeout', 'missing']]
+
+def test_staged_run_stores_every_error(tmp_path, monkeypatch, mongo, make_converter, make_corpus):
+	regression = pytest.importorskip('regression')
+	monkeypatch.chdir(tmp_path)
+	src = make_corpus({'a.pdf': 1, 'c.pdf': 'pages=1\nCRASH\n'})
+	regression.Regression(src_testdir=src, out_dir=str(tmp_path / 'out'), concur=1, do_diff=True, pipelined=False,
+						  ref_bin_dir=make_converter('ref_bin', '9.1'), tar_bin_dir=make_converter('tar_bin', '9.2')).run()
+	categories = sorted(record['category'] for record in mongo.pdftron_regression.errors.find({'category': {'$ne': 'message'}}))
+	assert categories == ['crash', 'crash', 'missing']
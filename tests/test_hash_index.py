@@ -0,0 +1,73 @@
+__author__ = 'Renchen'
+
+import hashlib
+import os
+import threading
+import pytest
+
+import hash_index as hash_index_module
+from hash_index import hash_index
+
+@pytest.fixture
+def reads(monkeypatch):
+	'''
+	Paths opened by hash_index, in order
+	'''
+	opened = []
+	original = open
+
+	def counting_open(path, *args, **kw):
+		opened.append(path)
+		return original(path, *args, **kw)
+	monkeypatch.setattr(hash_index_module, 'open', counting_open, raising=False)
+	return opened
+
+def write(path, data):
+	path.write_bytes(data)
+	return str(path)
+
+def test_each_document_is_read_once(tmp_path, reads):
+	path = write(tmp_path / 'a.pdf', b'%PDF a')
+	index = hash_index()
+	assert index.digest(path) == hashlib.sha1(b'%PDF a').hexdigest()
+	assert index.digest(path) == index.digest(os.path.join(str(tmp_path), '.', 'a.pdf'))
+	assert index.document_hash(path) == hashlib.sha1(b'%PDF a').hexdigest() + '_a.pdf'
+	assert reads == [path]
+
+def test_changed_documents_are_hashed_again(tmp_path, reads):
+	path = write(tmp_path / 'a.pdf', b'%PDF a')
+	index = hash_index()
+	index.digest(path)
+	write(tmp_path / 'a.pdf', b'%PDF b, longer')
+	assert index.digest(path) == hashlib.sha1(b'%PDF b, longer').hexdigest()
+	assert len(reads) == 2
+
+def test_concurrent_callers_share_one_read(tmp_path, reads):
+	path = write(tmp_path / 'a.pdf', b'x' * (4 << 20))
+	index = hash_index(chunk_size=4096)
+	barrier = threading.Barrier(8)
+	digests = []
+
+	def digest():
+		barrier.wait()
+		digests.append(index.digest(path))
+	threads = [threading.Thread(target=digest) for i in range(8)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	assert len(set(digests)) == 1 and len(digests) == 8
+	assert reads == [path]
+
+def test_index_is_persisted(tmp_path, reads):
+	path = write(tmp_path / 'a.pdf', b'%PDF a')
+	index_path = str(tmp_path / 'index' / 'hash_index.json')
+	index = hash_index(index_path)
+	index.digest(path)
+	index.save()
+	assert hash_index(index_path).digest(path) == hashlib.sha1(b'%PDF a').hexdigest()
+	# The document itself, the index file is opened by the second hash_index only
+	assert [item for item in reads if item == path] == [path]
+
+def test_unreadable_documents_have_no_hash(tmp_path):
+	assert hash_index().document_hash(str(tmp_path / 'missing.pdf')) is None
@@ -0,0 +1,128 @@
+__author__ = 'Renchen'
+
+import io
+import os
+import pytest
+
+numpy = pytest.importorskip('numpy')
+from PIL import Image, ImageDraw
+
+import image_diff
+
+def page(size=(300, 300), marks=(), color=(0, 0, 0)):
+	image = Image.new('RGB', size, 'white')
+	draw = ImageDraw.Draw(image)
+	for box in marks:
+		draw.rectangle(box, fill=color)
+	return image
+
+def save(image, path):
+	image.save(str(path), 'PNG')
+	return str(path)
+
+def test_identical_pages():
+	stats = image_diff.ComputeDiffStats(page(marks=[(10, 10, 20, 20)]), page(marks=[(10, 10, 20, 20)]))
+	assert stats['diff_pixels'] == 0
+	assert stats['region_count'] == 0
+	assert stats['ssim'] == 1.0
+	assert stats['diff_image'] is None
+
+def test_pixel_counts_and_bbox():
+	# 10 x 10 black square, across a tile boundary
+	stats = image_diff.ComputeDiffStats(page(size=(300, 300)), page(size=(300, 300), marks=[(250, 250, 259, 259)]))
+	assert stats['diff_pixels'] == 100
+	assert stats['diff_percentage'] == pytest.approx(100 * 100 / 90000.0)
+	assert stats['bbox'] == (250, 250, 260, 260)
+	assert stats['max_delta'] == {'R': 255, 'G': 255, 'B': 255}
+
+def test_tolerance_ignores_small_deltas():
+	# An almost white square only in ref, a black one only in tar
+	ref = page(marks=[(10, 10, 19, 19)], color=(250, 250, 250))
+	tar = page(marks=[(100, 100, 109, 109)])
+	stats = image_diff.ComputeDiffStats(ref, tar, tolerance=8)
+	assert stats['diff_pixels'] == 200
+	assert stats['tolerance_pixels'] == 100
+	# Regions are counted above tolerance
+	assert stats['region_count'] == 1
+	assert image_diff.ComputeDiffStats(ref, tar)['region_count'] == 2
+
+def test_nearby_specks_are_one_region():
+	mask = numpy.zeros((64, 64), dtype=bool)
+	mask[2, 2] = mask[5, 6] = True
+	mask[40, 40] = True
+	assert image_diff.CountRegions(mask) == 2
+
+def test_region_boxes_cover_the_changes():
+	mask = numpy.zeros((40, 50), dtype=bool)
+	mask[3:5, 3:5] = True
+	mask[30, 45] = True
+	boxes = sorted(image_diff.RegionBoxes(image_diff._cells(mask), (50, 40)))
+	assert boxes == [(0, 0, 8, 8), (40, 24, 48, 32)]
+
+def test_ssim_drops_with_larger_changes():
+	ref = page(marks=[(20, 20, 280, 40)])
+	small = image_diff.StructuralSimilarity(ref, page(marks=[(20, 20, 280, 40), (100, 100, 105, 105)]))
+	large = image_diff.StructuralSimilarity(ref, page(marks=[(20, 20, 280, 40), (20, 100, 280, 200)]))
+	assert 1.0 > small > large
+	assert image_diff.StructuralSimilarity(ref, ref) == pytest.approx(1.0)
+
+def test_image_diff(tmp_path):
+	ref = save(page(marks=[(10, 10, 19, 19)]), tmp_path / 'ref.png')
+	out = tmp_path / 'diff'
+	out.mkdir()
+	tar = save(page(marks=[(10, 10, 19, 19), (100, 100, 109, 109)]), tmp_path / 'tar.png')
+	msg = image_diff.ImageDiff(ref, tar, str(out))
+	assert msg['diff_percentage'] == pytest.approx(100 * 100 / 90000.0)
+	assert msg['region_count'] == 1
+	assert os.path.exists(msg['diff_image_path'])
+
+	same = save(page(marks=[(10, 10, 19, 19)]), tmp_path / 'same.png')
+	assert image_diff.ImageDiff(ref, same, str(out))['diff_image_path'] == ''
+	assert image_diff.ImageDiff(ref, str(tmp_path / 'missing.png'), str(out)) is None
+
+	compact = image_diff.ImageDiff(ref, tar, str(out / 'unused'), compact=True)
+	assert compact['diff_image_path'] == ''
+	assert compact['artifact']['boxes'] == [[96, 96, 112, 112]]
+
+def test_compact_diff_crops_patches_out_of_the_changed_tiles(tmp_path, monkeypatch):
+	ref = save(page(size=(600, 600), marks=[(10, 10, 19, 19)]), tmp_path / 'ref.png')
+	tar = save(page(size=(600, 600), marks=[(10, 10, 19, 19), (250, 250, 270, 270), (500, 40, 509, 49)]), tmp_path / 'tar.png')
+	out = tmp_path / 'diff'
+	out.mkdir()
+	full = image_diff.ImageDiff(ref, tar, str(out))
+	composed = Image.open(full['diff_image_path'])
+
+	sizes = []
+	new = Image.new
+	monkeypatch.setattr(Image, 'new', lambda mode, size, *args: sizes.append(tuple(size)) or new(mode, size, *args))
+	artifact = image_diff.ImageDiff(ref, tar, str(tmp_path / 'unused'), compact=True)['artifact']
+	assert (600, 600) not in sizes
+	assert artifact['size'] == [600, 600]
+	# The same patches as out of the full difference image, across tile boundaries too
+	boxes = [tuple(box) for box in artifact['boxes']]
+	assert boxes == [(248, 248, 272, 272), (496, 40, 512, 56)]
+	for box, patch in zip(boxes, artifact['patches']):
+		assert Image.open(io.BytesIO(patch)).tobytes() == composed.crop(box).tobytes()
+
+def test_renders_of_different_sizes_compare_their_overlap(tmp_path, monkeypatch):
+	ref = page(size=(300, 300), marks=[(10, 10, 19, 19)])
+	taller = page(size=(300, 400), marks=[(10, 10, 19, 19), (10, 350, 19, 359)])
+	assert image_diff.PixelsIdentical(ref, taller)
+	assert not image_diff.PixelsIdentical(ref, page(size=(300, 400), marks=[(10, 10, 29, 19)]))
+	paths = (save(ref, tmp_path / 'ref.png'), save(taller, tmp_path / 'tar.png'))
+	assert image_diff.ImageDiff(paths[0], paths[1], str(tmp_path / 'unused'))['diff_percentage'] == 0.0
+	monkeypatch.setattr(image_diff, 'numpy', None)
+	assert image_diff.ImageDiff(paths[0], paths[1], str(tmp_path / 'unused'))['diff_percentage'] == 0.0
+
+@pytest.mark.parametrize('mode', ['RGB', 'RGBA', 'L', 'P'])
+def test_numpy_and_pil_fallback_agree(monkeypatch, mode):
+	ref = page(size=(530, 270), marks=[(10, 10, 40, 40), (300, 200, 310, 260)]).convert(mode)
+	tar = page(size=(530, 270), marks=[(10, 10, 40, 40), (250, 100, 290, 140), (500, 5, 529, 7)], color=(40, 90, 200)).convert(mode)
+	with_numpy = image_diff.ComputeDiffStats(ref, tar, tolerance=30)
+	monkeypatch.setattr(image_diff, 'numpy', None)
+	fallback = image_diff.ComputeDiffStats(ref, tar, tolerance=30)
+	assert with_numpy['diff_pixels'] > 0
+	for key in ['diff_pixels', 'diff_percentage', 'tolerance_pixels', 'tolerance_percentage', 'bbox', 'max_delta']:
+		assert with_numpy[key] == fallback[key], key
+	assert image_diff.ImageCompare(ref, tar) == with_numpy['diff_percentage']
+	assert with_numpy['diff_image'].tobytes() == fallback['diff_image'].tobytes()
@@ -0,0 +1,65 @@
+__author__ = 'Renchen'
+
+import time
+import pytest
+
+from lease_store import sqlite_lease_store, mongo_lease_store
+
+@pytest.fixture(params=['sqlite', 'mongo'])
+def store(request, tmp_path):
+	if request.param == 'sqlite':
+		return sqlite_lease_store(str(tmp_path / 'leases.sqlite'))
+	mongomock = pytest.importorskip('mongomock')
+	return mongo_lease_store(mongomock.MongoClient().db.leases)
+
+def test_claim_hands_out_each_lease_once(store):
+	store.create('r1', {'0000': ['a.pdf'], '0001': ['b.pdf', 'c.pdf']})
+	store.create('r2', {'0000': ['z.pdf']})
+	first = store.claim('r1', 'w1', 60)
+	second = store.claim('r1', 'w2', 60)
+	assert (first['_id'], first['files']) == ('r1/0000', ['a.pdf'])
+	assert (second['_id'], second['files']) == ('r1/0001', ['b.pdf', 'c.pdf'])
+	assert store.claim('r1', 'w3', 60) is None
+	assert store.progress('r1') == {'leased': 2}
+
+def test_create_is_idempotent(store):
+	store.create('r1', {'0000': ['a.pdf']})
+	lease = store.claim('r1', 'w1', 60)
+	assert store.complete(lease['_id'], 'w1')
+	# A restarted coordinator doesn't reset the leases already done
+	store.create('r1', {'0000': ['a.pdf']})
+	assert store.progress('r1') == {'done': 1}
+	assert store.finished('r1')
+
+def test_expired_lease_is_taken_over(store):
+	store.create('r1', {'0000': ['a.pdf']})
+	lease = store.claim('r1', 'w1', -1)
+	assert lease['attempts'] == 1
+	taken = store.claim('r1', 'w2', 60)
+	assert taken['_id'] == lease['_id']
+	assert taken['attempts'] == 2
+	# The first owner lost it
+	assert not store.renew(lease['_id'], 'w1', 60)
+	assert not store.complete(lease['_id'], 'w1')
+	assert store.renew(taken['_id'], 'w2', 60)
+	assert store.claim('r1', 'w1', 60) is None
+	assert store.complete(taken['_id'], 'w2')
+	assert store.finished('r1')
+
+def test_renew_keeps_the_lease(store):
+	store.create('r1', {'0000': ['a.pdf']})
+	lease = store.claim('r1', 'w1', 0.2)
+	time.sleep(0.1)
+	assert store.renew(lease['_id'], 'w1', 60)
+	time.sleep(0.2)
+	assert store.claim('r1', 'w2', 60) is None
+
+def test_release_returns_lease_to_pending(store):
+	store.create('r1', {'0000': ['a.pdf']})
+	lease = store.claim('r1', 'w1', 60)
+	store.release(lease['_id'], 'w2')
+	assert store.progress('r1') == {'leased': 1}
+	store.release(lease['_id'], 'w1')
+	assert store.progress('r1') == {'pending': 1}
+	assert not store.finished('r1')
+	assert store.claim('r1', 'w2', 60)['_id'] == lease['_id']
@@ -0,0 +1,31 @@
+__author__ = 'Renchen'
+
+import json
+import os
+import pytest
+
+regression = pytest.importorskip('regression')
+pytestmark = pytest.mark.skipif(os.name != 'posix', reason='limits are set with prlimit')
+
+@pytest.mark.parametrize('scheduler', ['threads', 'asyncio'])
+def test_failures_are_put_down_to_limits_only_on_evidence(scheduler, tmp_path, monkeypatch, mongo, make_converter, make_corpus):
+	monkeypatch.chdir(tmp_path)
+	src = make_corpus({'hang.pdf': 'pages=1\nHANG\n', 'spin.pdf': 'pages=1\nSPIN\n', 'alloc.pdf': 'pages=1\nALLOC\n',
+					   'segv.pdf': 'pages=1\nSEGV\n', 'kill.pdf': 'pages=1\nKILL\n', 'ok.pdf': 1})
+	out_dir = str(tmp_path / 'out')
+	regression.Regression(src_testdir=src, out_dir=out_dir, concur=6, do_diff=False, timeout=5, cpu_limit=1, mem_limit=1 << 30, scheduler=scheduler,
+						  ref_bin_dir=make_converter('ref_bin', '9.1')).run()
+	with open(os.path.join(out_dir, 'errors.jsonl')) as file:
+		records = [json.loads(line) for line in file]
+	categories = dict((os.path.basename(record['path']), record['category']) for record in records if record['category'] not in ['message', 'missing'])
+	assert categories == {
+		# Killed by the timer
+		'hang.pdf': 'timeout',
+		# SIGXCPU at the CPU limit
+		'spin.pdf': 'timeout',
+		# Aborted after reporting bad_alloc
+		'alloc.pdf': 'oom',
+		# A segfault under a memory limit, a SIGKILL nobody sent under a CPU limit
+		'segv.pdf': 'crash',
+		'kill.pdf': 'crash',
+	}
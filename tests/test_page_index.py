@@ -0,0 +1,57 @@
+__author__ = 'Renchen'
+
+import os
+
+import page_index as page_index_module
+from page_index import page_index, page_number, scan_pages, scan_tree
+
+def touch(path, data=b'png'):
+	if not os.path.exists(os.path.dirname(path)):
+		os.makedirs(os.path.dirname(path))
+	with open(path, 'wb') as file:
+		file.write(data)
+	return path
+
+def test_page_numbers():
+	assert page_number('a.png', 'a') == 1
+	assert page_number('a_12.png', 'a') == 12
+	assert page_number('a_b.png', 'a') is None
+	assert page_number('a_2.png', 'ab') is None
+	assert page_number('a_2.jpg', 'a') is None
+	assert page_number('a_2_3.png', 'a_2') == 3
+
+def test_scan_pages(tmp_path):
+	folder = str(tmp_path)
+	for name in ['a_1.png', 'a_2.png', 'a_10.png', 'a_x.png', 'b_1.png', 'a_3.log']:
+		touch(os.path.join(folder, name))
+	os.makedirs(os.path.join(folder, 'a_4.png'))
+	pages = scan_pages(folder, 'a')
+	assert sorted(pages.keys()) == [1, 2, 10]
+	assert pages[10]['path'] == os.path.join(folder, 'a_10.png')
+	assert pages[10]['size'] == 3
+	assert scan_pages(os.path.join(folder, 'missing'), 'a') == {}
+
+def test_scan_tree(tmp_path):
+	for path in ['a.pdf', 'x/b.PDF', 'x/y/c.docx', 'x/y/d.txt']:
+		touch(os.path.join(str(tmp_path), path))
+	found = sorted(os.path.relpath(path, str(tmp_path)) for path in scan_tree(str(tmp_path), ['.pdf', '.docx']))
+	assert found == ['a.pdf', os.path.join('x', 'b.PDF'), os.path.join('x', 'y', 'c.docx')]
+
+def test_directories_are_scanned_once_until_refreshed(tmp_path, monkeypatch):
+	scans = []
+	scan = page_index_module.scan_pages
+	monkeypatch.setattr(page_index_module, 'scan_pages', lambda directory, stem: scans.append(directory) or scan(directory, stem))
+	index = page_index(str(tmp_path))
+	hash = 'f00d_doc.pdf'
+	touch(os.path.join(index.directory(hash, 'ref', '9.1'), 'doc_1.png'))
+	assert list(index.pages(hash, 'ref', '9.1').keys()) == [1]
+	touch(os.path.join(index.directory(hash, 'ref', '9.1'), 'doc_2.png'))
+	assert list(index.pages(hash, 'ref', '9.1').keys()) == [1]
+	assert len(scans) == 1
+	assert sorted(index.refresh(hash, 'ref', '9.1').keys()) == [1, 2]
+	index.invalidate(hash, 'ref', '9.1')
+	assert sorted(index.pages(hash, 'ref', '9.1').keys()) == [1, 2]
+	assert len(scans) == 3
+	# Targets have no version folder
+	touch(os.path.join(str(tmp_path), hash, 'tar', 'doc.png'))
+	assert list(index.pages(hash, 'tar').keys()) == [1]
@@ -0,0 +1,65 @@
+__author__ = 'Renchen'
+
+import zipfile
+import pytest
+
+from page_policy import page_policy, probe_page_count
+
+def pdf(tmp_path, count, name='a.pdf'):
+	path = tmp_path / name
+	kids = ' '.join('%d 0 R' % (i + 3) for i in range(count))
+	body = b'%PDF-1.4\n1 0 obj << /Type /Catalog /Pages 2 0 R >> endobj\n'
+	body += ('2 0 obj << /Type /Pages /Kids [%s] /Count %d >> endobj\n' % (kids, count)).encode('ascii')
+	for i in range(count):
+		body += ('%d 0 obj << /Type /Page /Parent 2 0 R >> endobj\n' % (i + 3)).encode('ascii')
+	path.write_bytes(body + b'%%EOF\n')
+	return str(path)
+
+def test_probe_page_count(tmp_path):
+	assert probe_page_count(pdf(tmp_path, 23)) == 23
+	path = tmp_path / 'b.docx'
+	with zipfile.ZipFile(str(path), 'w') as archive:
+		archive.writestr('docProps/app.xml', '<Properties><Pages>4</Pages></Properties>')
+	assert probe_page_count(str(path)) == 4
+	(tmp_path / 'c.pdf').write_bytes(b'%PDF-1.5 compressed object streams only')
+	assert probe_page_count(str(tmp_path / 'c.pdf')) is None
+	assert probe_page_count(str(tmp_path / 'missing.pdf')) is None
+
+def test_all_and_first():
+	assert page_policy('all').select('h') is None
+	policy = page_policy('first', max_pages=3)
+	assert policy.select('h') == [1, 2, 3]
+	assert policy.includes('h', 3) and not policy.includes('h', 4)
+	assert policy.page_range('h') == '1-3'
+
+def test_sampled_uses_the_recorded_page_count():
+	policy = page_policy('sampled', max_pages=5, page_count=lambda hash: {'long': 23, 'short': 3}.get(hash))
+	assert policy.select('long') == [1, 7, 12, 17, 23]
+	assert policy.page_range('long') == '1,7,12,17,23'
+	assert policy.select('short') == [1, 2, 3]
+	# Never converted, no document to probe: every page
+	assert policy.select('unknown') is None
+
+def test_sampled_probes_documents_on_their_first_run(tmp_path):
+	policy = page_policy('sampled', max_pages=5, page_count=lambda hash: None)
+	assert policy.select('h', pdf(tmp_path, 23)) == [1, 7, 12, 17, 23]
+	assert page_policy('sampled', max_pages=1).select('h', pdf(tmp_path, 9, 'b.pdf')) == [1]
+
+def test_changed_tops_up_with_the_first_pages():
+	changed = {'h': [9, 4], 'many': list(range(20, 30))}
+	policy = page_policy('changed', max_pages=4, changed_pages=changed.get)
+	assert policy.select('h') == [1, 2, 4, 9]
+	assert policy.select('many') == [20, 21, 22, 23]
+	assert policy.select('new') == [1, 2, 3, 4]
+	assert policy.page_range('h') == '1-2,4,9'
+
+def test_selection_is_made_once_per_run():
+	counts = {'h': 3}
+	policy = page_policy('sampled', max_pages=5, page_count=counts.get)
+	assert policy.select('h') == [1, 2, 3]
+	counts['h'] = 40
+	assert policy.select('h') == [1, 2, 3]
+
+def test_unknown_mode():
+	with pytest.raises(AssertionError):
+		page_policy('odd')
@@ -0,0 +1,125 @@
+__author__ = 'Renchen'
+
+import multiprocessing
+import os
+import pytest
+
+from pdfnet_backend import pdfnet_backend
+
+# Stand-in for a bundled PDFNetPython build. A "PDF" is a text file whose first
+# line is the page count; CRASH or HANG in it makes the worker die or hang. Every
+# page written holds the pid of the worker that rendered it
+FAKE_PDFNET = '''
+import os, time
+
+class PDFNet(object):
+	@staticmethod
+	def Initialize():
+		pass
+
+	@staticmethod
+	def GetVersion():
+		return 9.1
+
+class PDFDoc(object):
+	def __init__(self, path):
+		with open(path) as file:
+			data = file.read()
+		if 'CRASH' in data:
+			os._exit(245)
+		if 'HANG' in data:
+			time.sleep(60)
+		self.count = int(data.split()[0])
+
+	def InitSecurityHandler(self):
+		pass
+
+	def GetPageCount(self):
+		return self.count
+
+	def GetPageIterator(self):
+		return PageIterator(self.count)
+
+	def Close(self):
+		pass
+
+class PageIterator(object):
+	def __init__(self, count):
+		self.page_num = 1
+		self.count = count
+
+	def HasNext(self):
+		return self.page_num <= self.count
+
+	def Current(self):
+		return self.page_num
+
+	def Next(self):
+		self.page_num += 1
+
+class PDFDraw(object):
+	def SetDPI(self, dpi):
+		pass
+
+	def Export(self, page, path, format):
+		with open(path, 'w') as file:
+			file.write(str(os.getpid()))
+'''
+
+@pytest.fixture
+def backend(tmp_path, monkeypatch):
+	lib = tmp_path / 'fake_lib'
+	lib.mkdir()
+	(lib / '__init__.py').write_text('')
+	(lib / 'PDFNetPython.py').write_text(FAKE_PDFNET)
+	monkeypatch.syspath_prepend(str(tmp_path))
+	ret = pdfnet_backend('fake_lib', concur=1)
+	# Spawned workers get this sys.path, a forkserver started by an earlier test wouldn't
+	ret._pdfnet_backend__context = multiprocessing.get_context('spawn')
+	yield ret
+	ret.shutdown()
+
+def document(tmp_path, name, content):
+	path = tmp_path / name
+	path.write_text(content)
+	out = tmp_path / ('out_' + name)
+	out.mkdir()
+	return str(path), str(out)
+
+def rendered_by(out, name):
+	with open(os.path.join(out, name)) as file:
+		return int(file.read())
+
+def test_workers_are_reused_and_replaced_after_a_failure(tmp_path, backend):
+	assert backend.available()
+	assert backend.version() == '9.1'
+	assert backend.supports('a.pdf') and not backend.supports('a.docx')
+
+	path, out = document(tmp_path, 'a.pdf', '2\n')
+	assert backend.convert(path, out, timeout=30) == (None, {'status': 'ok', 'pages': 2})
+	first = rendered_by(out, 'a_1.png')
+	path, out = document(tmp_path, 'b.pdf', '1\n')
+	assert backend.convert(path, out, timeout=30)[0] is None
+	# Same worker as for the probe and a.pdf
+	assert rendered_by(out, 'b.png') == first
+
+	path, out = document(tmp_path, 'c.pdf', '1\nCRASH\n')
+	assert backend.convert(path, out, timeout=30) == ('crash', None)
+	path, out = document(tmp_path, 'd.pdf', '1\n')
+	assert backend.convert(path, out, timeout=30)[0] is None
+	second = rendered_by(out, 'd.png')
+	assert second != first
+
+	path, out = document(tmp_path, 'e.pdf', '1\nHANG\n')
+	assert backend.convert(path, out, timeout=1) == ('timeout', None)
+	path, out = document(tmp_path, 'f.pdf', '3\n')
+	assert backend.convert(path, out, timeout=30, pages=[2]) == (None, {'status': 'ok', 'pages': 3})
+	assert os.listdir(out) == ['f_2.png']
+	assert rendered_by(out, 'f_2.png') not in [first, second]
+
+def test_unloadable_build_is_unavailable(tmp_path, monkeypatch):
+	monkeypatch.syspath_prepend(str(tmp_path))
+	backend = pdfnet_backend('missing_lib', concur=1)
+	backend._pdfnet_backend__context = multiprocessing.get_context('spawn')
+	assert not backend.available()
+	assert not backend.supports('a.pdf')
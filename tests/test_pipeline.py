@@ -0,0 +1,84 @@
+__author__ = 'Renchen'
+
+import threading
+import time
+import pytest
+
+from pipeline import pipeline
+
+def test_items_go_through_the_stages_in_order():
+	events = []
+	lock = threading.Lock()
+
+	def stage(name, func):
+		def ret(arg):
+			with lock:
+				events.append((name, arg if name != 'persist' else tuple(arg)))
+			return func(arg)
+		return ret
+
+	batches = []
+	pipeline(stage('convert', lambda item: item * 10), stage('diff', lambda item: item + 1), batches.extend,
+			 convert_concur=1, diff_concur=1, persist_batch=3).run(range(5))
+	assert batches == [1, 11, 21, 31, 41]
+	for item in range(5):
+		converted = events.index(('convert', item))
+		diffed = events.index(('diff', item * 10))
+		assert converted < diffed
+	# With one worker per stage, items leave every stage in the order they came in
+	assert [arg for name, arg in events if name == 'convert'] == list(range(5))
+	assert [arg for name, arg in events if name == 'diff'] == [0, 10, 20, 30, 40]
+
+def test_failed_or_dropped_items_do_not_stop_the_others():
+	def convert(item):
+		if item == 2:
+			raise RuntimeError('converter crashed')
+		return None if item == 3 else item
+
+	def diff(item):
+		if item == 4:
+			raise RuntimeError('bad page')
+		return item
+
+	persisted = []
+	batches = []
+
+	def persist(batch):
+		batches.append(len(batch))
+		if 5 in batch:
+			raise RuntimeError('database down')
+		persisted.extend(batch)
+
+	pipeline(convert, diff, persist, convert_concur=3, diff_concur=2, persist_batch=1).run(range(8))
+	assert sorted(persisted) == [0, 1, 6, 7]
+	assert len(batches) == 5
+
+def test_slow_stages_bound_the_items_in_flight():
+	converted = []
+	persisted = []
+
+	def diff(item):
+		time.sleep(0.01)
+		# Never more than the queues and the workers between convert and persist
+		assert len(converted) - len(persisted) <= 2 + 2 + 2 + 1
+		return item
+
+	pipeline(lambda item: converted.append(item) or item, diff, persisted.extend,
+			 convert_concur=1, diff_concur=1, queue_size=2).run(range(30))
+	assert sorted(persisted) == list(range(30))
+
+def test_diff_pool_is_sized_by_diff_concur(tmp_path, monkeypatch, mongo, make_converter, make_corpus):
+	regression = pytest.importorskip('regression')
+	monkeypatch.chdir(tmp_path)
+	sizes = []
+	original = regression.ProcessPoolExecutor
+
+	def executor(max_workers=None, **kw):
+		sizes.append(max_workers)
+		return original(max_workers=max_workers, **kw)
+	monkeypatch.setattr(regression, 'ProcessPoolExecutor', executor)
+	src = make_corpus({'a.pdf': 2, 'b.pdf': 2})
+	regression.Regression(src_testdir=src, out_dir=str(tmp_path / 'out'), concur=4, diff_concur=1, do_diff=True,
+						  ref_bin_dir=make_converter('ref_bin', '9.1'), tar_bin_dir=make_converter('tar_bin', '9.2', shift=3)).run()
+	assert sizes == [1]
+	assert mongo.pdftron_regression.difference_metrics.count_documents({}) == 4
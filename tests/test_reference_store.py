@@ -0,0 +1,115 @@
+__author__ = 'Renchen'
+
+import os
+import pytest
+
+import reference_store as store_module
+from reference_store import reference_store, renderer_key, mark, is_complete, read_marker
+
+def render(folder, pages, stem='a'):
+	os.makedirs(folder, exist_ok=True)
+	ret = {}
+	for page_num in pages:
+		path = os.path.join(folder, '%s_%d.png' % (stem, page_num))
+		with open(path, 'wb') as file:
+			file.write(('page %d' % page_num).encode('utf-8'))
+		ret[page_num] = path
+	return ret
+
+@pytest.fixture(params=[True, False], ids=['link', 'copy'])
+def store(request, tmp_path):
+	return reference_store(str(tmp_path / 'store'), link=request.param, fsync=False)
+
+def test_renderer_key():
+	assert renderer_key('9.1', 'sha') == renderer_key('9.1', 'sha')
+	assert renderer_key('9.1', 'sha') != renderer_key('9.1', 'other')
+	assert renderer_key('9.1', 'sha', {'dpi': 96}) != renderer_key('9.1', 'sha', {'dpi': 150})
+
+def test_publish_then_fetch(store, tmp_path):
+	pages = render(str(tmp_path / 'run1'), [1, 2, 3])
+	assert store.publish('h', 'r', None, pages)
+	# Published once
+	assert not store.publish('h', 'r', None, pages)
+
+	output_dir = str(tmp_path / 'run2')
+	assert store.fetch('h', 'r', None, output_dir) == 3
+	assert sorted(os.listdir(output_dir)) == ['COMPLETE', 'a_1.png', 'a_2.png', 'a_3.png']
+	with open(os.path.join(output_dir, 'a_2.png'), 'rb') as file:
+		assert file.read() == b'page 2'
+	assert is_complete(output_dir, 'r')
+	assert not is_complete(output_dir, 'other renderer')
+	assert store.fetch('h', 'other renderer', None, str(tmp_path / 'run3')) is None
+
+def test_selections(store, tmp_path):
+	store.publish('h', 'r', [1, 2], render(str(tmp_path / 'run1'), [1, 2]))
+	assert store.lookup('h', 'r', [1])
+	assert store.lookup('h', 'r', [1, 2])
+	assert store.lookup('h', 'r', [1, 5]) is None
+	# Every page is needed
+	assert store.lookup('h', 'r') is None
+
+	store.publish('h', 'r', None, render(str(tmp_path / 'run2'), [1, 2, 3]))
+	assert store.lookup('h', 'r', [1, 5])
+	output_dir = str(tmp_path / 'run3')
+	assert store.fetch('h', 'r', [3], output_dir) == 3
+	# The marker says what the folder covers
+	assert read_marker(output_dir)['selection'] is None
+
+def test_corrupt_entry_is_evicted(store, tmp_path):
+	store.publish('h', 'r', None, render(str(tmp_path / 'run1'), [1, 2]))
+	folder, marker = store.lookup('h', 'r')
+	path = os.path.join(folder, 'a_2.png')
+	os.unlink(path)
+	with open(path, 'wb') as file:
+		file.write(b'garbage')
+
+	output_dir = str(tmp_path / 'run2')
+	assert store.fetch('h', 'r', None, output_dir) is None
+	assert store.lookup('h', 'r') is None
+	# Nothing half copied is left behind
+	assert not [name for name in os.listdir(output_dir) if name.endswith('.png')]
+	assert not is_complete(output_dir, 'r')
+
+def test_partial_output_folder_is_not_complete(tmp_path):
+	output_dir = str(tmp_path / 'out')
+	pages = render(output_dir, [1, 2])
+	assert not is_complete(output_dir, 'r')
+	mark(output_dir, 'h', 'r', {os.path.basename(path): 'sha' for path in pages.values()}, [1, 2])
+	assert is_complete(output_dir, 'r', [2])
+	assert not is_complete(output_dir, 'r', [3])
+	assert not is_complete(output_dir, 'r')
+	# A page truncated or lost after the marker was written
+	with open(pages[2], 'wb') as file:
+		file.write(b'')
+	assert not is_complete(output_dir, 'r', [1])
+
+def test_stale_temporary_folders_are_swept(tmp_path, monkeypatch):
+	root = str(tmp_path / 'store')
+	reference_store(root)
+	stale = os.path.join(root, 'tmp', 'left-by-a-crash')
+	fresh = os.path.join(root, 'tmp', 'being-published')
+	os.makedirs(stale)
+	os.makedirs(fresh)
+	old = os.stat(stale).st_mtime - store_module.STALE_AGE - 60
+	os.utime(stale, (old, old))
+	reference_store(root)
+	assert not os.path.exists(stale)
+	assert os.path.exists(fresh)
+
+def test_second_run_fetches_references(tmp_path, monkeypatch, mongo, make_converter, make_corpus):
+	regression = pytest.importorskip('regression')
+	monkeypatch.chdir(tmp_path)
+	src = make_corpus({'a.pdf': 2, 'b.pdf': 1})
+	ref_bin = make_converter('ref_bin', '9.1')
+	kw = dict(src_testdir=src, concur=1, do_diff=False, ref_bin_dir=ref_bin)
+	store = str(tmp_path / 'store')
+	regression.Regression(out_dir=str(tmp_path / 'out1'), ref_store=store, **kw).run()
+
+	# Same binary, so the same renderer, but any conversion would now crash
+	monkeypatch.setenv('FAKE_CONVERTER_FAIL', '1')
+	out_dir = str(tmp_path / 'out2')
+	regression.Regression(out_dir=out_dir, ref_store=store, **kw).run()
+	fetched = [name for root, dirs, names in os.walk(out_dir) for name in names if name.endswith('.png')]
+	assert sorted(fetched) == ['a_1.png', 'a_2.png', 'b.png']
+	with open(os.path.join(out_dir, 'sanity.json'), 'rb') as file:
+		assert b'"crashes": 0' in file.read()
@@ -0,0 +1,62 @@
+__author__ = 'Renchen'
+
+import sqlite3
+
+from results_store import results_store
+
+def result(percentage):
+	return {'diff_image_path': '/out/h/diff/1_2/a_1.png', 'diff_percentage': percentage, 'match': percentage == 0}
+
+def test_record_and_lookup(tmp_path):
+	store = results_store(str(tmp_path / 'results.sqlite'), run='r1')
+	store.record('/out/h/ref/a_1.png', '/out/h/tar/a_1.png', result(0.5))
+	assert store.by_tar('/out/h/tar/a_1.png') == result(0.5)
+	assert store.by_ref('/out/h/ref/a_1.png') == result(0.5)
+	assert store.by_tar('/out/h/tar/a_2.png') is None
+	# Replaced, not duplicated
+	store.record('/out/h/ref/a_1.png', '/out/h/tar/a_1.png', result(0))
+	assert store.by_tar('/out/h/tar/a_1.png') == result(0)
+	store.close()
+
+def test_forget(tmp_path):
+	store = results_store(str(tmp_path / 'results.sqlite'))
+	store.record('/ref/a_1.png', '/tar/a_1.png', result(0.1))
+	store.record('/ref/a_2.png', '/tar/a_2.png', result(0.2))
+	store.forget(['/tar/a_1.png'])
+	assert store.by_tar('/tar/a_1.png') is None
+	assert store.by_tar('/tar/a_2.png') == result(0.2)
+	store.close()
+
+def test_results_are_committed_in_batches_and_on_flush(tmp_path):
+	path = str(tmp_path / 'results.sqlite')
+	store = results_store(path, run='r1', commit_every=3)
+
+	def committed():
+		connection = sqlite3.connect(path)
+		try:
+			return connection.execute('SELECT COUNT(*) FROM diffs').fetchone()[0]
+		finally:
+			connection.close()
+
+	store.record('/ref/a_1.png', '/tar/a_1.png', result(0))
+	store.record('/ref/a_2.png', '/tar/a_2.png', result(0))
+	assert committed() == 0
+	store.record('/ref/a_3.png', '/tar/a_3.png', result(0))
+	assert committed() == 3
+	store.record('/ref/a_4.png', '/tar/a_4.png', result(0))
+	store.flush()
+	assert committed() == 4
+	store.close()
+
+def test_settings_survive_reopening(tmp_path):
+	path = str(tmp_path / 'results.sqlite')
+	store = results_store(path)
+	assert store.setting('tolerance') is None
+	store.set_setting('tolerance', '8')
+	store.record('/ref/a_1.png', '/tar/a_1.png', result(0.3))
+	store.close()
+
+	store = results_store(path)
+	assert store.setting('tolerance') == '8'
+	assert store.by_ref('/ref/a_1.png') == result(0.3)
+	store.close()
@@ -0,0 +1,76 @@
+__author__ = 'Renchen'
+
+import json
+
+from run_manifest import run_manifest
+
+def test_conversion_current(tmp_path):
+	output_dir = tmp_path / 'h' / 'ref' / '9.1'
+	output_dir.mkdir(parents=True)
+	(output_dir / 'a_1.png').write_bytes(b'1')
+	(output_dir / 'a_2.png').write_bytes(b'2')
+	manifest = run_manifest(str(tmp_path / 'run_manifest.json'))
+	assert not manifest.conversion_current('h', 'ref', 'bin1', str(output_dir), '9.1')
+	manifest.record_conversion('h', 'ref', 'bin1', {'a_1.png': 'd1', 'a_2.png': 'd2'}, True, '9.1')
+
+	assert manifest.conversion_current('h', 'ref', 'bin1', str(output_dir), '9.1')
+	# Another binary, version, role or page selection
+	assert not manifest.conversion_current('h', 'ref', 'bin2', str(output_dir), '9.1')
+	assert not manifest.conversion_current('h', 'ref', 'bin1', str(output_dir), '9.2')
+	assert not manifest.conversion_current('h', 'tar', 'bin1', str(output_dir))
+	assert not manifest.conversion_current('h', 'ref', 'bin1', str(output_dir), '9.1', [1])
+	# A page went missing
+	(output_dir / 'a_2.png').unlink()
+	assert not manifest.conversion_current('h', 'ref', 'bin1', str(output_dir), '9.1')
+
+def test_failed_conversion(tmp_path):
+	manifest = run_manifest(str(tmp_path / 'run_manifest.json'))
+	manifest.record_conversion('h', 'tar', 'bin1', {}, False)
+	assert manifest.conversion_failed('h', 'tar')
+	assert not manifest.conversion_failed('h', 'ref', '9.1')
+	assert not manifest.conversion_current('h', 'tar', 'bin1', str(tmp_path))
+
+def test_diff_results_replace_previous_ones(tmp_path):
+	manifest = run_manifest(str(tmp_path / 'run_manifest.json'))
+	manifest.record_diff('h', '9.1-9.2', 'a_1.png', 'r1', 't1', {'diff_percentage': 0.5})
+	assert manifest.diff_result('h', '9.1-9.2', 'a_1.png', 'r1', 't1') == {'diff_percentage': 0.5}
+	assert manifest.diff_result('h', '9.1-9.2', 'a_1.png', 'r1', 't2') is None
+	assert manifest.diff_result('h', '9.1-9.3', 'a_1.png', 'r1', 't1') is None
+
+	manifest.record_diff('h', '9.1-9.2', 'a_1.png', 'r1', 't2', {'diff_percentage': 0})
+	assert manifest.diff_result('h', '9.1-9.2', 'a_1.png', 'r1', 't2') == {'diff_percentage': 0}
+	assert manifest.diff_result('h', '9.1-9.2', 'a_1.png', 'r1', 't1') is None
+	manifest.save()
+	with open(str(tmp_path / 'run_manifest.json'), 'rb') as file:
+		saved = json.loads(file.read().decode('utf-8'))
+	assert saved['documents']['h']['diffs'] == {'9.1-9.2': {'a_1.png': {'ref': 'r1', 'tar': 't2', 'result': {'diff_percentage': 0}}}}
+
+def test_save_and_reload(tmp_path):
+	path = str(tmp_path / 'run_manifest.json')
+	manifest = run_manifest(path)
+	manifest.record_conversion('h', 'ref', 'bin1', {'a.png': 'd'}, True, '9.1', [1, 3])
+	manifest.record_changed_pages('h', {3, 1})
+	manifest.record_diff('h', '9.1-9.2', 'a.png', 'r', 't', {'diff_percentage': 0.1})
+	manifest.save()
+
+	manifest = run_manifest(path)
+	assert manifest.changed_pages('h') == [1, 3]
+	assert manifest.changed_pages('other') is None
+	(tmp_path / 'a.png').write_bytes(b'x')
+	assert manifest.conversion_current('h', 'ref', 'bin1', str(tmp_path), '9.1', [1, 3])
+	assert manifest.diff_result('h', '9.1-9.2', 'a.png', 'r', 't') == {'diff_percentage': 0.1}
+
+def test_format_1_diffs_are_dropped(tmp_path):
+	path = tmp_path / 'run_manifest.json'
+	document = {'conversions': {'tar': {'binary': 'bin1', 'status': 'ok', 'pages': {}, 'selection': None}},
+				'diffs': {'9.1-9.2': {'r:t': {'diff_percentage': 0}}}}
+	path.write_text(json.dumps({'documents': {'h': document}}))
+	manifest = run_manifest(str(path))
+	assert manifest.conversion_current('h', 'tar', 'bin1', str(tmp_path))
+	assert manifest.diff_result('h', '9.1-9.2', 'r:t', 'r', 't') is None
+
+def test_unreadable_manifest_starts_empty(tmp_path):
+	path = tmp_path / 'run_manifest.json'
+	path.write_text('{not json')
+	manifest = run_manifest(str(path))
+	assert manifest.changed_pages('h') is None
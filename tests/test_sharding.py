@@ -0,0 +1,80 @@
+__author__ = 'Renchen'
+
+import json
+import os
+import pytest
+
+regression = pytest.importorskip('regression')
+from lease_store import sqlite_lease_store
+
+class limited_store(object):
+	'''
+	Lease store that hands out at most claims leases, so several workers get a share
+	'''
+	def __init__(self, store, claims):
+		self.__store = store
+		self.__claims = claims
+
+	def claim(self, run, owner, ttl):
+		if not self.__claims:
+			return None
+		self.__claims -= 1
+		return self.__store.claim(run, owner, ttl)
+
+	def __getattr__(self, name):
+		return getattr(self.__store, name)
+
+def summary(out_dir):
+	with open(os.path.join(out_dir, 'sanity.json'), 'rb') as file:
+		ret = json.loads(file.read().decode('utf-8'))['summary']
+	del ret['run']
+	return ret
+
+def test_coordinator_report_includes_worker_errors(tmp_path, monkeypatch, mongo, make_converter, make_corpus):
+	monkeypatch.chdir(tmp_path)
+	src = make_corpus({'a.pdf': 2, 'b.pdf': 1, 'Annotations/c.pdf': 'pages=2\nCRASH\n', 'd.pdf': 3})
+	kw = dict(src_testdir=src, concur=2, do_diff=True,
+			  ref_bin_dir=make_converter('ref_bin', '9.1'), tar_bin_dir=make_converter('tar_bin', '9.2', shift=3))
+
+	single_out = str(tmp_path / 'single')
+	regression.Regression(out_dir=single_out, **kw).run()
+
+	sharded_out = str(tmp_path / 'sharded')
+	store = sqlite_lease_store(str(tmp_path / 'leases.sqlite'))
+	coordinator = regression.Regression(out_dir=sharded_out, **kw)
+	coordinator.run_coordinator(store, run_id='r1', lease_size=1, wait=False)
+	regression.Regression(out_dir=sharded_out, worker_id='w1', **kw).run_worker('r1', limited_store(store, 2))
+	regression.Regression(out_dir=sharded_out, worker_id='w2', **kw).run_worker('r1', store)
+	assert store.finished('r1')
+	# Both workers did some of the work, and wrote their errors to their own log
+	assert os.path.exists(os.path.join(sharded_out, 'errors.w1.jsonl'))
+	assert os.path.exists(os.path.join(sharded_out, 'errors.w2.jsonl'))
+
+	# Everything is done, so this only builds the report
+	coordinator.run_coordinator(store, run_id='r1', lease_size=1, wait=True, poll_interval=0)
+	sharded = summary(sharded_out)
+	assert sharded['crashes'] == 2
+	assert sharded['missing'] == 1
+	assert sharded == summary(single_out)
+
+def test_replayed_errors_are_counted_once(tmp_path):
+	from errorhandler import errorhandler
+	worker = errorhandler(str(tmp_path / 'errors.w1.jsonl'))
+	worker.set_run('r1')
+	worker.write('/src/a.pdf', message='exit code -11', object='ref', iscrash=True)
+	worker.write('/src/b.pdf', 'Bad xref', object='tar', isexception=True)
+	worker.write('/src/c.pdf', ismissing=True)
+	worker.close()
+	other = errorhandler(str(tmp_path / 'errors.w2.jsonl'))
+	other.set_run('r0')
+	other.write('/src/d.pdf', object='ref', iscrash=True)
+	other.close()
+
+	coordinator = errorhandler(str(tmp_path / 'errors.jsonl'))
+	coordinator.write('/src/a.pdf', message='exit code -11', object='ref', iscrash=True)
+	assert coordinator.replay(str(tmp_path / 'errors.w1.jsonl'), 'r1') == 1
+	assert coordinator.replay(str(tmp_path / 'errors.w1.jsonl'), 'r1') == 0
+	assert coordinator.replay(str(tmp_path / 'errors.w2.jsonl'), 'r1') == 0
+	assert coordinator.crashes() == ['/src/a.pdf']
+	assert coordinator.exceptions() == [('Bad xref', ['/src/b.pdf'])]
+	assert coordinator.missing() == []
@@ -0,0 +1,26 @@
+__author__ = 'Renchen'
+
+import os
+import pytest
+
+regression = pytest.importorskip('regression')
+
+def pngs(folder):
+	return sorted(name for root, dirs, names in os.walk(folder) for name in names if name.endswith('.png'))
+
+def test_simple_mode_renders_every_page(tmp_path, monkeypatch, mongo, make_converter, make_corpus):
+	monkeypatch.chdir(tmp_path)
+	src = make_corpus({'a.pdf': 12})
+	ref_out = str(tmp_path / 'ref')
+	tar_out = str(tmp_path / 'tar')
+	diff_out = str(tmp_path / 'diff')
+	for folder in [ref_out, tar_out, diff_out]:
+		os.makedirs(folder)
+	# The default page_selection ('first', 10 pages) is for centralized mode only
+	regression.Regression(src_testdir=src, ref_outdir=ref_out, tar_outdir=tar_out, diff_outdir=diff_out, concur=1, do_diff=True,
+						  ref_bin_dir=make_converter('ref_bin', '9.1'), tar_bin_dir=make_converter('tar_bin', '9.2', shift=3)).run()
+	expected = ['a_%d.png' % page_num for page_num in range(1, 13)]
+	assert pngs(ref_out) == sorted(expected)
+	assert pngs(tar_out) == sorted(expected)
+	# Even pages are shifted in tar
+	assert pngs(diff_out) == sorted('a_%d.png' % page_num for page_num in range(2, 13, 2))